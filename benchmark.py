@@ -0,0 +1,150 @@
+import gc
+import json
+import math
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+import graphviz
+from explain import CostBatch, Graph, GraphVisualizer, Snapshot
+
+"""
+Directory of the recorded fixtures: snapshot.json (the settings and catalog of the database) and plans/*.json (EXPLAIN (FORMAT JSON) outputs).
+"""
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+"""
+The benchmarked stages of the explain pipeline, in order. The batch stage evaluates the costs of the plan with a CostBatch instead of a Graph, 
+as run_offline does.
+"""
+STAGES = ('graph', 'descriptions', 'render', 'batch')
+
+"""
+Function to load the fixtures. Returns the Snapshot and the plans by fixture name.
+"""
+def load_fixtures(directory = None):
+    directory = directory or FIXTURES_DIR
+    db = Snapshot.load(os.path.join(directory, 'snapshot.json'))
+
+    plans = {}
+    plans_directory = os.path.join(directory, 'plans')
+    for file_name in sorted(os.listdir(plans_directory)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(plans_directory, file_name)) as file:
+                plans[file_name[:-len('.json')]] = json.load(file)[0]['Plan']
+    return db, plans
+
+"""
+Function to get the number of nodes and the depth of a plan.
+"""
+def get_plan_shape(query_plan):
+    node_count = 0
+    depth = 0
+    stack = [(query_plan, 1)]
+    while stack:
+        query_plan, level = stack.pop()
+        node_count += 1
+        depth = max(depth, level)
+        stack.extend((child_query_plan, level + 1) for child_query_plan in query_plan.get('Plans', ()))
+    return node_count, depth
+
+"""
+Minimum duration of a timed run: stages faster than this are run several times per timed run, as timeit does, to reduce the noise.
+"""
+MIN_RUN_TIME = 0.05
+
+"""
+Function to measure a stage: the median and minimum time per call over repeat timed runs, then the peak memory allocated by one more call 
+under tracemalloc. The setup is called before each call and is not measured, its result is passed to the stage.
+"""
+def measure(stage, setup, repeat):
+    argument = setup()
+    started = time.perf_counter()
+    stage(argument)
+    number = max(1, math.ceil(MIN_RUN_TIME / max(time.perf_counter() - started, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        arguments = [setup() for _ in range(number)]
+        # As in timeit, the garbage collector would otherwise add the cost of collecting earlier runs to random runs
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            for argument in arguments:
+                stage(argument)
+            times.append((time.perf_counter() - started) / number)
+        finally:
+            gc.enable()
+        del arguments
+
+    argument = setup()
+    tracemalloc.start()
+    try:
+        stage(argument)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': statistics.median(times), 'min_time': min(times), 'number': number, 'peak_memory': peak_memory}
+
+"""
+Function to benchmark the stages of the explain pipeline on every fixture plan.
+The render stage is skipped (None) when the Graphviz executables are not installed.
+"""
+def run_benchmark(directory = None, repeat = 5, epsilon = 1):
+    db, plans = load_fixtures(directory)
+    results = {}
+    for name, query_plan in plans.items():
+        node_count, depth = get_plan_shape(query_plan)
+        result = {'nodes': node_count, 'depth': depth}
+        build_graph = lambda: Graph(query_plan, db, epsilon)
+
+        result['graph'] = measure(lambda _: build_graph(), lambda: None, repeat)
+        result['descriptions'] = measure(lambda graph: [node.cost_description for node in graph.nodes], build_graph, repeat)
+        try:
+            result['render'] = measure(GraphVisualizer, build_graph, repeat)
+        except graphviz.ExecutableNotFound:
+            result['render'] = None
+        result['batch'] = measure(lambda _: CostBatch([query_plan], db, epsilon).evaluate(), lambda: None, repeat)
+        results[name] = result
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+"""
+Function to compare benchmark results against a baseline.
+Returns the regressions as (fixture, stage, baseline time, time) for the stages slower than threshold times the baseline. 
+The minimum times are compared, as they are the least sensitive to the noise of the machine.
+"""
+def compare_results(baseline, results, threshold = 1.25):
+    regressions = []
+    for name, result in results['results'].items():
+        baseline_result = baseline['results'].get(name)
+        if not baseline_result:
+            continue
+        for stage in STAGES:
+            if result.get(stage) and baseline_result.get(stage) and result[stage]['min_time'] > baseline_result[stage]['min_time'] * threshold:
+                regressions.append((name, stage, baseline_result[stage]['min_time'], result[stage]['min_time']))
+    return regressions
+
+"""
+Function to format benchmark results as a table, with the ratio to the baseline when one is given.
+"""
+def format_results(results, baseline = None):
+    lines = [f"{'fixture':<12} {'nodes':>6} {'depth':>6} {'stage':<13} {'time (ms)':>10} {'peak (KiB)':>11}" + (f" {'vs baseline':>12}" if baseline else "")]
+    for name, result in results['results'].items():
+        for stage in STAGES:
+            if result[stage] is None:
+                lines.append(f"{name:<12} {result['nodes']:>6} {result['depth']:>6} {stage:<13} {'skipped':>10}")
+                continue
+            line = f"{name:<12} {result['nodes']:>6} {result['depth']:>6} {stage:<13} {result[stage]['time'] * 1000:>10.2f} {result[stage]['peak_memory'] / 1024:>11.1f}"
+            baseline_result = baseline['results'].get(name, {}).get(stage) if baseline else None
+            if baseline_result:
+                line += f" {result[stage]['min_time'] / baseline_result['min_time']:>11.2f}x"
+            lines.append(line)
+    return '\n'.join(lines)
@@ -1,14 +1,962 @@
 import psycopg2
+import psycopg2.extras
 import graphviz
-import random
 from pprint import pp
 import math
 import re
+import os
+import json
+import hashlib
+import itertools
+import copy
+import threading
+import weakref
+from collections import OrderedDict
+import time
+import numpy as np
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from dataclasses import dataclass, field, fields, replace
+from types import MappingProxyType
+
+"""
+Multipliers to normalize the memory units reported by pg_settings into bytes.
+"""
+MEMORY_UNITS = {'B': 1, 'kB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+"""
+Function to normalize a raw pg_settings value based on its vartype and unit. 
+Memory settings are converted to bytes (e.g. work_mem with unit 'kB' or min_parallel_table_scan_size with unit '8kB'), booleans to bool and numbers to int/float.
+"""
+def normalize_setting(setting, unit, vartype):
+    if vartype == 'bool':
+        return setting == 'on'
+    if vartype not in ('integer', 'real'):
+        return setting
+
+    value = int(setting) if vartype == 'integer' else float(setting)
+    unit_match = re.fullmatch(r'(\d*)(B|kB|MB|GB|TB)', unit or '')
+    if unit_match:
+        value *= int(unit_match.group(1) or 1) * MEMORY_UNITS[unit_match.group(2)]
+    return value
+
+"""
+Units of the memory settings whose values are given without a unit, as in postgresql.conf and pg_settings.
+"""
+SETTING_UNITS = {'block_size': 'B', 'work_mem': 'kB', 'min_parallel_table_scan_size': '8kB'}
+
+"""
+Function to parse the value of a setting given as in postgresql.conf: a number, or a string with an optional memory unit ('64MB', '1.1'). 
+Memory settings are converted to bytes, a number without a unit being in the unit of SETTING_UNITS. Raises a ValueError for an invalid value.
+"""
+def parse_setting(name, value):
+    if isinstance(value, str):
+        value_match = re.fullmatch(r'\s*(-?\d+(?:\.\d*)?|-?\.\d+)\s*(B|kB|MB|GB|TB)?\s*', value)
+        if not value_match:
+            raise ValueError(f"Invalid value {value!r} for {name}")
+        value, unit = value_match.group(1), value_match.group(2)
+        if unit and name not in SETTING_UNITS:
+            raise ValueError(f"{name} does not accept the unit {unit}")
+    else:
+        unit = None
+    return normalize_setting(value, unit or SETTING_UNITS.get(name), 'real')
+
+"""
+Function to parse the value of a boolean setting: a bool, or a string as in postgresql.conf ('on', 'off', 'true', ...).
+"""
+def parse_bool_setting(value):
+    return value if isinstance(value, bool) else str(value).lower() in ('on', 'true', 'yes', '1')
+
+"""
+Class Settings is an immutable snapshot of the planner settings used by the cost calculators. 
+It is filled by a single pg_settings query (see DB.get_settings), memory settings are in bytes.
+"""
+@dataclass(frozen=True)
+class Settings:
+    block_size: int = 8192
+    seq_page_cost: float = 1.0
+    random_page_cost: float = 4.0
+    cpu_tuple_cost: float = 0.01
+    cpu_index_tuple_cost: float = 0.005
+    cpu_operator_cost: float = 0.0025
+    parallel_setup_cost: float = 1000.0
+    parallel_tuple_cost: float = 0.1
+    work_mem: int = 4 * 1024 ** 2
+    hash_mem_multiplier: float = 2.0
+    max_parallel_workers_per_gather: int = 2
+    parallel_leader_participation: bool = True
+    min_parallel_table_scan_size: int = 8 * 1024 ** 2
+    enable_flags: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+
+    """
+    Names of the pg_settings rows that map directly to a field of the snapshot.
+    """
+    NAMES = (
+        'block_size', 'seq_page_cost', 'random_page_cost', 'cpu_tuple_cost', 'cpu_index_tuple_cost', 'cpu_operator_cost', 
+        'parallel_setup_cost', 'parallel_tuple_cost', 'work_mem', 'hash_mem_multiplier', 
+        'max_parallel_workers_per_gather', 'parallel_leader_participation', 'min_parallel_table_scan_size',
+    )
+
+    """
+    Method to build the snapshot from (name, setting, unit, vartype) rows of pg_settings. 
+    Settings missing from the server (e.g. hash_mem_multiplier before PostgreSQL 13) keep their PostgreSQL default.
+    """
+    @classmethod
+    def from_rows(cls, rows):
+        values = {}
+        enable_flags = {}
+        for name, setting, unit, vartype in rows:
+            value = normalize_setting(setting, unit, vartype)
+            if name.startswith('enable_'):
+                enable_flags[name] = value
+            elif name in cls.NAMES:
+                values[name] = value
+        return cls(enable_flags=MappingProxyType(enable_flags), **values)
+
+    """
+    Method to get a fingerprint of the snapshot, which changes whenever any setting changes.
+    """
+    def get_fingerprint(self):
+        return hashlib.sha1(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()
+
+    """
+    Method to get the snapshot as a JSON serializable dict.
+    """
+    def to_dict(self):
+        values = {name: getattr(self, name) for name in Settings.NAMES}
+        values['enable_flags'] = dict(self.enable_flags)
+        return values
+
+    """
+    Method to build the snapshot from a dict returned by to_dict. Missing settings keep their PostgreSQL default, unknown ones (e.g. of an older version) are ignored.
+    """
+    @classmethod
+    def from_dict(cls, values):
+        enable_flags = dict(values.get('enable_flags', {}))
+        return cls(enable_flags=MappingProxyType(enable_flags), **{name: value for name, value in values.items() if name in cls.NAMES})
+
+    """
+    Method to check whether a planner method (e.g. 'seqscan' or 'enable_seqscan') is enabled.
+    """
+    def is_enabled(self, name):
+        return self.enable_flags.get(name if name.startswith('enable_') else 'enable_' + name, True)
+
+    """
+    Method to get a copy of the settings with some values overridden, e.g. for a what-if simulation. 
+    The values are parsed by parse_setting ('64MB', '1.1', 1.1), the enable_* flags and the boolean settings accept booleans or 'on'/'off'.
+    Raises a ValueError for an unknown setting or an invalid value.
+    """
+    def override(self, overrides):
+        types = {setting.name: setting.type for setting in fields(self)}
+        values = {}
+        enable_flags = dict(self.enable_flags)
+        for name, value in overrides.items():
+            if name.startswith('enable_'):
+                enable_flags[name] = parse_bool_setting(value)
+            elif name in Settings.NAMES and types[name] is bool:
+                values[name] = parse_bool_setting(value)
+            elif name in Settings.NAMES:
+                value = parse_setting(name, value)
+                values[name] = int(round(value)) if types[name] is int else value
+            else:
+                raise ValueError(f"Unknown setting {name}")
+        return replace(self, enable_flags=MappingProxyType(enable_flags), **values)
+
+"""
+Class ExplainMode enumerates how a query is explained, from planning only (the query is never executed) to a full EXPLAIN ANALYZE.
+The value is the label shown in the GUI, the options are the EXPLAIN options used by DB.get_query_plan.
+"""
+class ExplainMode(Enum):
+    ESTIMATE = 'Estimate only'
+    ANALYZE = 'Analyze'
+    ANALYZE_BUFFERS = 'Analyze with buffers and timing'
+
+    """
+    Method to get the options of the EXPLAIN command for the mode.
+    """
+    def get_options(self):
+        if self is ExplainMode.ESTIMATE:
+            return 'FORMAT JSON, VERBOSE TRUE'
+        if self is ExplainMode.ANALYZE:
+            return 'FORMAT JSON, VERBOSE TRUE, ANALYZE TRUE, TIMING FALSE'
+        return 'FORMAT JSON, VERBOSE TRUE, ANALYZE TRUE, BUFFERS TRUE, TIMING TRUE'
+
+    """
+    Method to check whether the mode executes the query.
+    """
+    def is_executing(self):
+        return self is not ExplainMode.ESTIMATE
+
+"""
+Class Catalog is an indexed in-memory snapshot of the pg_class rows of the tables, their indexes and their TOAST relations. 
+Relations are keyed by OID and by (schema, relname) so that identically named tables in different schemas do not collide.
+"""
+class Catalog:
+    """
+    Columns of each relation row, in the order returned by DB.get_statistics.
+    """
+    COLUMNS = ('oid', 'nspname', 'relname', 'relkind', 'relpages', 'reltuples', 'relhasindex', 'reltoastrelid', 'parent_oid')
+
+    """
+    Relation kinds that are listed as tables (ordinary, partitioned and materialized views).
+    """
+    TABLE_KINDS = ('r', 'p', 'm')
+
+    """
+    Constructor to instantiate a Catalog object from the rows of the bulk catalog query.
+    """
+    def __init__(self, rows = ()):
+        self.relations = {}
+        self.oids_by_name = {}
+        self.oids_by_relname = {}
+        self.oids_by_parent = {}
+        self.observers = []
+        for row in rows:
+            self.add(dict(zip(Catalog.COLUMNS, row)))
+
+    """
+    Method to subscribe an observer to the changes of the catalog. The observer is called with the OIDs of the tables that changed 
+    (reloaded, added or dropped) whenever the catalog is refreshed (see DB.refresh_statistics).
+    """
+    def subscribe(self, observer):
+        self.observers.append(observer)
+
+    """
+    Method to unsubscribe an observer from the changes of the catalog.
+    """
+    def unsubscribe(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    """
+    Method to notify the observers that the given tables changed.
+    """
+    def notify(self, oids):
+        for observer in list(self.observers):
+            observer(oids)
+
+    """
+    Method to add (or replace) a relation in the catalog and its name indexes.
+    """
+    def add(self, relation):
+        oid = relation['oid']
+        if oid in self.relations:
+            self.remove(oid)
+        self.relations[oid] = relation
+        self.oids_by_name[(relation['nspname'], relation['relname'])] = oid
+        self.oids_by_relname.setdefault(relation['relname'], []).append(oid)
+        if relation['parent_oid'] is not None:
+            self.oids_by_parent.setdefault(relation['parent_oid'], []).append(oid)
+
+    """
+    Method to remove a relation from the catalog and its name indexes.
+    """
+    def remove(self, oid):
+        relation = self.relations.pop(oid, None)
+        if relation is None:
+            return
+        self.oids_by_name.pop((relation['nspname'], relation['relname']), None)
+        oids = self.oids_by_relname[relation['relname']]
+        oids.remove(oid)
+        if not oids:
+            del self.oids_by_relname[relation['relname']]
+        if relation['parent_oid'] is not None:
+            siblings = self.oids_by_parent[relation['parent_oid']]
+            siblings.remove(oid)
+            if not siblings:
+                del self.oids_by_parent[relation['parent_oid']]
+
+    """
+    Method to remove a table together with its indexes and TOAST relation.
+    """
+    def remove_table(self, oid):
+        for dependent_oid in list(self.oids_by_parent.get(oid, ())):
+            self.remove(dependent_oid)
+        self.remove(oid)
+
+    """
+    Method to look up a relation by name. When the schema is not given, a relation in 'public' is preferred, mimicking the default search_path.
+    Returns None if the relation is unknown.
+    """
+    def get(self, relname, schema = None):
+        if schema:
+            oid = self.oids_by_name.get((schema, relname))
+            return self.relations[oid] if oid is not None else None
+
+        oids = self.oids_by_relname.get(relname)
+        if not oids:
+            return None
+        oid = self.oids_by_name.get(('public', relname), oids[0])
+        return self.relations[oid]
+
+    """
+    Method to get the tables (ordinary, partitioned and materialized views) of the catalog.
+    """
+    def tables(self):
+        return [relation for relation in self.relations.values() if relation['relkind'] in Catalog.TABLE_KINDS]
+
+    """
+    Method to get the indexes and the TOAST relation that belong to a given table OID.
+    """
+    def dependents(self, oid):
+        return [self.relations[dependent_oid] for dependent_oid in self.oids_by_parent.get(oid, ())]
+
+    """
+    Method to get the relations as rows in the order of Catalog.COLUMNS, e.g. to be serialized.
+    """
+    def to_rows(self):
+        return [[relation[column] for column in Catalog.COLUMNS] for relation in self.relations.values()]
+
+"""
+Function to get the directory of the on-disk caches: the given directory, $QUPEX_CACHE_DIR or ~/.cache/qupex.
+"""
+def get_cache_directory(directory = None):
+    return directory or os.environ.get('QUPEX_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'qupex')
+
+"""
+Class CatalogCache is the on-disk cache of catalog snapshots, so that reconnecting to a known database does not rescan the whole catalog. 
+Each snapshot is stored as a JSON file keyed by the server system identifier, the database and the user, together with the 
+pg_stat_all_tables stamps it was taken at, which are used to find the relations that need to be reloaded.
+"""
+class CatalogCache:
+    """
+    Version of the file format, bumped whenever Catalog.COLUMNS or the stamps change.
+    """
+    VERSION = 1
+
+    """
+    Constructor to instantiate a CatalogCache object. The directory defaults to $QUPEX_CACHE_DIR or ~/.cache/qupex.
+    """
+    def __init__(self, directory = None):
+        self.directory = get_cache_directory(directory)
+
+    """
+    Method to get the path of the cache file for a given key.
+    """
+    def get_path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, f'catalog-{digest}.json')
+
+    """
+    Method to load a cached snapshot. Returns (catalog, stamps), or None if there is no usable cache file.
+    """
+    def load(self, key):
+        try:
+            with open(self.get_path(key)) as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if content.get('version') != CatalogCache.VERSION or content.get('key') != list(key):
+            return None
+        stamps = {int(oid): tuple(stamp) for oid, stamp in content['stamps'].items()}
+        return Catalog(content['relations']), stamps
+
+    """
+    Method to save a snapshot. The file is written atomically so that concurrent sessions never read a partial file: 
+    it is written to a temporary file unique to the process and thread (the batch workers each save the catalog), then moved into place.
+    """
+    def save(self, key, catalog, stamps):
+        content = {
+            'version': CatalogCache.VERSION,
+            'key': list(key),
+            'relations': catalog.to_rows(),
+            'stamps': {str(oid): list(stamp) for oid, stamp in stamps.items()},
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.get_path(key)
+            temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(temporary_path, 'w') as file:
+                    json.dump(content, file)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        except OSError:
+            # The cache is only an optimization, failing to write it must not fail the login.
+            pass
+
+"""
+Class LRUCache is a bounded, thread-safe mapping that evicts the least recently used entry when it is full. 
+Entries can optionally expire after ttl seconds.
+"""
+class LRUCache:
+    """
+    Constructor to instantiate a LRUCache object.
+    """
+    def __init__(self, max_size, ttl = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    """
+    Method to get the value of a key, or None if it is missing or expired. The entry becomes the most recently used one.
+    """
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl is not None and time.monotonic() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    """
+    Method to set the value of a key, evicting the least recently used entries if the cache is full.
+    """
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    """
+    Method to remove the entries whose value matches a predicate. Returns the number of removed entries.
+    """
+    def discard_where(self, predicate):
+        with self.lock:
+            keys = [key for key, (value, _) in self.entries.items() if predicate(value)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    """
+    Method to remove all entries.
+    """
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+"""
+Pattern of the tokens of a query for normalization: literals and quoted identifiers are kept as they are, comments and whitespace are collapsed.
+"""
+SQL_QUERY_TOKEN = re.compile(r"""
+    (?P<literal>'(?:[^']|'')*'|"(?:[^"]|"")*"|(?P<tag>\$\w*\$)[\s\S]*?(?P=tag))
+    | (?P<space>\s+|--[^\n]*|/\*[\s\S]*?\*/)
+    | [^'"$\s/-]+ | [\s\S]
+""", re.VERBOSE)
+
+"""
+Function to normalize a query so that queries differing only in whitespace, comments, letter case (outside literals and quoted identifiers) 
+or a trailing semicolon share the same plan cache entry.
+"""
+def normalize_query(query: str):
+    parts = []
+    for match in SQL_QUERY_TOKEN.finditer(query):
+        if match.group('literal'):
+            parts.append(match.group('literal'))
+        elif match.group('space'):
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        else:
+            parts.append(match.group(0).lower())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+"""
+Class PlanCache is the LRU cache of explained queries: the parsed Graph and its rendered GraphVisualizer. 
+The key is the normalized query, the fingerprint of the planner settings, the explain mode and the epsilon. 
+The statistics version is tracked per relation: each entry remembers the tables its plan reads, and refreshing the statistics of a table 
+(DB.refresh_statistics) invalidates the entries that depend on it, while the other entries stay valid.
+"""
+class PlanCache:
+    """
+    Constructor to instantiate a PlanCache object. Entries expire after ttl seconds if it is given.
+    """
+    def __init__(self, max_size = 32, ttl = None):
+        self.entries = LRUCache(max_size, ttl)
+
+    """
+    Method to get the cache key of a query.
+    """
+    def get_key(self, query: str, settings: Settings, mode: ExplainMode, epsilon):
+        return normalize_query(query), settings.get_fingerprint(), mode.value, float(epsilon)
+
+    """
+    Method to get the cached (graph, visualizer) of a key, or None.
+    """
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[:2] if entry else None
+
+    """
+    Method to cache the graph and visualizer of a key.
+    """
+    def put(self, key, graph, visualizer):
+        self.entries.put(key, (graph, visualizer, graph.get_relation_oids()))
+
+    """
+    Method to invalidate the entries whose plan reads any of the given table OIDs.
+    """
+    def invalidate_relations(self, oids):
+        oids = set(oids)
+        return self.entries.discard_where(lambda entry: not entry[2].isdisjoint(oids))
+
+    """
+    Method to invalidate all entries.
+    """
+    def clear(self):
+        self.entries.clear()
+
+"""
+Class RenderCache is the cache of rendered graph images, so that a plan that has been rendered before is shown without running dot again. 
+The key is a hash of the DOT source, which holds the structure of the plan, the labels and the validity colouring of the nodes, 
+together with the image format and size. The images are kept in an in-memory LRU and in a directory on disk that is bounded in bytes, 
+evicting the least recently used files (by modification time, which is updated on every hit).
+"""
+class RenderCache:
+    """
+    Version of the cached images, bumped whenever GraphVisualizer changes the way it renders a DOT source.
+    """
+    VERSION = 1
+
+    """
+    Age in seconds after which a temporary file is considered left behind by a crashed process, and removed by evict.
+    """
+    STALE_TEMPORARY_AGE = 3600
+
+    """
+    Constructor to instantiate a RenderCache object. The directory defaults to the render/ directory of get_cache_directory, 
+    a max_disk_size of 0 keeps the images in memory only.
+    """
+    def __init__(self, max_size = 64, directory = None, max_disk_size = 64 * 1024 ** 2):
+        self.memory = LRUCache(max_size)
+        self.directory = os.path.join(get_cache_directory(directory), 'render')
+        self.max_disk_size = max_disk_size
+        self.lock = threading.Lock()
+
+    """
+    Method to get the key of a rendered image.
+    """
+    def get_key(self, source, format, size):
+        return hashlib.sha1(json.dumps([RenderCache.VERSION, source, format, list(size)]).encode()).hexdigest()
+
+    """
+    Method to get the path of the cached image of a key.
+    """
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    """
+    Method to get a cached image, or None if it has not been rendered before.
+    """
+    def get(self, key):
+        image = self.memory.get(key)
+        if image is not None or not self.max_disk_size:
+            return image
+
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                image = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        self.memory.put(key, image)
+        return image
+
+    """
+    Method to cache an image. The file is written atomically, through a temporary file unique to the process and thread, 
+    then the least recently used files are evicted if the directory is full.
+    """
+    def put(self, key, image):
+        self.memory.put(key, image)
+        if not self.max_disk_size:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.get_path(key)
+            temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(temporary_path, 'wb') as file:
+                    file.write(image)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+            self.evict()
+        except OSError:
+            # The cache is only an optimization, failing to write it must not fail the rendering.
+            pass
+
+    """
+    Method to remove the least recently used files until the directory fits in max_disk_size. 
+    The temporary files being written are skipped, the ones left behind by a crashed process are removed.
+    """
+    def evict(self):
+        with self.lock:
+            files = []
+            stale_time = time.time() - RenderCache.STALE_TEMPORARY_AGE
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if not entry.name.endswith('.tmp'):
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                    elif stat.st_mtime < stale_time:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+
+            disk_size = sum(file_size for _, file_size, _ in files)
+            for _, file_size, path in sorted(files):
+                if disk_size <= self.max_disk_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                disk_size -= file_size
+
+    """
+    Method to remove all cached images, in memory and on disk.
+    """
+    def clear(self):
+        self.memory.clear()
+        with self.lock:
+            try:
+                with os.scandir(self.directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            os.remove(entry.path)
+            except OSError:
+                pass
+
+"""
+Pattern of the tokens of a JSON document: punctuation, strings, numbers and literals.
+"""
+JSON_TOKEN = re.compile(r"""
+    \s*(?:
+    (?P<punctuation>[\[\]{},:])
+    | (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<number>-?\d+(?P<fraction>\.\d+)?(?P<exponent>[eE][+-]?\d+)?)
+    | (?P<literal>true|false|null)
+    )
+""", re.VERBOSE)
+
+"""
+Values of the JSON literals.
+"""
+JSON_LITERALS = {'true': True, 'false': False, 'null': None}
+
+"""
+Function to decode the JSON output of EXPLAIN. 
+The json module decodes nested arrays and objects recursively, so it fails on plans nested deeper than the recursion limit: 
+those plans are decoded by an explicit stack instead.
+"""
+def loads_query_plan(text: str):
+    try:
+        return json.loads(text)
+    except RecursionError:
+        pass
+
+    # Each container on the stack is [value, pending key]
+    stack = []
+    result = None
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = JSON_TOKEN.match(text, position)
+        if not match:
+            raise ValueError(f'Invalid JSON at position {position}')
+        position = match.end()
+        punctuation = match.group('punctuation')
+        if punctuation in ('[', '{'):
+            stack.append([[] if punctuation == '[' else {}, None])
+            continue
+        if punctuation in (',', ':'):
+            continue
+        if punctuation in (']', '}'):
+            value = stack.pop()[0]
+        elif match.group('string'):
+            value = json.loads(match.group('string'))
+            if stack and isinstance(stack[-1][0], dict) and stack[-1][1] is None:
+                stack[-1][1] = value
+                continue
+        elif match.group('number'):
+            number = match.group('number')
+            value = float(number) if match.group('fraction') or match.group('exponent') else int(number)
+        else:
+            value = JSON_LITERALS[match.group('literal')]
+
+        if not stack:
+            result = value
+        elif isinstance(stack[-1][0], dict):
+            stack[-1][0][stack[-1][1]] = value
+            stack[-1][1] = None
+        else:
+            stack[-1][0].append(value)
+    return result
+
+"""
+Class PoolClosed is the exception raised when a connection is borrowed from a closed ConnectionPool.
+"""
+class PoolClosed(Exception):
+    pass
+
+"""
+Class ConnectionPool is a bounded, thread-safe pool of database connections. 
+Connections are validated when they are borrowed after being idle for a while, broken connections are discarded on release, 
+and a background health check closes idle connections that the server has dropped.
+"""
+class ConnectionPool:
+    """
+    Constructor to instantiate a ConnectionPool object. The connect callable opens a new connection.
+    """
+    def __init__(self, connect, max_size = 4, validation_interval = 5.0, health_check_interval = 60.0, timeout = 30.0):
+        self.connect = connect
+        self.max_size = max_size
+        self.validation_interval = validation_interval
+        self.timeout = timeout
+        self.idle_connections = []
+        self.generations = {}
+        self.size = 0
+        self.generation = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        if health_check_interval:
+            threading.Thread(target=self.run_health_checks, args=(health_check_interval,), daemon=True).start()
+
+    """
+    Method to borrow a connection. Blocks while all max_size connections are in use, raises PoolClosed once the pool is closed.
+    """
+    def acquire(self):
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.closed or self.idle_connections or self.size < self.max_size, self.timeout):
+                    raise TimeoutError(f"No database connection available after {self.timeout} seconds")
+                if self.closed:
+                    raise PoolClosed()
+                if self.idle_connections:
+                    connection, last_used = self.idle_connections.pop()
+                else:
+                    connection, last_used = None, None
+                    self.size += 1
+                generation = self.generation
+
+            if connection is None:
+                try:
+                    connection = self.connect()
+                except:
+                    self.discard(None)
+                    raise
+                self.generations[connection] = generation
+                return connection
+
+            if time.monotonic() - last_used < self.validation_interval or self.is_healthy(connection):
+                return connection
+            self.discard(connection)
+
+    """
+    Method to return a borrowed connection. The open transaction is rolled back; broken connections and connections opened before the last reset are closed.
+    """
+    def release(self, connection):
+        if not connection.closed:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+
+        with self.condition:
+            if connection.closed or self.closed or self.generations.get(connection) != self.generation:
+                stale = True
+            else:
+                stale = False
+                self.idle_connections.append((connection, time.monotonic()))
+                self.condition.notify()
+        if stale:
+            self.discard(connection)
+
+    """
+    Method to close a connection and free its slot in the pool.
+    """
+    def discard(self, connection):
+        if connection is not None:
+            self.generations.pop(connection, None)
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    """
+    Method to borrow a connection for the duration of a with block.
+    """
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    """
+    Method to check that a connection still works with a trivial query.
+    """
+    def is_healthy(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    """
+    Method to run the periodic health check of the idle connections until the pool is closed.
+    """
+    def run_health_checks(self, interval):
+        while not self.stopped.wait(interval):
+            with self.condition:
+                idle_connections, self.idle_connections = self.idle_connections, []
+            for connection, last_used in idle_connections:
+                if self.is_healthy(connection):
+                    with self.condition:
+                        self.idle_connections.append((connection, last_used))
+                        self.condition.notify()
+                else:
+                    self.discard(connection)
+
+    """
+    Method to reset the pool: idle connections are closed now, connections in use are closed when they are released.
+    """
+    def reset(self):
+        with self.condition:
+            self.generation += 1
+            idle_connections, self.idle_connections = self.idle_connections, []
+        for connection, _ in idle_connections:
+            self.discard(connection)
+
+    """
+    Method to close the pool and all of its idle connections.
+    """
+    def close(self):
+        self.stopped.set()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.reset()
+
+"""
+Class Snapshot is an offline stand-in for DB: the planner settings and the catalog of a database, serialized to a JSON file, 
+which is all that Graph and Node read from the database. A snapshot captured once (see DB.capture_snapshot) explains saved plans 
+anywhere, without a connection.
+"""
+class Snapshot:
+    """
+    Version of the file format, bumped whenever Catalog.COLUMNS or the settings change.
+    """
+    VERSION = 1
+
+    """
+    Constructor to instantiate a Snapshot object.
+    """
+    def __init__(self, settings: Settings, statistics: Catalog, server_version = None, captured_at = None):
+        self.settings = settings
+        self.statistics = statistics
+        self.server_version = server_version
+        self.captured_at = captured_at
+
+    """
+    Method to get a relation of the snapshot. Raises a LookupError if the plan reads a relation that was not captured.
+    """
+    def get_relation(self, table_name, schema = None):
+        relation = self.statistics.get(table_name, schema)
+        if relation is None:
+            raise LookupError(f"Relation {schema + '.' if schema else ''}{table_name} is not in the snapshot")
+        return relation
+
+    """
+    Method to get the relations of a plan by (schema, name), as DB.get_relations does, from the catalog of the snapshot. 
+    The relations that were not captured are left out.
+    """
+    def get_relations(self, names):
+        relations = {}
+        for schema, relation_name in names:
+            relation = self.statistics.get(relation_name, schema)
+            if relation is not None:
+                relations[(schema, relation_name)] = relation
+        return relations
+
+    """
+    Method to get the snapshot as a JSON serializable dict.
+    """
+    def to_dict(self):
+        return {
+            'version': Snapshot.VERSION,
+            'server_version': self.server_version,
+            'captured_at': self.captured_at,
+            'settings': self.settings.to_dict(),
+            'relations': self.statistics.to_rows(),
+        }
+
+    """
+    Method to build a snapshot from a dict returned by to_dict.
+    """
+    @classmethod
+    def from_dict(cls, content):
+        if content.get('version', Snapshot.VERSION) != Snapshot.VERSION:
+            raise ValueError(f"Unsupported snapshot version {content.get('version')}")
+        return cls(Settings.from_dict(content['settings']), Catalog(content['relations']), content.get('server_version'), content.get('captured_at'))
+
+    """
+    Method to save the snapshot to a JSON file.
+    """
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file)
+
+    """
+    Method to load a snapshot from a JSON file.
+    """
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls.from_dict(json.load(file))
 
 """
 Class DB is the interface class to interact with the database. 
 """
 class DB: 
+    """
+    Default number of connections of the pool, enough for catalog lookups, an EXPLAIN run and a cancel request at the same time.
+    """
+    POOL_SIZE = 4
+
+    """
+    The catalog lookups that are prepared on the server, once per connection (see execute_prepared), by statement name: 
+    their parameter types and their query. Relations are resolved to their OID with to_regclass from a schema (NULL to follow the search_path) 
+    and a name, which are quoted by quote_ident so that mixed-case and special names need no quoting by the caller.
+    """
+    PREPARED_STATEMENTS = {
+        'qupex_relations': ('text[], text[]', """
+            SELECT r.schema, r.relname, c.oid, n.nspname, c.relname, c.relkind, c.relpages, c.reltuples, c.relhasindex, c.reltoastrelid, 
+                COALESCE(i.indrelid, owner.oid) AS parent_oid, am.amname, i.indisunique, i.indnkeyatts
+            FROM unnest($1, $2) AS r(schema, relname)
+            JOIN pg_class c ON c.oid = to_regclass(concat_ws('.', quote_ident(r.schema), quote_ident(r.relname)))
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_index i ON i.indexrelid = c.oid
+            LEFT JOIN pg_class owner ON owner.reltoastrelid = c.oid
+            LEFT JOIN pg_am am ON am.oid = c.relam
+            """),
+    }
+
     """
     Constructor to iniate connection with the database.
     """
@@ -18,24 +966,20 @@ class DB:
         self.database = config['database']
         self.user = config['user']
         self.password = config['password']
-        self.connection = psycopg2.connect(host=self.host, port=self.port, database=self.database, user=self.user, password=self.password)
-        self.cursor = self.connection.cursor()
-        self.block_size = self.get_block_size()
-        self.seq_page_cost = self.get_seq_page_cost()
-        self.cpu_tuple_cost = self.get_cpu_tuple_cost() 
-        self.cpu_index_tuple_cost = self.get_cpu_index_tuple_cost()
-        self.random_page_cost = self.get_random_page_cost()
-        self.cpu_operator_cost = self.get_cpu_operator_cost()
-        self.parallel_setup_cost = self.get_parallel_setup_cost()
-        self.parallel_tuple_cost = self.get_parallel_tuple_cost()
-        self.statistics = self.get_statistics()
-        self.work_mem = self.get_work_mem()
+        self.pool = ConnectionPool(self.connect, max_size=config.get('pool_size', DB.POOL_SIZE))
+        self.catalog_cache = CatalogCache(config.get('cache_dir'))
+        self.plan_cache = PlanCache(config.get('plan_cache_size', 32), config.get('plan_cache_ttl'))
+        self.render_cache = RenderCache(config.get('render_cache_size', 64), config.get('cache_dir'), config.get('render_cache_disk_size', 64 * 1024 ** 2))
+        # The names of the statements prepared on each pooled connection, forgotten with the connection
+        self.prepared_statements = weakref.WeakKeyDictionary()
+        self.settings = self.get_settings()
 
         """ 
         Execute Analyze command if for all tables, the analyze or autoanalyze have never been done for each table. 
         This can be done safely because the data is static for this project (There is no Upsert operation). 
+        It is run before the statistics are loaded so that the catalog snapshot reflects the analyzed tables.
         """
-        self.cursor.execute("""
+        self.execute_command("""
             DO $$
             BEGIN
                 IF NOT EXISTS (
@@ -51,211 +995,372 @@ class DB:
             END $$;
         """) 
 
+        self.statistics = self.get_statistics()
+
     """
     Method to close the connection to the database.
     """
     def close_connection(self):
-        self.cursor.close()
-        self.connection.close()
+        self.pool.close()
         
     """
-    Method to reset the connection to the database.
+    Method to reset the connection to the database. The pooled connections are replaced by new ones, which also checks that the server is reachable.
     """
     def reset_connection(self):
-        self.connection = psycopg2.connect(host=self.host, port=self.port, database=self.database, user=self.user, password=self.password)
-        self.cursor = self.connection.cursor()
+        self.pool.reset()
+        self.execute("SELECT 1;")
+
+    """
+    Method to open a new connection to the database, used by the connection pool.
+    """
+    def connect(self):
+        return psycopg2.connect(host=self.host, port=self.port, database=self.database, user=self.user, password=self.password)
+
+    """
+    Method to run an operation on a connection borrowed from the pool. 
+    If the connection turns out to be broken (e.g. the server closed it), the operation is transparently retried once on a new connection.
+    """
+    def run(self, operation):
+        for attempt in range(2):
+            with self.pool.connection() as connection:
+                try:
+                    return operation(connection)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    if attempt or not connection.closed:
+                        raise
         
     """
-    Method to get the query plan of a given query.
+    Method to get the query plan of a given query. The mode decides whether the query is executed (see ExplainMode). 
+    The statement_timeout (in milliseconds) aborts the query on the server when it runs longer than that.
+    The on_backend_pid callback receives the process ID of the backend running the EXPLAIN, e.g. to cancel it, then None once the EXPLAIN has returned.
+    """
+    def get_query_plan(self, query: str, mode: ExplainMode = ExplainMode.ANALYZE_BUFFERS, statement_timeout = None, on_backend_pid = None): 
+        def explain(connection):
+            if on_backend_pid:
+                on_backend_pid(connection.get_backend_pid())
+            with connection.cursor() as cursor:
+                # The plan is decoded by loads_query_plan, which also handles very deep plans
+                psycopg2.extras.register_default_json(cursor, loads=loads_query_plan)
+                if statement_timeout:
+                    # SET LOCAL only lasts until the connection is rolled back when it is released
+                    cursor.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+                try:
+                    cursor.execute(f"EXPLAIN ({mode.get_options()}) " + query)
+                    return cursor.fetchall()[0][0][0]['Plan']
+                finally:
+                    # The backend is forgotten before the connection goes back to the pool, where another query may run on it
+                    if on_backend_pid:
+                        on_backend_pid(None)
+
+        return self.run(explain)
+
+    """
+    Method to get the planner settings of the database as an immutable Settings snapshot in a single round trip.
+    """
+    def get_settings(self):
+        query_results = self.execute("""
+            SELECT name, setting, unit, vartype
+            FROM pg_settings
+            WHERE name = ANY(%s) OR name LIKE 'enable\\_%%';
+            """, (list(Settings.NAMES),))
+        return Settings.from_rows(query_results[0])
+
+    """
+    Method to execute a query.
     """
-    def get_query_plan(self, query: str): 
-        query_plan = self.execute("EXPLAIN (FORMAT JSON, VERBOSE TRUE, BUFFERS TRUE, ANALYZE TRUE) " + query)[0][0][0][0]['Plan']
-        return query_plan
+    def execute(self, query: str, params = None):
+        def execute(connection):
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                column_names = [description[0] for description in cursor.description]
+                query_results = cursor.fetchall()
+            return query_results, column_names
 
-    """ 
-    Method to get the cpu_tuple_cost
+        return self.run(execute)
+
+    """
+    Method to execute one of the PREPARED_STATEMENTS with the given parameters. The statement is prepared the first time it is executed 
+    on a connection, later executions on that connection skip its parsing and planning on the server.
     """
-    def get_cpu_tuple_cost(self):
-        return float(self.execute("""
-                show cpu_tuple_cost;
-            """)[0][0][0])
+    def execute_prepared(self, name, params = ()):
+        def execute_prepared(connection):
+            prepared_statements = self.prepared_statements.setdefault(connection, set())
+            with connection.cursor() as cursor:
+                if name not in prepared_statements:
+                    # PREPARE is not transactional, the statement outlives the rollback of the connection when it is released
+                    parameter_types, query = DB.PREPARED_STATEMENTS[name]
+                    cursor.execute(f"PREPARE {name} ({parameter_types}) AS {query}")
+                    prepared_statements.add(name)
+                cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+                column_names = [description[0] for description in cursor.description]
+                query_results = cursor.fetchall()
+            return query_results, column_names
+
+        return self.run(execute_prepared)
 
     """
-    Method to get the block size of the database.
+    Method to execute a command that returns no rows (e.g. ANALYZE) and commit it.
     """
-    def get_block_size(self): 
-        return int(self.execute("""
-                select current_setting('block_size');
-            """)[0][0][0])
-    
+    def execute_command(self, query: str, params = None):
+        def execute_command(connection):
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+            connection.commit()
+
+        self.run(execute_command)
+
     """
-    Method to get the seq_page_cost of the database.
+    Method to cancel the query running on a given backend with pg_cancel_backend. 
+    The cancel request is sent on another pooled connection, because the connection running the query is busy.
     """
-    def get_seq_page_cost(self):
-        return float(self.execute("""
-                show seq_page_cost;
-            """)[0][0][0])
-    
+    def cancel_backend(self, pid):
+        self.execute("SELECT pg_cancel_backend(%s);", (pid,))
+
     """
-    Method to get the random_page_cost of the database.
+    Method to check the validity of a query. The query is only parsed and planned with a plain EXPLAIN, it is never executed.
     """
-    def get_random_page_cost(self):
-        return float(self.execute("""
-                show random_page_cost;
-            """)[0][0][0])
-    
+    def is_query_valid(self, query: str):    
+        try:
+            self.execute("EXPLAIN " + query)
+        except Exception as exception:
+            return False, exception
+        
+        return True, None
+
     """
-    Method to get the cpu_operator_cost of the database.
+    Method to get the columns of all user relations (tables, views, materialized views and foreign tables of every schema) in a single query, 
+    with their types and statistics targets (-1 for the default_statistics_target). 
+    Returns a dictionary of (schema, relation name) to the list of (column name, type, statistics target), in column order.
     """
-    def get_cpu_operator_cost(self): 
-        return float(self.execute("""
-                show cpu_operator_cost;
-            """)[0][0][0])
-    
+    def get_schema_columns(self):
+        query_results = self.execute("""
+            SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod), COALESCE(a.attstattarget, -1)
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid
+            WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f')
+                AND a.attnum > 0 
+                AND NOT a.attisdropped
+                AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname !~ '^pg_(toast|temp_)'
+            ORDER BY n.nspname, c.relname, a.attnum;
+            """)
+
+        schema_columns = {}
+        for schema, relation_name, column_name, column_type, statistics_target in query_results[0]:
+            schema_columns.setdefault((schema, relation_name), []).append((column_name, column_type, statistics_target))
+        return schema_columns
+
+    """
+    Method to get the relations of a plan by (schema, name) in a single query: their pg_class row (as in the Catalog), 
+    the access method from pg_am, and for indexes whether they are unique and their number of key columns from pg_index. 
+    Names without a schema are resolved with the search_path, as in the plan. Relations that do not exist are left out.
+    """
+    def get_relations(self, names):
+        names = list(names)
+        if not names:
+            return {}
+        query_results = self.execute_prepared('qupex_relations', ([schema for schema, _ in names], [relation_name for _, relation_name in names]))
+
+        relations = {}
+        for row in query_results[0]:
+            relations[(row[0], row[1])] = dict(zip(Catalog.COLUMNS + ('amname', 'indisunique', 'indnkeyatts'), row[2:]))
+        return relations
+
+    """
+    Method to get the overall statistics of a database. 
+    The snapshot is restored from the on-disk catalog cache when possible, and only the relations whose pg_stat_all_tables stamps changed are reloaded.
     """
-    Method to get the parallel_setup_cost of the database.
+    def get_statistics(self): 
+        cache_key = self.get_cache_key()
+        stamps = self.get_statistics_stamps()
+        cached = self.catalog_cache.load(cache_key)
+        self.statistics_stamps = stamps
+
+        if cached is None:
+            catalog = Catalog(self.get_relation_statistics())
+        else:
+            catalog, cached_stamps = cached
+            if not self.reload_changed_relations(catalog, cached_stamps, stamps):
+                return catalog
+
+        self.catalog_cache.save(cache_key, catalog, stamps)
+        return catalog
+
     """
-    def get_parallel_setup_cost(self): 
-        return float(self.execute("""
-                show parallel_setup_cost;
-            """)[0][0][0])
-    
+    Method to refresh the statistics: only the tables whose pg_stat_all_tables stamps changed since they were loaded are reloaded, 
+    the cached plans that read them are invalidated and the observers of the catalog are notified. Returns the OIDs of the tables that changed.
+    """
+    def refresh_statistics(self):
+        stamps = self.get_statistics_stamps()
+        changed_oids = self.reload_changed_relations(self.statistics, self.statistics_stamps, stamps)
+        self.statistics_stamps = stamps
+        if changed_oids:
+            self.plan_cache.invalidate_relations(changed_oids)
+            self.catalog_cache.save(self.get_cache_key(), self.statistics, stamps)
+            self.statistics.notify(changed_oids)
+        return changed_oids
+
     """
-    Method to get the parallel_tuple_cost of the database.
+    Method to capture a Snapshot of the settings and the catalog, to explain plans of this database offline.
     """
-    def get_parallel_tuple_cost(self): 
-        return float(self.execute("""
-                show parallel_tuple_cost;
-            """)[0][0][0])
-    
+    def capture_snapshot(self):
+        server_version = self.execute("SHOW server_version;")[0][0][0]
+        return Snapshot(self.settings, Catalog(self.statistics.to_rows()), server_version, time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+
     """
-    Method to get the cpu_index_tuple_cost of the database.
+    Method to reload the relations whose stamps differ between old_stamps and new_stamps into the catalog. 
+    Dropped tables are removed. Returns the OIDs of the tables that changed.
     """
-    def get_cpu_index_tuple_cost(self): 
-        return float(self.execute("""
-                show cpu_index_tuple_cost
-            """)[0][0][0])
+    def reload_changed_relations(self, catalog: Catalog, old_stamps, new_stamps):
+        changed_oids = [oid for oid, stamp in new_stamps.items() if old_stamps.get(oid) != stamp]
+        dropped_oids = [oid for oid in old_stamps if oid not in new_stamps]
+
+        for oid in changed_oids + dropped_oids:
+            catalog.remove_table(oid)
+        if changed_oids:
+            for row in self.get_relation_statistics(changed_oids):
+                catalog.add(dict(zip(Catalog.COLUMNS, row)))
+
+        return changed_oids + dropped_oids
 
     """
-    Method to get the table statistics of a given table. Column names can be specified to get the statistics of only specific columns.
+    Method to get the key of the catalog cache: the server system identifier, the database and the user.
     """
-    def get_table_statistics(self, table_name, column_names = None): 
+    def get_cache_key(self):
+        try:
+            system_identifier = str(self.execute("SELECT system_identifier FROM pg_control_system();")[0][0][0])
+        except psycopg2.Error:
+            # pg_control_system() may not be available, fall back to the server address.
+            system_identifier = f'{self.host}:{self.port}'
+        return system_identifier, self.database, self.user
+
+    """
+    Method to get the statistics stamps of all tables from pg_stat_all_tables, which change whenever a table is analyzed, vacuumed or modified. 
+    Tables without statistics (e.g. partitioned tables) are included with an empty stamp so that new tables are still detected.
+    Returns a dictionary of table OID to stamp.
+    """
+    def get_statistics_stamps(self):
         query_results = self.execute("""
-            SELECT {column_names} FROM pg_class WHERE relname = '{table_name}';
-            """.format(table_name=table_name, column_names="*" if not column_names else ','.join(column_names)))
+            SELECT c.oid, s.last_analyze::text, s.last_autoanalyze::text, s.n_mod_since_analyze, s.last_vacuum::text, s.last_autovacuum::text
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+            WHERE c.relkind IN ('r', 'p', 'm')
+                AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname !~ '^pg_(toast|temp_)';
+            """)
+        return {row[0]: tuple(row[1:]) for row in query_results[0]}
 
-        table_statistics = {} 
-        for column_value, column_name in zip(query_results[0][0], query_results[1]):
-            table_statistics[column_name] = column_value
-        
-        return table_statistics
-    
     """
-    Method to get the number of pages of a given table.
+    Method to get the pg_class rows of all user tables (or only of the given table OIDs), their indexes and their TOAST relations in a single query.
     """
-    def get_table_page_count(self, table_name): 
-        return self.statistics[table_name]['relpages']
+    def get_relation_statistics(self, table_oids = None):
+        query_results = self.execute("""
+            WITH tables AS (
+                SELECT c.oid
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.relkind IN ('r', 'p', 'm')
+                    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND n.nspname !~ '^pg_(toast|temp_)'
+                    AND (%(table_oids)s::oid[] IS NULL OR c.oid = ANY(%(table_oids)s::oid[]))
+            )
+            SELECT c.oid, n.nspname, c.relname, c.relkind, c.relpages, c.reltuples, c.relhasindex, c.reltoastrelid, 
+                COALESCE(i.indrelid, owner.oid) AS parent_oid
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_index i ON i.indexrelid = c.oid
+            LEFT JOIN pg_class owner ON owner.reltoastrelid = c.oid
+            WHERE c.oid IN (SELECT oid FROM tables)
+                OR i.indrelid IN (SELECT oid FROM tables)
+                OR owner.oid IN (SELECT oid FROM tables);
+            """, {'table_oids': table_oids})
+        return query_results[0]
     
+
+"""
+Class Node is the class to represent a node in the physical query plan.
+The cost of a node is computed when the node is created (see compute_cost), while the text of its cost description is only rendered, 
+and then memoized, the first time cost_description is read.
+"""
+class Node: 
     """
-    Method to get the number of tuples of a given table.
+    Cost model of each supported node type: the suffix of its compute_cost_* and get_cost_description_* methods. 
+    Seq Scan is resolved in get_cost_model as it depends on the filter.
     """
-    def get_table_row_count(self, table_name): 
-        return self.statistics[table_name]['reltuples']
+    COST_MODELS = {
+        'Sort': 'sort',
+        'Merge Join': 'merge_join',
+        'Hash': 'hash',
+        'Aggregate': 'aggregate',
+        'Hash Join': 'hash_join',
+        'Gather': 'gather',
+        'Gather Merge': 'gather_merge',
+        'Index Scan': 'index_scan',
+        'Materialize': 'materialize',
+        'Nested Loop': 'nested_loop',
+    }
 
     """
-    Method to execute a query.
+    The enable_* flag of the planner method of each cost model. PostgreSQL (up to version 16) adds DISABLE_COST to the startup cost of a disabled method, 
+    which it still uses when there is no other way to run the query.
     """
-    def execute(self, query: str):
-        self.cursor.execute(query)
-        column_names = [description[0] for description in self.cursor.description]
-        query_results = self.cursor.fetchall()
-        return query_results, column_names
+    DISABLE_FLAGS = {
+        'sequential_scan': 'enable_seqscan',
+        'sequential_scan_with_filter': 'enable_seqscan',
+        'index_scan': 'enable_indexscan',
+        'sort': 'enable_sort',
+        'merge_join': 'enable_mergejoin',
+        'hash_join': 'enable_hashjoin',
+        'nested_loop': 'enable_nestloop',
+        'gather_merge': 'enable_gathermerge',
+    }
 
     """
-    Method to check the validity of a query.
+    Cost added by PostgreSQL to a disabled planner method (disable_cost in costsize.c).
     """
-    def is_query_valid(self, query: str):    
-        try:
-            self.cursor.execute(query)
-            self.cursor.fetchone()
-        except Exception as exception:
-            return False, exception
-        
-        return True, None
+    DISABLE_COST = 1.0e10
 
     """
-    Method to get the table names of the database.
+    Size in bytes added to the aligned width of each tuple of a hash table: the headers of the hash join tuple and of the minimal tuple, aligned on 8 bytes.
     """
-    def get_table_names(self): 
-        query_results = self.execute(
-            """
-            SELECT 
-                t.table_name 
-            FROM 
-                information_schema.tables t
-            WHERE 
-                t.table_schema = 'public' 
-                AND t.table_type = 'BASE TABLE' 
-            """
-        )
-        table_names = [] 
-        for table_name, in query_results[0]: 
-            table_names.append(table_name)
-        return table_names
+    HASH_TUPLE_OVERHEAD = 32
 
     """
-    Method to get the column names of a given table.
+    Values of max_parallel_workers_per_gather for which the cost and the rows per worker of a parallel scan are predicted (see predict_parallel_scan).
     """
-    def get_column_names(self, table_name: str): 
-        query_results = self.execute(
-            """
-            SELECT t.column_name 
-            FROM information_schema.columns t 
-            WHERE t.table_name = '{table_name}'
-            """.format(table_name=table_name)
-        )
-        
-        column_names = [] 
-        for column_name, in query_results[0]: 
-            column_names.append(column_name)
+    PARALLEL_WORKER_PREDICTIONS = (0, 1, 2, 4, 8)
 
-        return column_names
+    """
+    Static variable that contains the size in bytes of the header of a tuple, aligned (MAXALIGN(SizeofHeapTupleHeader) in PostgreSQL).
+    """
+    TUPLE_HEADER_SIZE = 24
 
     """
-    Method to get the overall statistics of a database.
+    Static variables that contain the bounds of the merge order of an external sort (MINORDER and MAXORDER in tuplesort.c).
     """
-    def get_statistics(self): 
-        statistics = {} 
-        for table_name in self.get_table_names(): 
-            statistics[table_name] = self.get_table_statistics(table_name)
-        
-        return statistics 
-    
+    MIN_MERGE_ORDER = 6
+    MAX_MERGE_ORDER = 500
+
     """
-    Method to get the work_mem of the database.
+    Attributes of a node. The raw query plan is not kept: only the fields used by the cost models are extracted from it.
     """
-    def get_work_mem(self):
-        return int(self.execute("""
-            SELECT setting::bigint * CASE unit
-                WHEN 'kB' THEN 1024
-                WHEN 'MB' THEN 1024^2
-                ELSE 1
-                END AS work_mem_bytes
-            FROM pg_settings
-            WHERE name = 'work_mem';
-        """)[0][0][0])
+    __slots__ = ('id', 'db', 'settings', 'node_type', 'startup_cost', 'acutal_row_count', 'total_cost', 'row_count', 'row_width', 
+                 'output', 'filter', 'relation_name', 'schema', 'index_name', 'relation', 'index', 'workers', 'parallel_aware', 'gather_workers', 
+                 'limit_tuples', 'sort_spaces', 'hash_usage', 'strategy', 'hash_condition', 'children', 'epsilon', 'cost_terms', 'estimated_cost', 'valid', '_cost_description')
 
-"""
-Class Node is the class to represent a node in the physical query plan.
-"""
-class Node: 
     """
-    Constructor to instantiate a Node object.
+    Constructor to instantiate a Node object. The node_id is the position of the node in the pre-order of the plan (see Graph). 
+    The db is the source of the settings and the catalog: a DB, or a Snapshot to explain a saved plan offline.
+    The relations are the relations of the plan by (schema, name) (see Graph.parse_query_plan), the relations of the node are fetched when they are not given.
+    The gather_workers are the workers planned by the closest Gather or Gather Merge above the node, which run its parallel aware scans.
+    The limit_tuples are the rows of the Limit above a sort, which only has to keep the first limit_tuples rows (a bounded sort).
     """
-    def __init__(self, query_plan, db: DB, children, epsilon): 
-        self.query_plan = query_plan
+    def __init__(self, query_plan, db: DB, children, epsilon, node_id = 0, relations = None, gather_workers = None, limit_tuples = None): 
+        self.id = node_id
         self.db = db 
-        self.uuid = str(random.random())
+        self.settings = db.settings
         self.node_type = query_plan['Node Type']
         self.startup_cost = query_plan['Startup Cost']
         self.acutal_row_count = query_plan['Actual Rows'] if 'Actual Rows' in query_plan else ""
@@ -265,76 +1370,315 @@ class Node:
         self.output = query_plan['Output'] if 'Output' in query_plan else ""
         self.filter = query_plan['Filter'] if 'Filter' in query_plan else ""
         self.relation_name = query_plan['Relation Name'] if 'Relation Name' in query_plan else ""
+        self.schema = query_plan['Schema'] if 'Schema' in query_plan else None
+        self.index_name = query_plan['Index Name'] if 'Index Name' in query_plan else ""
+        if relations is None:
+            relations = db.get_relations(Node.get_relation_names(query_plan))
+        self.relation = relations.get((self.schema, self.relation_name)) if self.relation_name else None
+        self.index = relations.get((self.schema, self.index_name)) if self.index_name else None
         self.workers = query_plan['Workers Planned'] if 'Workers Planned' in query_plan else ""
+        self.parallel_aware = query_plan['Parallel Aware'] if 'Parallel Aware' in query_plan else False
+        self.gather_workers = gather_workers
+        self.limit_tuples = limit_tuples
+        self.sort_spaces = Node.get_sort_spaces(query_plan)
+        self.hash_usage = Node.get_hash_usage(query_plan)
         self.strategy = query_plan['Strategy'] if 'Strategy' in query_plan else ""
         self.hash_condition = query_plan['Hash Cond'] if 'Hash Cond' in query_plan else ""
         self.children = children
         self.epsilon = epsilon
-        self.valid = False
-        self.cost_description = self.get_cost_description() 
+        self.cost_terms = self.compute_cost()
+        self.estimated_cost = self.cost_terms['total_cost'] if self.cost_terms else None
+        self.valid = self.estimated_cost is not None and abs(self.estimated_cost - self.total_cost) <= self.epsilon
+        self._cost_description = None
+
+    """
+    Method to get the (schema, name) of the relation and of the index read by a node of a query plan.
+    """
+    @staticmethod
+    def get_relation_names(query_plan):
+        schema = query_plan['Schema'] if 'Schema' in query_plan else None
+        return [(schema, query_plan[key]) for key in ('Relation Name', 'Index Name') if key in query_plan]
+
+    """
+    Method to get the sort methods reported by EXPLAIN ANALYZE for a sort, by the leader and by each worker: 
+    a list of (Sort Method, Sort Space Used in kB, Sort Space Type), empty when the plan was not analyzed.
+    """
+    @staticmethod
+    def get_sort_spaces(query_plan):
+        return [(plan['Sort Method'], plan['Sort Space Used'], plan['Sort Space Type']) 
+                for plan in itertools.chain([query_plan], query_plan.get('Workers', ())) if 'Sort Method' in plan]
+
+    """
+    Method to get the hash table reported by EXPLAIN ANALYZE for a hash: (Hash Batches, Peak Memory Usage in kB), None when the plan was not analyzed.
+    """
+    @staticmethod
+    def get_hash_usage(query_plan):
+        return (query_plan['Hash Batches'], query_plan['Peak Memory Usage']) if 'Hash Batches' in query_plan else None
+
+    """
+    Method to get the statistics of the relation read by the node. Raises a LookupError if the relation is unknown (e.g. not in a snapshot).
+    """
+    def get_relation(self):
+        if self.relation is None:
+            raise LookupError(f"Relation {self.schema + '.' if self.schema else ''}{self.relation_name} is unknown")
+        return self.relation
+
+    """
+    Method to get the statistics of the index read by the node. Raises a LookupError if the index is unknown (e.g. not in a snapshot).
+    """
+    def get_index(self):
+        if self.index is None:
+            raise LookupError(f"Index {self.schema + '.' if self.schema else ''}{self.index_name} is unknown")
+        return self.index
+
+    """
+    Method to get the number of workers of a parallel aware scan under the given settings (the settings of the node by default). 
+    Under the settings of the database, these are the workers planned by its Gather, otherwise the workers that PostgreSQL would plan (see get_planned_workers).
+    """
+    def get_parallel_workers(self, settings: Settings = None):
+        settings = settings or self.settings
+        db_settings = self.db.settings
+        if self.gather_workers is not None and settings.max_parallel_workers_per_gather == db_settings.max_parallel_workers_per_gather \
+                and settings.min_parallel_table_scan_size == db_settings.min_parallel_table_scan_size:
+            return self.gather_workers
+        return self.get_planned_workers(settings)
+
+    """
+    Method to get the number of workers that PostgreSQL plans for a parallel scan of the relation of the node (compute_parallel_worker in allpaths.c): 
+    none below min_parallel_table_scan_size, then one more worker every time the table triples in size, up to max_parallel_workers_per_gather.
+    """
+    def get_planned_workers(self, settings: Settings):
+        page_count = self.get_relation()['relpages']
+        threshold = max(settings.min_parallel_table_scan_size // settings.block_size, 1)
+        if page_count < threshold:
+            return 0
+        workers = 1
+        while page_count >= threshold * 3:
+            workers += 1
+            threshold *= 3
+        return min(workers, settings.max_parallel_workers_per_gather)
+
+    """
+    Method to get the parallel divisor of the node under the given settings (get_parallel_divisor in costsize.c): the share of the rows scanned by each process. 
+    The leader also scans, less as the number of workers grows since it has to collect their rows, unless parallel_leader_participation is off. 
+    It is 1 for the nodes that are not parallel aware, or without workers.
+    """
+    def get_parallel_divisor(self, settings: Settings = None):
+        settings = settings or self.settings
+        workers = self.get_parallel_workers(settings) if self.parallel_aware else 0
+        if workers == 0:
+            return 1
+        parallel_divisor = workers
+        leader_contribution = 1.0 - 0.3 * workers
+        if settings.parallel_leader_participation and leader_contribution > 0:
+            parallel_divisor += leader_contribution
+        return parallel_divisor
+
+    """
+    Method to get the estimated number of rows returned by each process running the node. 
+    The Plan Rows of a parallel aware node are already per process under the settings of the database, they are scaled to the divisor of the settings of the node.
+    """
+    def get_rows_per_worker(self):
+        return self.row_count * self.get_parallel_divisor(self.db.settings) / self.get_parallel_divisor()
+
+    """
+    Method to predict the cost and the rows per worker of a parallel aware scan for the given values of max_parallel_workers_per_gather. 
+    Returns a dict per value with the workers, the parallel divisor, the rows per worker and the total cost of the scan.
+    """
+    def predict_parallel_scan(self, max_workers_values = PARALLEL_WORKER_PREDICTIONS):
+        predictions = []
+        for max_workers in max_workers_values:
+            node = self.simulate(self.settings.override({'max_parallel_workers_per_gather': max_workers}), self.children)
+            predictions.append({'max_parallel_workers_per_gather': max_workers, 'workers': node.get_parallel_workers(), 
+                                'parallel_divisor': node.get_parallel_divisor(), 'rows_per_worker': node.get_rows_per_worker(), 'total_cost': node.total_cost})
+        return predictions
+
+    """
+    Method to get the part of the cost description of a parallel aware scan: its parallel divisor, and the predictions of predict_parallel_scan.
+    Returns an empty string for the other nodes.
+    """
+    def get_parallel_description(self):
+        if not self.parallel_aware:
+            return ""
+        workers = self.get_parallel_workers()
+        leader_contribution = f"max(1 - 0.3 * {workers}, 0)" if self.settings.parallel_leader_participation else "0 (parallel_leader_participation is off)"
+        predictions = "\n".join(
+            f"            {prediction['max_parallel_workers_per_gather']:>31} | {prediction['workers']:>7} | {prediction['parallel_divisor']:>7.2f} | "
+            f"{prediction['rows_per_worker']:>15.1f} | {prediction['total_cost']:.3f}"
+            for prediction in self.predict_parallel_scan())
+
+        return f"""
+        Parallel scan with {workers} worker{"" if workers == 1 else "s"}{" and the leader" if self.settings.parallel_leader_participation else ""}:
+        parallel_divisor = workers + leader_contribution
+                         = {workers} + {leader_contribution}
+                         = {self.get_parallel_divisor()}
+        Each process returns {self.get_rows_per_worker()} rows, the rows of the scan divided by the parallel divisor.
+
+        Prediction as max_parallel_workers_per_gather varies (no workers means no parallel scan):
+            max_parallel_workers_per_gather | workers | divisor | rows per worker | total_cost
+{predictions}
+        """
+
+    """
+    Method to get which cost of each child is part of the cost computed by the cost model of the node: 'total_cost', 'startup_cost' or None. 
+    The join models of the lecture only count the blocks of their inputs, Gather Merge only the startup cost of its input, 
+    and the nested loop variants count the cost of none, one or both of their inputs.
+    """
+    def get_child_cost_parts(self):
+        cost_model = self.get_cost_model()
+        if cost_model in ('merge_join', 'hash_join'):
+            return [None] * len(self.children)
+        if cost_model == 'gather_merge':
+            return ['startup_cost'] * len(self.children)
+        if cost_model == 'nested_loop':
+            return {'materialized': ['total_cost', None], 'index': ['total_cost', 'total_cost'], 'block': [None, None]}[self.cost_terms['variant']]
+        return ['total_cost'] * len(self.children)
+
+    """
+    Method to get the own cost of the node, without the cost of its children: 
+    the cost of its model without the part of its children (see get_child_cost_parts), or its cost minus the cost of its children without a model 
+    (at least 0, as a Limit costs less than its input when it stops early).
+    """
+    def get_own_cost(self):
+        if self.cost_terms is None:
+            return max(self.total_cost - sum(child.total_cost for child in self.children), 0)
+        return self.cost_terms['total_cost'] - sum(getattr(child, part) for child, part in zip(self.children, self.get_child_cost_parts()) if part)
+
+    """
+    Method to simulate the node under other settings, on top of its simulated children (see Graph.simulate). 
+    Returns a copy of the node whose cost is computed by its cost model with the given settings and the costs of the given children. 
+    The change of cost of the children that the model does not count (see get_child_cost_parts) is added on top of it, so that it reaches the root. 
+    Nodes without a cost model (or whose model cannot be computed) keep their own cost, on top of the change of cost of their children.
+    """
+    def simulate(self, settings: Settings, children):
+        node = copy.copy(self)
+        node.settings = settings
+        node.children = children
+        node._cost_description = None
+        try:
+            node.cost_terms = node.compute_cost()
+        except (ArithmeticError, LookupError, ValueError):
+            node.cost_terms = None
+
+        if node.cost_terms is None:
+            node.total_cost = self.total_cost + sum(child.total_cost - original.total_cost for child, original in zip(children, self.children))
+        else:
+            uncounted_cost = sum((child.total_cost - original.total_cost) - ((getattr(child, part) - getattr(original, part)) if part else 0) 
+                                 for child, original, part in zip(children, self.children, node.get_child_cost_parts()))
+            node.total_cost = node.cost_terms['total_cost'] + uncounted_cost
+            node.startup_cost = node.cost_terms.get('startup_cost', self.startup_cost)
+        node.estimated_cost = node.total_cost
+        node.valid = None
+        return node
+
+    """
+    The cost description of the node, rendered on first access.
+    """
+    @property
+    def cost_description(self):
+        if self._cost_description is None:
+            self._cost_description = self.get_cost_description()
+        return self._cost_description
 
     """
     Method to get the label for the graph visualization for each node.
     """
     def get_label(self): 
-        return f"""{self.node_type + (" with filter " if self.filter else "")} {"- " + self.relation_name if self.relation_name else ""}\n{"cost: " + str(round(self.total_cost, 3))}"""
+        cost_model = self.get_cost_model()
+        spilled = (self.cost_terms is not None and 
+                   (cost_model == 'sort' and self.get_sort_diagnostics()['spilled'] or cost_model == 'hash' and self.get_hash_diagnostics()['spilled']))
+        return f"""{("Parallel " if self.parallel_aware else "") + self.node_type + (" with filter " if self.filter else "")} {"- " + self.relation_name if self.relation_name else ""}\n{"cost: " + str(round(self.total_cost, 3))}{" (spilled to disk)" if spilled else ""}"""
+
+    """
+    Method to get the cost model of the node (see COST_MODELS), or None if the node type is not supported.
+    """
+    def get_cost_model(self):
+        if self.node_type == 'Seq Scan':
+            return 'sequential_scan_with_filter' if self.filter else 'sequential_scan'
+        return Node.COST_MODELS.get(self.node_type)
+
+    """
+    Method to get the cost model of a node of a query plan, as get_cost_model does for a Node.
+    """
+    @staticmethod
+    def get_plan_cost_model(query_plan):
+        if query_plan['Node Type'] == 'Seq Scan':
+            return 'sequential_scan_with_filter' if query_plan.get('Filter') else 'sequential_scan'
+        return Node.COST_MODELS.get(query_plan['Node Type'])
+
+    """
+    Method to compute the cost of the node. For different node_type, we have different cost function. 
+    Returns the terms of the calculation (including total_cost) used by the cost description, or None if the node type is not supported.
+    """
+    def compute_cost(self):
+        cost_model = self.get_cost_model()
+        if cost_model is None:
+            return None
+        terms = getattr(self, 'compute_cost_' + cost_model)()
+        if not self.is_method_enabled():
+            terms = {**terms, 'disable_cost': Node.DISABLE_COST, 'startup_cost': terms.get('startup_cost', 0) + Node.DISABLE_COST, 
+                     'total_cost': terms['total_cost'] + Node.DISABLE_COST}
+        return terms
+
+    """
+    Method to check whether the planner method of the node is enabled by its enable_* flag (see DISABLE_FLAGS). 
+    Nodes without a flag are always enabled.
+    """
+    def is_method_enabled(self):
+        flag = Node.DISABLE_FLAGS.get(self.get_cost_model())
+        return flag is None or self.settings.is_enabled(flag)
 
     """
     Method to get the cost description for each node. For different node_type, we have different cost description function. 
     This function acts as the general function to call the specific cost description function based on the node_type.
     """
     def get_cost_description(self): 
-        if self.node_type == 'Seq Scan':
-            if self.filter: 
-                return self.get_cost_description_sequential_scan_with_filter() 
-            return self.get_cost_description_sequential_scan() 
-        elif self.node_type == 'Sort':
-            return self.get_cost_description_sort()
-        elif self.node_type == 'Merge Join':
-            return self.get_cost_description_merge_join()
-        elif self.node_type == 'Hash':
-            return self.get_cost_description_hash() 
-        elif self.node_type == 'Aggregate':
-            return self.get_cost_description_aggregate() 
-        elif self.node_type == 'Hash Join':
-            return self.get_cost_description_hash_join() 
-        elif self.node_type == 'Gather':
-            return self.get_cost_description_gather()
-        elif self.node_type == 'Gather Merge':
-            return self.get_cost_description_gather_merge() 
-        elif self.node_type == 'Index Scan': 
-            return self.get_cost_description_index_scan()
-        elif self.node_type == 'Materialize':
-            return self.get_cost_description_materialize()
-        elif self.node_type == 'Nested Loop':
-            return self.get_cost_description_nested_loop()
-        return f'Unfortunately, the operation of type {self.node_type} is beyond the scope of this project.'
+        cost_model = self.get_cost_model()
+        if cost_model is None:
+            return f'Unfortunately, the operation of type {self.node_type} is beyond the scope of this project.'
+        description = getattr(self, 'get_cost_description_' + cost_model)()
+        if self.cost_terms is not None and 'disable_cost' in self.cost_terms:
+            description += f"""
+        {Node.DISABLE_FLAGS[cost_model]} is off: as PostgreSQL does, disable_cost = {Node.DISABLE_COST} is added to the startup_cost and the total_cost above."""
+        return description
     
     """
-    Method to get the cost of sequential scan. 
+    Method to compute the cost of sequential scan. 
     We combine what we learnt from the lecture and the PostgreSQL documentation to calculate the cost of the sequential scan by applyin appropriate weight. 
-    """
-    def get_cost_description_sequential_scan(self): 
-        cpu_tuple_cost = self.db.cpu_tuple_cost
-        row_count = self.row_count
-        seq_page_cost = self.db.seq_page_cost
-        page_count = self.db.get_table_page_count(self.relation_name)
+    A parallel scan divides the tuples of the table, and so the CPU cost, by the parallel divisor, while every page is still read once.
+    """
+    def compute_cost_sequential_scan(self): 
+        cpu_tuple_cost = self.settings.cpu_tuple_cost
+        parallel_divisor = self.get_parallel_divisor()
+        row_count = self.get_relation()['reltuples'] / parallel_divisor if self.parallel_aware else self.row_count
+        seq_page_cost = self.settings.seq_page_cost
+        page_count = self.get_relation()['relpages']
         startup_cost = 0
         run_cost = (cpu_tuple_cost) * row_count + seq_page_cost * page_count
         total_cost = startup_cost + run_cost 
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
+        return {'cpu_tuple_cost': cpu_tuple_cost, 'parallel_divisor': parallel_divisor, 'row_count': row_count, 'seq_page_cost': seq_page_cost, 
+                'page_count': page_count, 'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of sequential scan.
+    """
+    def get_cost_description_sequential_scan(self): 
+        terms = self.cost_terms
+        cpu_tuple_cost, row_count, seq_page_cost, page_count = terms['cpu_tuple_cost'], terms['row_count'], terms['seq_page_cost'], terms['page_count']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
 
         underestimate_reason = """
            The answer is underestimated due to the lack of information to the details needed to calculatae the intricate costs in Postgres.
         """
 
         overestimate_reason = """
-            The answer is overestimated due to Postgres implementing parallel scan, which is not considered in our calculation and not accounted in the lecture formula.
+            The answer is overestimated as the planner scales the number of tuples and pages of the catalog to the current size of the table, which is not accounted in the lecture formula.
         """
 
         description = f"""
         startup_cost = {startup_cost} (the cost to retrieve the first row)
 
+        {f"Ntuple = reltuples / parallel_divisor = {row_count} (only the CPU cost is shared by the processes)" if self.parallel_aware else ""}
         run_cost = cpu_run_cost + disk_run_cost 
                  = (cpu_tuple_cost) * Ntuple + seq_page_cost * Npage
                  = ({cpu_tuple_cost}) * {row_count} + {seq_page_cost} * {page_count}
@@ -348,32 +1692,43 @@ class Node:
                                 
         Is it a valid calculation? {"YES" if self.valid else "NO"} (with epsilon = {self.epsilon})
         {"" if self.valid else underestimate_reason if total_cost <= self.total_cost else overestimate_reason}
-        """
+        {self.get_parallel_description()}"""
 
         return description
     
     
     """
-    Method to get the cost of sequential scan with filter. 
-    Similar to get_cost_description_sequential_scan() method, yet we need to consider the filter condition in the cost calculation by adding the term cpu_operator_cost * number_of_input_tuples.
+    Method to compute the cost of sequential scan with filter. 
+    Similar to compute_cost_sequential_scan() method, yet we need to consider the filter condition in the cost calculation by adding the term cpu_operator_cost * number_of_input_tuples.
     """
-    def get_cost_description_sequential_scan_with_filter(self): 
-        cpu_tuple_cost = self.db.cpu_tuple_cost
-        cpu_operator_cost = self.db.cpu_operator_cost
-        row_count = self.db.get_table_row_count(self.relation_name)
-        seq_page_cost = self.db.seq_page_cost
-        page_count = self.db.get_table_page_count(self.relation_name)
+    def compute_cost_sequential_scan_with_filter(self): 
+        cpu_tuple_cost = self.settings.cpu_tuple_cost
+        cpu_operator_cost = self.settings.cpu_operator_cost
+        parallel_divisor = self.get_parallel_divisor()
+        row_count = self.get_relation()['reltuples'] / parallel_divisor
+        seq_page_cost = self.settings.seq_page_cost
+        page_count = self.get_relation()['relpages']
         startup_cost = 0
         run_cost = (cpu_tuple_cost + cpu_operator_cost) * row_count + seq_page_cost * page_count
         total_cost = startup_cost + run_cost 
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
+        return {'cpu_tuple_cost': cpu_tuple_cost, 'cpu_operator_cost': cpu_operator_cost, 'parallel_divisor': parallel_divisor, 'row_count': row_count, 
+                'seq_page_cost': seq_page_cost, 'page_count': page_count, 'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of sequential scan with filter.
+    """
+    def get_cost_description_sequential_scan_with_filter(self): 
+        terms = self.cost_terms
+        cpu_tuple_cost, cpu_operator_cost, row_count = terms['cpu_tuple_cost'], terms['cpu_operator_cost'], terms['row_count']
+        seq_page_cost, page_count = terms['seq_page_cost'], terms['page_count']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
 
         underestimate_reason = """
             The answer is underestimate due to the lack of information to the details needed to calculatae the intricate costs in Postgres.
         """
 
         overestimate_reason = """
-            The answer is overestimated due to Postgres implementing parallel scan, which is not considered in our calculation and not accounted in the lecture formula.
+            The answer is overestimated as the planner scales the number of tuples and pages of the catalog to the current size of the table, which is not accounted in the lecture formula.
         """
 
 
@@ -381,6 +1736,7 @@ class Node:
         startup_cost = {startup_cost} (the cost to retrieve the first row)
 
 
+        {f"Ntuple = reltuples / parallel_divisor = {row_count} (only the CPU cost is shared by the processes)" if self.parallel_aware else ""}
         run_cost = cpu_run_cost + disk_run_cost 
                  = (cpu_tuple_cost + cpu_operator_cost) * Ntuple + seq_page_cost * Npage
                  = ({cpu_tuple_cost + cpu_operator_cost}) * {row_count} + {seq_page_cost} * {page_count}
@@ -394,32 +1750,134 @@ class Node:
 
         Is it a valid calculation? {"YES" if self.valid else "NO"} (with epsilon = {self.epsilon})
         {"" if self.valid else underestimate_reason if total_cost <= self.total_cost else overestimate_reason}
-        """
+        {self.get_parallel_description()}"""
         return description
 
     """
-    Method to get the cost of sort operation. 
-    For the startup_cost and run_cost, we mimic the implementation of PostgreSQL. 
+    Method to compute the cost of sort operation. 
+    For the startup_cost and run_cost, we mimic the implementation of PostgreSQL (cost_tuplesort in costsize.c), which depends on the size of the sorted tuples: 
+    a bounded sort (below a Limit) only keeps the first limit_tuples rows in a heap, a sort that fits in work_mem is a quicksort in memory, 
+    and a larger sort is an external merge that writes runs of work_mem bytes to disk and merges them in one or more passes.
     """
-    def get_cost_description_sort(self):
-        cpu_operator_cost = self.db.cpu_operator_cost 
+    def compute_cost_sort(self):
+        cpu_operator_cost = self.settings.cpu_operator_cost 
         comparison_cost = 2 * cpu_operator_cost
-        num_input_tuples = self.children[0].row_count # fetch number of tuples returned from the scan operator cost. 
+        num_input_tuples = max(self.children[0].row_count, 2) # fetch number of tuples returned from the scan operator cost. 
         log_sort_tuples = math.log2(num_input_tuples)
+        work_mem = self.settings.work_mem
 
         last_scan_cost = self.children[0].total_cost # fetch cost of the scan operator. 
-        
-        startup_cost = last_scan_cost + comparison_cost * num_input_tuples * log_sort_tuples
+
+        input_bytes = self.get_sort_size(num_input_tuples)
+        if self.limit_tuples and self.limit_tuples < num_input_tuples:
+            output_tuples, output_bytes = self.limit_tuples, self.get_sort_size(self.limit_tuples)
+        else:
+            output_tuples, output_bytes = num_input_tuples, input_bytes
+
+        terms = {}
+        if output_bytes > work_mem:
+            sort_method = 'external merge'
+            page_count = math.ceil(input_bytes / self.settings.block_size)
+            run_count = input_bytes / work_mem
+            merge_order = min(max(work_mem // (34 * self.settings.block_size), Node.MIN_MERGE_ORDER), Node.MAX_MERGE_ORDER)
+            merge_passes = math.ceil(math.log(run_count) / math.log(merge_order)) if run_count > merge_order else 1
+            page_accesses = 2 * page_count * merge_passes
+            page_cost = self.settings.seq_page_cost * 0.75 + self.settings.random_page_cost * 0.25
+            sort_cost = comparison_cost * num_input_tuples * log_sort_tuples + page_accesses * page_cost
+            terms = {'page_count': page_count, 'run_count': run_count, 'merge_order': merge_order, 'merge_passes': merge_passes, 
+                     'page_accesses': page_accesses, 'page_cost': page_cost}
+        elif num_input_tuples > 2 * output_tuples or input_bytes > work_mem:
+            sort_method = 'top-N heapsort'
+            sort_cost = comparison_cost * num_input_tuples * math.log2(2 * output_tuples)
+        else:
+            sort_method = 'quicksort'
+            sort_cost = comparison_cost * num_input_tuples * log_sort_tuples
+
+        startup_cost = last_scan_cost + sort_cost
         run_cost = cpu_operator_cost * num_input_tuples
         total_cost = startup_cost + run_cost
+        return {'cpu_operator_cost': cpu_operator_cost, 'num_input_tuples': num_input_tuples, 'output_tuples': output_tuples, 'input_bytes': input_bytes, 
+                'output_bytes': output_bytes, 'work_mem': work_mem, 'sort_method': sort_method, 'last_scan_cost': last_scan_cost, 'sort_cost': sort_cost, 
+                **terms, 'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the size in bytes of the given number of sorted tuples, as estimated by PostgreSQL (relation_byte_size in costsize.c): 
+    each tuple takes its width and a tuple header, both aligned on 8 bytes.
+    """
+    def get_sort_size(self, tuple_count):
+        return tuple_count * (math.ceil(self.row_width / 8) * 8 + Node.TUPLE_HEADER_SIZE)
+
+    """
+    Method to get the diagnostics of a sort: the estimated and the actual sort methods, whether it spilled to disk, 
+    and the minimum work_mem (in bytes) that would have kept it in memory. 
+    The actual sort (spilled when any process used the disk) is only known once the plan is analyzed, the estimate is used otherwise.
+    """
+    def get_sort_diagnostics(self):
+        return Node.diagnose_sort(self.cost_terms['sort_method'], self.cost_terms['output_bytes'], self.sort_spaces)
+
+    """
+    Method to get the diagnostics of a sort (see get_sort_diagnostics) from its estimated method, the estimated size of its output, 
+    and the sort methods reported by EXPLAIN ANALYZE (see get_sort_spaces).
+    """
+    @staticmethod
+    def diagnose_sort(sort_method, output_bytes, sort_spaces):
+        disk_space_used = [space_used for _, space_used, space_type in sort_spaces if space_type == 'Disk']
+        spilled = bool(disk_space_used) if sort_spaces else sort_method == 'external merge'
+        # A sort needs at least the memory it used (or wrote to disk when it spilled), and the planner only sorts in memory when the output fits in work_mem
+        min_work_mem = max([math.ceil(output_bytes / 1024)] + [space_used for _, space_used, _ in sort_spaces]) * 1024
+        return {'estimated_method': sort_method, 'methods': sorted({method for method, _, _ in sort_spaces}), 
+                'spilled': spilled, 'disk_space_used': sum(disk_space_used) * 1024, 'min_work_mem': min_work_mem}
+
+    """
+    Method to get the cost description of sort operation.
+    """
+    def get_cost_description_sort(self):
+        terms = self.cost_terms
+        cpu_operator_cost, num_input_tuples = terms['cpu_operator_cost'], terms['num_input_tuples']
+        output_tuples, input_bytes, output_bytes, work_mem = terms['output_tuples'], terms['input_bytes'], terms['output_bytes'], terms['work_mem']
+        sort_method, last_scan_cost, sort_cost = terms['sort_method'], terms['last_scan_cost'], terms['sort_cost']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
+        diagnostics = self.get_sort_diagnostics()
         
         # Confirmation values from EXPLAIN command
         psql_total_cost = self.total_cost  
-        self.valid = abs(total_cost - psql_total_cost) <= self.epsilon
-        reason = "The calculation may differ due to variations in some cases, such as the output is bigger than the work_mem, which will cause the tuples to be written to disk."
+        reason = "The calculation may differ as the size of the sorted tuples is estimated from their average width, which decides between the sort methods."
+
+        if sort_method == 'external merge':
+            sort_description = f"""
+        The {output_bytes} bytes to sort do not fit in work_mem = {work_mem} bytes, the sort is an external merge:
+        page_count = ceil(input_bytes / block_size) = {terms['page_count']}
+        run_count = input_bytes / work_mem = {input_bytes} / {work_mem} = {terms['run_count']}
+        merge_order = work_mem / (34 * block_size), between {Node.MIN_MERGE_ORDER} and {Node.MAX_MERGE_ORDER} = {terms['merge_order']}
+        merge_passes = {"ceil(log(run_count) / log(merge_order))" if terms['run_count'] > terms['merge_order'] else "1 (all the runs are merged at once)"} = {terms['merge_passes']}
+        page_accesses = 2 * page_count * merge_passes = {terms['page_accesses']} (every pass writes and reads all the pages)
+
+        sort_cost = comparison_cost * Ntuple * log2(Ntuple) + page_accesses * (seq_page_cost * 0.75 + random_page_cost * 0.25)
+                  = {2 * cpu_operator_cost} * {num_input_tuples} * {math.log2(num_input_tuples)} + {terms['page_accesses']} * {terms['page_cost']}
+                  = {sort_cost}"""
+        elif sort_method == 'top-N heapsort':
+            sort_description = f"""
+        Only the first {output_tuples} rows are kept (bounded sort below a Limit), the sort is a top-N heapsort in memory:
+        sort_cost = comparison_cost * Ntuple * log2(2 * limit_tuples)
+                  = {2 * cpu_operator_cost} * {num_input_tuples} * {math.log2(2 * output_tuples)}
+                  = {sort_cost}"""
+        else:
+            sort_description = f"""
+        The {output_bytes} bytes to sort fit in work_mem = {work_mem} bytes, the sort is a quicksort in memory:
+        sort_cost = comparison_cost * Ntuple * log2(Ntuple)
+                  = {2 * cpu_operator_cost} * {num_input_tuples} * {math.log2(num_input_tuples)}
+                  = {sort_cost}"""
+
+        if self.sort_spaces:
+            actual_description = "Actual sort: " + ", ".join(f"{method} ({space_used} kB of {space_type.lower()})" for method, space_used, space_type in self.sort_spaces)
+        else:
+            actual_description = "Actual sort: unknown, the query was not analyzed."
 
         description = f"""
-        startup_cost = {startup_cost}
+        input_bytes = Ntuple * (aligned width + tuple header) = {num_input_tuples} * ({math.ceil(self.row_width / 8) * 8} + {Node.TUPLE_HEADER_SIZE}) = {input_bytes}
+        {sort_description}
+
+        startup_cost = last_scan_cost + sort_cost = {last_scan_cost} + {sort_cost} = {startup_cost}
 
         run_cost = {cpu_operator_cost} * {num_input_tuples} = {run_cost}
         total_cost = startup_cost + run_cost 
@@ -430,16 +1888,19 @@ class Node:
 
         Is it a valid calculation? {"YES" if self.valid else "NO"} (with epsilon = {self.epsilon})
         {"" if self.valid else reason}
+
+        Estimated sort: {sort_method}. {actual_description}
+        {"The sort spilled to disk. " if diagnostics['spilled'] else ""}The minimum work_mem to sort in memory is at least {diagnostics['min_work_mem'] // 1024} kB (work_mem is {work_mem // 1024} kB).
         """
         
         return description
     
     """
-    Method to get the cost of merge join operation. 
+    Method to compute the cost of merge join operation. 
     We estimate the number of blocks my measuring the number of blocks in the smaller relation and the larger relation by using database catalog. 
     blocks = ceil(row_count * row_width / block_size).
     """
-    def get_cost_description_merge_join(self):
+    def compute_cost_merge_join(self):
         """
         - Using 2PMMS join algorithm 3(B(S) + B(R))
         - B(S) = number of blocks in the smaller relation
@@ -448,12 +1909,20 @@ class Node:
         rel_s = self.children[0]
         rel_r = self.children[1]
 
-        b_s = math.ceil(rel_s.row_count * rel_s.row_width / self.db.block_size)
-        b_r = math.ceil(rel_r.row_count * rel_r.row_width / self.db.block_size)
+        b_s = math.ceil(rel_s.row_count * rel_s.row_width / self.settings.block_size)
+        b_r = math.ceil(rel_r.row_count * rel_r.row_width / self.settings.block_size)
 
-        total_cost = 3 * (b_s + b_r) * self.db.seq_page_cost
+        total_cost = 3 * (b_s + b_r) * self.settings.seq_page_cost
+        return {'b_s': b_s, 'b_r': b_r, 'seq_page_cost': self.settings.seq_page_cost, 'total_cost': total_cost}
 
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
+    """
+    Method to get the cost description of merge join operation.
+    """
+    def get_cost_description_merge_join(self):
+        terms = self.cost_terms
+        b_s, b_r, seq_page_cost, total_cost = terms['b_s'], terms['b_r'], terms['seq_page_cost'], terms['total_cost']
+        rel_s = self.children[0]
+        rel_r = self.children[1]
 
         reason = f"""
             Our cost is {"underestimated" if total_cost <= self.total_cost else "overestimated"}.
@@ -476,7 +1945,7 @@ class Node:
                          = {b_r}
             
             total_cost = 3 * (num_blocks_S + num_blocks_R) * seq_page_cost
-                       = 3 * ({b_s} + {b_r}) * {self.db.seq_page_cost}
+                       = 3 * ({b_s} + {b_r}) * {seq_page_cost}
                        = {total_cost}
 
             psql_total_cost = {self.total_cost}
@@ -485,14 +1954,57 @@ class Node:
             {"" if self.valid else reason}
         """
 
-        return description
-    
+        return description
+    
+    """
+    Method to compute the cost of nested loop join.
+    We have 3 variants for nested loop join: index-based, materialized, and normal nested loop join.
+    """
+    def compute_cost_nested_loop(self):
+        # compare sizes of 2 input relations. Smaller relation is rel_out and larger relation is rel_in
+        rel_inner = self.children[1]
+        rel_outer = self.children[0]
+
+        num_input_tuples_rel_out = rel_outer.row_count
+        num_input_tuples_rel_in = rel_inner.row_count
+
+        size_tuple_rel_out = rel_outer.row_width
+        size_tuple_rel_in = rel_inner.row_width
+
+        num_blocks_rel_out = math.ceil(size_tuple_rel_out * num_input_tuples_rel_out / self.settings.block_size)
+        num_blocks_rel_in = math.ceil(size_tuple_rel_in * num_input_tuples_rel_in / self.settings.block_size)
+
+        cost_rel_out = rel_outer.total_cost
+        terms = {'num_blocks_rel_out': num_blocks_rel_out, 'num_blocks_rel_in': num_blocks_rel_in, 'cost_rel_out': cost_rel_out}
+
+        if rel_inner.node_type == 'Materialize' and rel_outer.node_type == 'Seq Scan':
+            startup_cost = 0
+            rescan_cost =  self.settings.cpu_operator_cost * num_input_tuples_rel_out
+
+            run_cost = (self.settings.cpu_operator_cost + self.settings.cpu_tuple_cost) * num_input_tuples_rel_out * num_input_tuples_rel_in + rescan_cost * (num_input_tuples_rel_in - 1) + cost_rel_out    
+            total_cost = startup_cost + run_cost
+            terms.update({'variant': 'materialized', 'rescan_cost': rescan_cost})
+        elif rel_inner.node_type == 'Index Scan' and rel_outer.node_type == 'Seq Scan':
+            startup_cost = rel_inner.startup_cost
+            total_cost = (self.settings.cpu_tuple_cost + rel_inner.total_cost) * num_input_tuples_rel_out + cost_rel_out
+
+            run_cost = total_cost - startup_cost
+            terms.update({'variant': 'index'})
+        else:
+            startup_cost = 0
+            m = self.settings.work_mem / self.settings.block_size
+            run_cost = (num_blocks_rel_out + num_blocks_rel_in * num_input_tuples_rel_out / m) * self.settings.seq_page_cost
+            total_cost = startup_cost + run_cost
+            terms.update({'variant': 'block', 'm': m})
+
+        terms.update({'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost})
+        return terms
+
     """
     Method to get nested loop join cost description.
-    We have 3 variants for nested loop join: index-based, materialized, and normal nested loop join.
     """
     def get_cost_description_nested_loop(self):
-        # compare sizes of 2 input relations. Smaller relation is rel_out and larger relation is rel_in
+        terms = self.cost_terms
         rel_inner = self.children[1]
         rel_outer = self.children[0]
 
@@ -502,14 +2014,8 @@ class Node:
         size_tuple_rel_out = rel_outer.row_width
         size_tuple_rel_in = rel_inner.row_width
 
-        num_blocks_rel_out = math.ceil(size_tuple_rel_out * num_input_tuples_rel_out / self.db.block_size)
-        num_blocks_rel_in = math.ceil(size_tuple_rel_in * num_input_tuples_rel_in / self.db.block_size)
-
-        cost_rel_out = rel_outer.total_cost
-        cost_rel_in = rel_inner.total_cost
-
-
-        psql_total_cost = self.total_cost
+        num_blocks_rel_out, num_blocks_rel_in, cost_rel_out = terms['num_blocks_rel_out'], terms['num_blocks_rel_in'], terms['cost_rel_out']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
         
         description = ""
         underestimate_reason = """
@@ -520,16 +2026,8 @@ class Node:
             The answer is overestimated due to the way Postgres handle a certain type of relation (e.g. unique inner relation), which they implemented a much more optimized way to handle the join. Thus its cost estimation function is different as well.
         """
 
-        
-
-        if rel_inner.node_type == 'Materialize' and rel_outer.node_type == 'Seq Scan':
-            startup_cost = 0
-            rescan_cost =  self.db.cpu_operator_cost * num_input_tuples_rel_out
-
-            run_cost = (self.db.cpu_operator_cost + self.db.cpu_tuple_cost) * num_input_tuples_rel_out * num_input_tuples_rel_in + rescan_cost * (num_input_tuples_rel_in - 1) + cost_rel_out    
-            total_cost = startup_cost + run_cost
-            self.valid = abs(total_cost - psql_total_cost) <= self.epsilon
-           
+        if terms['variant'] == 'materialized':
+            rescan_cost = terms['rescan_cost']
             description = f"""
                 startup_cost = {startup_cost}
                 The cost to retrieve the first row is zero
@@ -538,7 +2036,7 @@ class Node:
 
 
                 run_cost = (cpu_operator_cost + cpu_tuple_cost) * num_input_tuples_rel_out * num_input_tuples_rel_in + rescan_cost * (size_tuple_rel_out - 1) + cost_rel_out
-                            = ({self.db.cpu_operator_cost} + {self.db.cpu_tuple_cost}) * {num_input_tuples_rel_out} * {num_input_tuples_rel_in} + {rescan_cost} * ({num_input_tuples_rel_out} - 1) + {cost_rel_out}
+                            = ({self.settings.cpu_operator_cost} + {self.settings.cpu_tuple_cost}) * {num_input_tuples_rel_out} * {num_input_tuples_rel_in} + {rescan_cost} * ({num_input_tuples_rel_out} - 1) + {cost_rel_out}
                             = {run_cost}
                 
                 total_cost  = startup_cost + run_cost
@@ -549,18 +2047,12 @@ class Node:
                 Valid calculation? {"Yes" if self.valid else "No"}
                 {"" if self.valid else underestimate_reason if total_cost <= self.total_cost else overestimate_reason}
             """
-        elif rel_inner.node_type == 'Index Scan' and rel_outer.node_type == 'Seq Scan':
-            startup_cost = rel_inner.startup_cost
-            total_cost = (self.db.cpu_tuple_cost + rel_inner.total_cost) * num_input_tuples_rel_out + cost_rel_out
-
-            run_cost = total_cost - startup_cost
-            self.valid = abs(total_cost - psql_total_cost) <= self.epsilon
-
+        elif terms['variant'] == 'index':
             description = f"""
                 startup_cost = {startup_cost}
 
                 total_cost = (cpu_tuple_cost + cost_rel_in) * num_input_tuples_rel_out + cost_rel_out
-                         = ({self.db.cpu_tuple_cost} + {rel_inner.total_cost}) * {num_input_tuples_rel_out} + {cost_rel_out}
+                         = ({self.settings.cpu_tuple_cost} + {rel_inner.total_cost}) * {num_input_tuples_rel_out} + {cost_rel_out}
                          = {run_cost}
 
                 run_cost = total_cost - startup_cost
@@ -573,31 +2065,24 @@ class Node:
                 {"" if self.valid else underestimate_reason if total_cost <= self.total_cost else overestimate_reason}
             """
         else:
-            startup_cost = 0
-            m = self.db.work_mem / self.db.block_size
-            run_cost = (num_blocks_rel_out + num_blocks_rel_in * num_input_tuples_rel_out / m) * self.db.seq_page_cost
-            total_cost = startup_cost + run_cost
-            self.valid = abs(total_cost - psql_total_cost) <= self.epsilon
-
-            
-
+            m = terms['m']
             description = f"""
                 Using the lecture's formula,
 
                 num_blocks_rel_out = ceil(size_tuple_rel_out * num_input_tuples_rel_out / block_size)
-                                    = ceil({size_tuple_rel_out} * {num_input_tuples_rel_out} / {self.db.block_size})
+                                    = ceil({size_tuple_rel_out} * {num_input_tuples_rel_out} / {self.settings.block_size})
                                     = {num_blocks_rel_out}
 
                 num_blocks_rel_in = ceil(size_tuple_rel_in * num_input_tuples_rel_in / block_size)
-                                    = ceil({size_tuple_rel_in} * {num_input_tuples_rel_in} / {self.db.block_size})
+                                    = ceil({size_tuple_rel_in} * {num_input_tuples_rel_in} / {self.settings.block_size})
                                     = {num_blocks_rel_in}
                 
                 m   = work_mem / block_size
-                    = {self.db.work_mem} / {self.db.block_size}
+                    = {self.settings.work_mem} / {self.settings.block_size}
                     = {m}
                 
                 run_cost = (num_blocks_rel_out + num_blocks_rel_in * num_input_tuples_rel_out / m) * seq_page_cost
-                         = ({num_blocks_rel_out} + {num_blocks_rel_in} * {num_input_tuples_rel_out} / {m}) * {self.db.seq_page_cost}
+                         = ({num_blocks_rel_out} + {num_blocks_rel_in} * {num_input_tuples_rel_out} / {m}) * {self.settings.seq_page_cost}
                          = {run_cost}
 
                 total_cost = {startup_cost} + {run_cost}
@@ -608,34 +2093,39 @@ class Node:
                 {"" if self.valid else underestimate_reason if total_cost <= self.total_cost else overestimate_reason}
             """ 
 
-        # Confirmation values from EXPLAIN command
-        psql_total_cost = self.total_cost  
-        
-        
         return description
 
     """
-    Method to get the cost description of materialize operation.
+    Method to compute the cost of materialize operation.
     """
-    def get_cost_description_materialize(self):
+    def compute_cost_materialize(self):
         startup_cost = self.children[0].startup_cost
-        run_cost = self.children[0].total_cost - self.children[0].startup_cost + 2 * self.db.cpu_operator_cost * self.children[0].row_count
+        run_cost = self.children[0].total_cost - self.children[0].startup_cost + 2 * self.settings.cpu_operator_cost * self.children[0].row_count
 
         tuples_size = self.children[0].row_count * self.children[0].row_width
 
         # If the tuples size > work_mem, then the tuples are written to disk w ceil
-        write_to_disk = tuples_size > self.db.work_mem
+        write_to_disk = tuples_size > self.settings.work_mem
 
         extra_run_cost = 0
 
         if write_to_disk:
-            extra_run_cost = self.db.seq_page_cost * math.ceil(tuples_size / self.db.block_size) 
+            extra_run_cost = self.settings.seq_page_cost * math.ceil(tuples_size / self.settings.block_size) 
 
         total_cost = startup_cost + run_cost + extra_run_cost
+        return {'tuples_size': tuples_size, 'write_to_disk': write_to_disk, 'extra_run_cost': extra_run_cost, 
+                'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of materialize operation.
+    """
+    def get_cost_description_materialize(self):
+        terms = self.cost_terms
+        tuples_size, write_to_disk, extra_run_cost = terms['tuples_size'], terms['write_to_disk'], terms['extra_run_cost']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
 
         # Confirmation values from EXPLAIN command
         psql_total_cost = self.total_cost  
-        self.valid = abs(total_cost - psql_total_cost) <= self.epsilon
         
         overestimation_reason = "The answer may differ due to the intricate statistics that cannot be obtained from the query alone."
         underestimation_reason = "The answer is different due to the underestimated size of each tuples which requires intricate statistics (such as byte alignment rule) that cannot be obtained from the query alone."
@@ -645,7 +2135,7 @@ class Node:
         extra_description = f"""
             Since the tuples size is greater than work_mem, the tuples are written to disk as the tuples are too large to fit in memory.
             extra_run_cost  = seq_page_cost * ceil(tuples_size / block_size)
-            extra_run_cost  = {self.db.seq_page_cost} * ceil({tuples_size} / {self.db.block_size}) = {self.db.seq_page_cost * math.ceil(tuples_size / self.db.block_size)}
+            extra_run_cost  = {self.settings.seq_page_cost} * ceil({tuples_size} / {self.settings.block_size}) = {self.settings.seq_page_cost * math.ceil(tuples_size / self.settings.block_size)}
 
             run_cost += extra_run_cost
             run_cost = {run_cost} + {extra_run_cost} 
@@ -657,7 +2147,7 @@ class Node:
                          = {startup_cost}
                             
             run_cost = input_run_cost +  2 * cpu_operator_cost * num_input_tuples
-            run_cost = {self.children[0].total_cost - self.children[0].startup_cost} + 2 * {self.db.cpu_operator_cost} * {self.children[0].row_count} 
+            run_cost = {self.children[0].total_cost - self.children[0].startup_cost} + 2 * {self.settings.cpu_operator_cost} * {self.children[0].row_count} 
                      = {run_cost}
 
             { extra_description if write_to_disk else "" }
@@ -672,10 +2162,11 @@ class Node:
         return description
 
     """
-    Method to get the cost description of index scan. 
+    Method to compute the cost of index scan. 
     Getting the exact number of height_of_index in this case is not possible, therefore we calculate the cost as the average of index page access. 
+    The cost is only made of page accesses, so it is the same for a parallel index scan: PostgreSQL only divides the CPU cost by the parallel divisor.
     """
-    def get_cost_description_index_scan(self):
+    def compute_cost_index_scan(self):
         """
         Using the lecture formula:
 
@@ -688,19 +2179,28 @@ class Node:
             - data blocks = number of tuples / number of tuples in a block * 0.5
         """
 
-        index_relation_name = self.query_plan['Index Name']
-        index_statistics = self.db.get_table_statistics(index_relation_name, ['reltuples', 'relpages'])
+        index_statistics = self.get_index()
         num_index_pages, num_index_tuples = index_statistics['relpages'], index_statistics['reltuples']
 
-        row_count = self.db.get_table_row_count(self.relation_name)
+        row_count = self.get_relation()['reltuples']
+        page_count = self.get_relation()['relpages']
         branching_factor = num_index_tuples / num_index_pages
         height_of_index = math.log(num_index_pages) / math.log(branching_factor)
         avg_data_blocks = row_count / branching_factor * 0.5
-        avg_cost = (height_of_index + avg_data_blocks + self.db.get_table_page_count(self.relation_name) / 2) * self.db.random_page_cost
+        avg_cost = (height_of_index + avg_data_blocks + page_count / 2) * self.settings.random_page_cost
+        return {'num_index_pages': num_index_pages, 'num_index_tuples': num_index_tuples, 'row_count': row_count, 'page_count': page_count, 
+                'branching_factor': branching_factor, 'height_of_index': height_of_index, 'avg_data_blocks': avg_data_blocks, 'total_cost': avg_cost}
+
+    """
+    Method to get the cost description of index scan. 
+    """
+    def get_cost_description_index_scan(self):
+        terms = self.cost_terms
+        num_index_pages, num_index_tuples, row_count, page_count = terms['num_index_pages'], terms['num_index_tuples'], terms['row_count'], terms['page_count']
+        branching_factor, height_of_index, avg_cost = terms['branching_factor'], terms['height_of_index'], terms['total_cost']
 
         # Confirmation values from EXPLAIN command
         psql_total_cost = self.total_cost  
-        self.valid = abs(avg_cost - psql_total_cost) <= self.epsilon
         reason = f"""
             Our cost is {"underestimated" if avg_cost <= psql_total_cost else "overestimated"}.
             The calculation from the EXPLAIN query differs from our calculation due to the limited information provided by the database interface.
@@ -710,7 +2210,7 @@ class Node:
 
         description = f"""
             As there are various types of indexes in PostgreSQL, there will be several assumptions being made:
-            - The index is a B+ tree index
+            - The index is a B+ tree index{f" (its access method is {self.index['amname']})" if self.index.get('amname') else ""}
             - The given index is clustered index
 
             branching_factor = num_index_tuples / num_index_pages
@@ -726,7 +2226,7 @@ class Node:
                             = {row_count / branching_factor * 0.5}
 
             avg_cost = (height_of_index + avg_data_blocks + rel_pages / 2) * random_page_cost
-                     = {height_of_index} + {row_count / branching_factor * 0.5} + {self.db.get_table_page_count(self.relation_name) / 2} * {self.db.random_page_cost}
+                     = {height_of_index} + {row_count / branching_factor * 0.5} + {page_count / 2} * {self.settings.random_page_cost}
                      = {avg_cost}
                                 
             total_cost = {avg_cost}
@@ -735,20 +2235,32 @@ class Node:
 
             Valid calculation? {"Yes" if self.valid else "No"}
             {"" if self.valid else reason}
-            """
+            {"The page accesses are not divided among the processes of the parallel scan, only its rows are." if self.parallel_aware else ""}
+            {self.get_parallel_description()}"""
         return description
     
     """
-    Method to get the cost description of aggregate. 
+    Method to compute the cost of aggregate. 
     We mimic the implementation of PostgreSQL to calculate the cost of the aggregate operation.
     """
-    def get_cost_description_aggregate(self): 
-        cpu_tuple_cost = self.db.cpu_tuple_cost
-        cpu_operator_cost = self.db.cpu_operator_cost
+    def compute_cost_aggregate(self): 
+        cpu_tuple_cost = self.settings.cpu_tuple_cost
+        cpu_operator_cost = self.settings.cpu_operator_cost
         prev_totalcost = self.children[0].total_cost
         estimated_rows = self.children[0].row_count
-        actual_row_count = self.acutal_row_count
+        # Without ANALYZE (ExplainMode.ESTIMATE) there is no actual row count, the planned one is used instead
+        actual_row_count = self.acutal_row_count if self.acutal_row_count != "" else self.row_count
         total_cost = prev_totalcost + (estimated_rows * cpu_operator_cost) + (actual_row_count * cpu_tuple_cost)
+        return {'cpu_tuple_cost': cpu_tuple_cost, 'cpu_operator_cost': cpu_operator_cost, 'prev_totalcost': prev_totalcost, 
+                'estimated_rows': estimated_rows, 'actual_row_count': actual_row_count, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of aggregate. 
+    """
+    def get_cost_description_aggregate(self): 
+        terms = self.cost_terms
+        cpu_tuple_cost, cpu_operator_cost, prev_totalcost = terms['cpu_tuple_cost'], terms['cpu_operator_cost'], terms['prev_totalcost']
+        estimated_rows, actual_row_count, total_cost = terms['estimated_rows'], terms['actual_row_count'], terms['total_cost']
 
         psql_total_cost = self.total_cost
         reason = f"""
@@ -761,7 +2273,6 @@ class Node:
                        = {total_cost}
         """
 
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
         description = f"""
             {formula}
             psql_total_cost = {psql_total_cost}
@@ -770,34 +2281,93 @@ class Node:
         """
         return description
 
+    """
+    Method to compute the cost of hash. 
+    We mimic the implementation of PostgreSQL to calculate the cost of the hash operation. 
+    The size of the hash table decides whether it is built in memory, within hash_mem = work_mem * hash_mem_multiplier, or split into batches written to disk.
+    """
+    def compute_cost_hash(self): 
+        total_cost = self.children[0].total_cost
+        hash_mem = self.settings.work_mem * self.settings.hash_mem_multiplier
+        hash_bytes, batch_count = Node.estimate_hash_table(self.row_count, self.row_width, hash_mem)
+        return {'hash_mem': hash_mem, 'hash_bytes': hash_bytes, 'batch_count': batch_count, 'total_cost': total_cost}
+
+    """
+    Method to estimate the hash table of the given tuples as PostgreSQL does (ExecChooseHashTableSize in nodeHash.c): each tuple takes its aligned width 
+    and HASH_TUPLE_OVERHEAD, each bucket (one per tuple, in a power of two of at least 1024) a pointer of 8 bytes. 
+    A table larger than hash_mem is split into a power of two of batches, each of which fits in hash_mem with its buckets. 
+    Returns the size in bytes of the whole table and the number of batches.
+    """
+    @staticmethod
+    def estimate_hash_table(row_count, row_width, hash_mem):
+        row_count = max(row_count, 1)
+        tuple_size = Node.HASH_TUPLE_OVERHEAD + math.ceil(row_width / 8) * 8
+        hash_bytes = row_count * tuple_size + 8 * max(2 ** math.ceil(math.log2(row_count)), 1024)
+        if hash_bytes <= hash_mem:
+            return hash_bytes, 1
+        bucket_bytes = 8 * 2 ** math.floor(math.log2(hash_mem / (tuple_size + 8)))
+        batch_count = 2 ** math.ceil(math.log2(max(math.ceil(row_count * tuple_size / (hash_mem - bucket_bytes)), 2)))
+        return hash_bytes, batch_count
+
+    """
+    Method to get the diagnostics of a hash: the estimated and the actual numbers of batches, whether it spilled to disk (more than one batch), 
+    the peak memory (in bytes) of its hash table, and the minimum work_mem (in bytes) that would have kept it in memory. 
+    The actual hash table is only known once the plan is analyzed, the estimate is used otherwise.
+    """
+    def get_hash_diagnostics(self):
+        return Node.diagnose_hash(self.cost_terms['batch_count'], self.cost_terms['hash_bytes'], self.settings.hash_mem_multiplier, self.hash_usage)
+
+    """
+    Method to get the diagnostics of a hash (see get_hash_diagnostics) from its estimated number of batches, the estimated size of its hash table, 
+    hash_mem_multiplier and the hash table reported by EXPLAIN ANALYZE (see get_hash_usage).
+    """
+    @staticmethod
+    def diagnose_hash(batch_count, hash_bytes, hash_mem_multiplier, hash_usage):
+        batches, peak_memory = hash_usage if hash_usage else (None, None)
+        return {'estimated_batches': batch_count, 'batches': batches, 'spilled': (batches if hash_usage else batch_count) > 1, 
+                'peak_memory': peak_memory * 1024 if hash_usage else None, 'min_work_mem': math.ceil(hash_bytes / hash_mem_multiplier / 1024) * 1024}
+
     """
     Method to get the cost description of hash. 
-    We mimic the implementation of PostgreSQL to calculate the cost of the hash operation.
     """
     def get_cost_description_hash(self): 
-        total_cost = self.children[0].total_cost
+        total_cost = self.cost_terms['total_cost']
         psql_total_cost = self.total_cost  
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
         reason = f"""
             Our cost is {"underestimated" if total_cost <= self.total_cost else "overestimated"}.
             The calculation requires more statistics that are not available outside of external PostgreSQL codebase. 
         """
 
+        terms = self.cost_terms
+        if terms['batch_count'] > 1:
+            memory_description = f"The hash table does not fit in hash_mem, it is split into {terms['batch_count']} batches written to disk."
+        else:
+            memory_description = "The hash table fits in hash_mem, it is built in memory."
+        if self.hash_usage:
+            actual_description = f"Actual hash table: {self.hash_usage[0]} batches, {self.hash_usage[1]} kB of peak memory"
+        else:
+            actual_description = "Actual hash table: unknown, the query was not analyzed."
+
         description = f"""
             As observed in PostgresSQL, hash cost are passed hence we will do the same.
             total_cost = prev_total_cost
                        = {total_cost}
             PostgreSQL total_cost = {psql_total_cost}
+
+            hash_mem = work_mem * hash_mem_multiplier = {self.settings.work_mem} * {self.settings.hash_mem_multiplier} = {terms['hash_mem']}
+            hash_bytes = Ntuple * (aligned width + tuple overhead) + buckets = {terms['hash_bytes']}
+            {memory_description}
+            {actual_description}
             is it a valid calculation? {"YES" if self.valid else "NO"} (with epsilon = {self.epsilon})
             {"" if self.valid else reason}
         """
         return description
     
     """
-    Method to get the cost description of hash join.
+    Method to compute the cost of hash join.
     We apply the knowledge from the lecture to calculate the cost of the hash join operation, weighted by the seq_page_cost. 
     """
-    def get_cost_description_hash_join(self):
+    def compute_cost_hash_join(self):
         """
         - Using grace hash join algorithm 3(B(S) + B(R))
         - B(S) = number of blocks in the smaller relation
@@ -806,12 +2376,20 @@ class Node:
         rel_s = self.children[0]
         rel_r = self.children[1]
 
-        b_s = math.ceil(rel_s.row_count * rel_s.row_width / self.db.block_size)
-        b_r = math.ceil(rel_r.row_count * rel_r.row_width / self.db.block_size)
+        b_s = math.ceil(rel_s.row_count * rel_s.row_width / self.settings.block_size)
+        b_r = math.ceil(rel_r.row_count * rel_r.row_width / self.settings.block_size)
 
-        total_cost = 3 * (b_s + b_r) * self.db.seq_page_cost
+        total_cost = 3 * (b_s + b_r) * self.settings.seq_page_cost
+        return {'b_s': b_s, 'b_r': b_r, 'seq_page_cost': self.settings.seq_page_cost, 'total_cost': total_cost}
 
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
+    """
+    Method to get the cost description of hash join.
+    """
+    def get_cost_description_hash_join(self):
+        terms = self.cost_terms
+        b_s, b_r, seq_page_cost, total_cost = terms['b_s'], terms['b_r'], terms['seq_page_cost'], terms['total_cost']
+        rel_s = self.children[0]
+        rel_r = self.children[1]
 
         reason = f"""
             Our cost is {"underestimated" if total_cost <= self.total_cost else "overestimated"}.
@@ -835,7 +2413,7 @@ class Node:
                          = {b_r}
             
             total_cost = 3 * (num_blocks_S + num_blocks_R) * seq_page_cost
-                       = 3 * ({b_s} + {b_r}) * {self.db.seq_page_cost}
+                       = 3 * ({b_s} + {b_r}) * {seq_page_cost}
                        = {total_cost}
 
             psql_total_cost = {self.total_cost}
@@ -847,20 +2425,30 @@ class Node:
         return description
     
     """
-    Method to get the cost description of gather operation. 
+    Method to compute the cost of gather operation. 
     We mimic the implementation of PostgreSQL to calculate the cost of the gather operation.
     """
-    def get_cost_description_gather(self): 
-        parallel_setup_cost = self.db.parallel_setup_cost
-        parallel_tuple_cost = self.db.parallel_tuple_cost
+    def compute_cost_gather(self): 
+        parallel_setup_cost = self.settings.parallel_setup_cost
+        parallel_tuple_cost = self.settings.parallel_tuple_cost
         prev_startup_cost = self.children[0].startup_cost
         prev_total_cost = self.children[0].total_cost
         planned_row = self.row_count
         startup_cost = prev_startup_cost + parallel_setup_cost
         run_cost = (prev_total_cost - prev_startup_cost) + (parallel_tuple_cost * self.row_count)
         total_cost = startup_cost + run_cost
+        return {'parallel_setup_cost': parallel_setup_cost, 'parallel_tuple_cost': parallel_tuple_cost, 'prev_startup_cost': prev_startup_cost, 
+                'prev_total_cost': prev_total_cost, 'planned_row': planned_row, 'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of gather operation. 
+    """
+    def get_cost_description_gather(self): 
+        terms = self.cost_terms
+        parallel_setup_cost, parallel_tuple_cost = terms['parallel_setup_cost'], terms['parallel_tuple_cost']
+        prev_startup_cost, prev_total_cost, planned_row = terms['prev_startup_cost'], terms['prev_total_cost'], terms['planned_row']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
         psql_total_cost = self.total_cost  
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
         reason = f"""
             Our cost is {"underestimated" if total_cost <= self.total_cost else "overestimated"}.
             The calculation requires more statistics that are not available outside of external PostgreSQL codebase. 
@@ -886,13 +2474,13 @@ class Node:
         return description
     
     """
-    Method to get the cost description of gather merge operation.
+    Method to compute the cost of gather merge operation.
     We mimic the implementation of PostgreSQL to calculate the cost of the gather merge operation.
     """
-    def get_cost_description_gather_merge(self): 
-        cpu_operator_cost = self.db.cpu_operator_cost
-        parallel_setup_cost = self.db.parallel_setup_cost
-        parallel_tuple_cost = self.db.parallel_tuple_cost
+    def compute_cost_gather_merge(self): 
+        cpu_operator_cost = self.settings.cpu_operator_cost
+        parallel_setup_cost = self.settings.parallel_setup_cost
+        parallel_tuple_cost = self.settings.parallel_tuple_cost
         prev_startup_cost = self.children[0].startup_cost
         workers = self.workers
         planned_row = self.row_count
@@ -905,8 +2493,20 @@ class Node:
         run_cost = (planned_row * comparison_cost * logN) + (cpu_operator_cost * planned_row) + (parallel_tuple_cost * planned_row * 1.05)
 
         total_cost = startup_cost + run_cost
+        return {'cpu_operator_cost': cpu_operator_cost, 'parallel_setup_cost': parallel_setup_cost, 'parallel_tuple_cost': parallel_tuple_cost, 
+                'prev_startup_cost': prev_startup_cost, 'workers': workers, 'planned_row': planned_row, 'n': n, 'logN': logN, 
+                'comparison_cost': comparison_cost, 'startup_cost': startup_cost, 'run_cost': run_cost, 'total_cost': total_cost}
+
+    """
+    Method to get the cost description of gather merge operation.
+    """
+    def get_cost_description_gather_merge(self): 
+        terms = self.cost_terms
+        cpu_operator_cost, parallel_setup_cost, parallel_tuple_cost = terms['cpu_operator_cost'], terms['parallel_setup_cost'], terms['parallel_tuple_cost']
+        prev_startup_cost, workers, planned_row = terms['prev_startup_cost'], terms['workers'], terms['planned_row']
+        n, logN, comparison_cost = terms['n'], terms['logN'], terms['comparison_cost']
+        startup_cost, run_cost, total_cost = terms['startup_cost'], terms['run_cost'], terms['total_cost']
         psql_total_cost = self.total_cost  
-        self.valid = abs(total_cost - self.total_cost) <= self.epsilon
         reason = f"""
             Our cost is {"underestimated" if total_cost <= self.total_cost else "overestimated"}.
             The calculation requires more statistics that are not available outside of external PostgreSQL codebase. 
@@ -943,24 +2543,584 @@ This serves as a wrapper class to parse the query plan and create the graph.
 """
 class Graph:    
     """
-    Constructor to instantiate a Graph object.
+    Constructor to instantiate a Graph object. The nodes are numbered in pre-order, nodes[i] is the node with id i (the root is nodes[0]). 
+    The db is a DB, or a Snapshot to explain a saved plan offline.
     """
     def __init__(self, query_plan, db: DB, epsilon): 
         self.db = db 
         self.epsilon = epsilon
+        self.nodes = []
         self.root = self.parse_query_plan(query_plan)
     
     """
-    Method to parse the query plan and create the graph.
+    Method to parse the query plan and create the graph. 
+    The plan is walked (see walk_query_plan), then the nodes are created in reverse pre-order, 
+    so that the children of a node (which come after it in pre-order) already exist when it is created. 
     """
     def parse_query_plan(self, query_plan):
-        children = []
-        if 'Plans' in query_plan: 
-            for child_query_plan in query_plan['Plans']: 
-                children.append(self.parse_query_plan(child_query_plan)) 
+        query_plans, children_ids, gather_workers, limits = Graph.walk_query_plan(query_plan)
+
+        # The relations and indexes of all the nodes are fetched at once, before any cost is computed
+        relations = self.db.get_relations(dict.fromkeys(name for query_plan in query_plans for name in Node.get_relation_names(query_plan)))
+
+        self.nodes = [None] * len(query_plans)
+        for node_id in reversed(range(len(query_plans))):
+            children = [self.nodes[child_id] for child_id in children_ids[node_id]]
+            self.nodes[node_id] = Node(query_plans[node_id], self.db, children, self.epsilon, node_id, relations, gather_workers[node_id], limits[node_id])
+        return self.nodes[0]
+
+    """
+    Method to walk a query plan with an explicit stack, numbering its nodes in pre-order. 
+    The workers planned by a Gather or Gather Merge are passed down the walk to the parallel aware nodes below it, 
+    and the rows of a Limit to the sort below it (through a Gather Merge, whose workers sort with the same bound).
+    Returns the plans of the nodes, the ids of their children, their gather_workers and their limit_tuples (see Node), by node id.
+    """
+    @staticmethod
+    def walk_query_plan(query_plan):
+        query_plans = []
+        children_ids = []
+        gather_workers = []
+        limits = []
+        stack = [(query_plan, None, None, None)]
+        while stack:
+            query_plan, parent_id, workers, limit_tuples = stack.pop()
+            node_id = len(query_plans)
+            query_plans.append(query_plan)
+            children_ids.append([])
+            gather_workers.append(workers)
+            limits.append(limit_tuples)
+            if parent_id is not None:
+                children_ids[parent_id].append(node_id)
+            if query_plan['Node Type'] in ('Gather', 'Gather Merge'):
+                workers = query_plan['Workers Planned']
+            if query_plan['Node Type'] == 'Limit':
+                limit_tuples = query_plan['Plan Rows']
+            elif query_plan['Node Type'] != 'Gather Merge':
+                limit_tuples = None
+            if 'Plans' in query_plan: 
+                stack.extend((child_query_plan, node_id, workers, limit_tuples) for child_query_plan in reversed(query_plan['Plans']))
+        return query_plans, children_ids, gather_workers, limits
+
+    """
+    Method to get the OIDs of the tables read by the plan, including the tables of the scanned indexes.
+    """
+    def get_relation_oids(self):
+        oids = set()
+        for node in self.nodes:
+            if node.relation:
+                oids.add(node.relation['oid'])
+        return oids
+
+    """
+    Method to simulate the plan under other settings (see Settings.override), without the database: the cost of every node is recomputed 
+    bottom-up by its cost model, from the simulated costs of its children instead of the costs of PostgreSQL. 
+    Returns the simulated nodes (see Node.simulate) by node id.
+    """
+    def simulate(self, settings: Settings):
+        nodes = [None] * len(self.nodes)
+        for node in reversed(self.nodes):
+            nodes[node.id] = node.simulate(settings, [nodes[child.id] for child in node.children])
+        return nodes
+
+"""
+Class CostBatch is the batch cost engine: the nodes of many query plans flattened into columnar NumPy arrays, 
+on which the cost model of each node type is evaluated as one vectorized expression over all the nodes of that type. 
+It is built from the raw plans, without creating a Node (and computing its cost) per node, and gives the same estimates as Node.compute_cost.
+"""
+class CostBatch:
+    """
+    The cost models, in the order of their model ids (-1 for the unsupported node types).
+    """
+    MODELS = ('sequential_scan', 'sequential_scan_with_filter') + tuple(Node.COST_MODELS.values())
+
+    """
+    The settings used by the cost models.
+    """
+    SETTINGS = ('block_size', 'seq_page_cost', 'random_page_cost', 'cpu_tuple_cost', 'cpu_operator_cost', 
+                'parallel_setup_cost', 'parallel_tuple_cost', 'work_mem', 'max_parallel_workers_per_gather', 'parallel_leader_participation', 
+                'min_parallel_table_scan_size')
+
+    """
+    The sort methods, in the order of their ids (see get_sort_terms).
+    """
+    SORT_METHODS = ('quicksort', 'top-N heapsort', 'external merge')
+
+    """
+    Constructor to instantiate a CostBatch object from a list of query plans (as parsed from EXPLAIN (FORMAT JSON)), with the settings and the catalog 
+    of db: a DB, or a Snapshot for saved plans. The nodes of each plan are numbered in pre-order (see Graph.walk_query_plan), 
+    the node at position i of the batch is the node node_ids[i] of the plan plan_ids[i]. 
+    A plan that cannot be walked or flattened (e.g. one of its scans reads an unknown relation, as Node.get_relation raises) is left out, 
+    its exception is kept in errors. 
+    The per-node columns end with a sentinel row of NaN, so that the child columns can be gathered with -1 for a missing child.
+    """
+    def __init__(self, query_plans, db: DB, epsilon = 1):
+        self.db = db
+        self.epsilon = epsilon
+        self.errors = {}
+        walks = []
+        for plan_id, query_plan in enumerate(query_plans):
+            try:
+                walks.append(Graph.walk_query_plan(query_plan))
+            except Exception as exception:
+                self.errors[plan_id] = exception
+                walks.append(None)
+
+        # The relations and indexes of all the plans are fetched at once
+        relations = db.get_relations(dict.fromkeys(name for walk in walks if walk for query_plan in walk[0] 
+                                                   for name in Node.get_relation_names(query_plan)))
+
+        self.columns = {name: [] for name in ('model', 'row_count', 'row_width', 'startup_cost', 'total_cost', 'actual_row_count', 'workers', 
+                                              'parallel_aware', 'gather_workers', 'limit_tuples', 'page_count', 'table_row_count', 
+                                              'index_page_count', 'index_row_count', 'outer', 'inner')}
+        self.node_types = []
+        self.relation_names = []
+        self.parents = []
+        self.sort_spaces = {}
+        self.hash_usages = {}
+        self.plan_ids = []
+        self.node_ids = []
+        self.plan_ranges = []
+        for plan_id, walk in enumerate(walks):
+            offset = len(self.plan_ids)
+            if walk is None:
+                self.plan_ranges.append(None)
+                continue
+            try:
+                self.add_plan(plan_id, walk, relations, offset)
+            except Exception as exception:
+                self.errors[plan_id] = exception
+                self.plan_ranges.append(None)
+                for values in (self.columns.values(), (self.node_types, self.relation_names, self.parents, self.plan_ids, self.node_ids)):
+                    for column in values:
+                        del column[offset:]
+                self.sort_spaces = {index: spaces for index, spaces in self.sort_spaces.items() if index < offset}
+                self.hash_usages = {index: usage for index, usage in self.hash_usages.items() if index < offset}
+            else:
+                self.plan_ranges.append(range(offset, len(self.plan_ids)))
+
+        columns = self.columns
+        del self.columns
+        self.size = len(self.plan_ids)
+        self.model = np.array(columns.pop('model') + [-1], dtype=np.int64)
+        self.outer = np.array(columns.pop('outer'), dtype=np.int64)
+        self.inner = np.array(columns.pop('inner'), dtype=np.int64)
+        for name, values in columns.items():
+            setattr(self, name, np.array(values + [math.nan], dtype=np.float64))
+        self.plan_ids = np.array(self.plan_ids, dtype=np.int64)
+        self.node_ids = np.array(self.node_ids, dtype=np.int64)
+
+    """
+    Method to add the nodes of a walked plan (see Graph.walk_query_plan) to the columns, from the position offset of the batch. 
+    The fields are read from the plan as Node does.
+    """
+    def add_plan(self, plan_id, walk, relations, offset):
+        query_plans, children_ids, gather_workers, limits = walk
+        columns = self.columns
+        parents = [None] * len(query_plans)
+        for node_id, child_ids in enumerate(children_ids):
+            for child_id in child_ids:
+                parents[child_id] = node_id
+
+        for node_id, query_plan in enumerate(query_plans):
+            cost_model = Node.get_plan_cost_model(query_plan)
+            schema = query_plan.get('Schema')
+            relation_name = query_plan.get('Relation Name', "")
+            relation = relations.get((schema, relation_name)) if relation_name else None
+            index_name = query_plan.get('Index Name', "")
+            index = relations.get((schema, index_name)) if cost_model == 'index_scan' else None
+            if cost_model in ('sequential_scan', 'sequential_scan_with_filter', 'index_scan') and relation is None:
+                raise LookupError(f"Relation {schema + '.' if schema else ''}{relation_name} is unknown")
+            if cost_model == 'index_scan' and index is None:
+                raise LookupError(f"Index {schema + '.' if schema else ''}{index_name} is unknown")
+
+            columns['model'].append(CostBatch.MODELS.index(cost_model) if cost_model else -1)
+            columns['row_count'].append(query_plan['Plan Rows'])
+            columns['row_width'].append(query_plan['Plan Width'])
+            columns['startup_cost'].append(query_plan['Startup Cost'])
+            columns['total_cost'].append(query_plan['Total Cost'])
+            columns['actual_row_count'].append(query_plan.get('Actual Rows', math.nan))
+            columns['workers'].append(query_plan.get('Workers Planned', math.nan))
+            columns['parallel_aware'].append(1 if query_plan.get('Parallel Aware') else 0)
+            columns['gather_workers'].append(gather_workers[node_id] if gather_workers[node_id] is not None else math.nan)
+            columns['limit_tuples'].append(limits[node_id] if limits[node_id] else math.nan)
+            columns['page_count'].append(relation['relpages'] if relation else math.nan)
+            columns['table_row_count'].append(relation['reltuples'] if relation else math.nan)
+            columns['index_page_count'].append(index['relpages'] if index else math.nan)
+            columns['index_row_count'].append(index['reltuples'] if index else math.nan)
+            child_ids = children_ids[node_id]
+            columns['outer'].append(offset + child_ids[0] if len(child_ids) > 0 else -1)
+            columns['inner'].append(offset + child_ids[1] if len(child_ids) > 1 else -1)
+
+            if cost_model == 'sort':
+                self.sort_spaces[offset + node_id] = Node.get_sort_spaces(query_plan)
+            if cost_model == 'hash':
+                self.hash_usages[offset + node_id] = Node.get_hash_usage(query_plan)
+            self.node_types.append(query_plan['Node Type'])
+            self.relation_names.append(relation_name or None)
+            self.parents.append(parents[node_id])
+            self.plan_ids.append(plan_id)
+            self.node_ids.append(node_id)
+
+    """
+    Method to get the values of the settings used by the cost models, from the settings of the database or the given settings.
+    """
+    def get_settings_values(self, settings = None):
+        settings = settings or self.db.settings
+        return {name: float(getattr(settings, name)) for name in CostBatch.SETTINGS}
+
+    """
+    Method to evaluate the cost models over the batch, with the settings of the database or the given settings. 
+    As in Node.compute_cost, DISABLE_COST is added to the nodes of a disabled planner method. 
+    Returns the estimated cost and the error (estimated cost - PostgreSQL total cost) of every node, NaN for the unsupported node types.
+    """
+    def evaluate(self, settings = None):
+        settings = settings or self.db.settings
+        settings_values = self.get_settings_values(settings)
+        db_settings_values = self.get_settings_values()
+        estimated_cost = np.full(self.size, math.nan)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for model_id, cost_model in enumerate(CostBatch.MODELS):
+                index = np.flatnonzero(self.model[:self.size] == model_id)
+                if len(index):
+                    estimated_cost[index] = getattr(self, 'evaluate_' + cost_model)(index, settings_values, db_settings_values)
+                    if cost_model in Node.DISABLE_FLAGS and not settings.is_enabled(Node.DISABLE_FLAGS[cost_model]):
+                        estimated_cost[index] += Node.DISABLE_COST
+        return estimated_cost, estimated_cost - self.total_cost[:self.size]
+
+    """
+    Method to get whether the estimated costs are valid calculations, given the errors returned by evaluate.
+    """
+    def get_valid(self, error):
+        return np.abs(error) <= self.epsilon
+
+    """
+    Method to get the exception of a plan: the one raised when it was flattened, or an ArithmeticError if a cost model gave no finite estimate 
+    for one of its nodes (where Node.compute_cost raises, e.g. for a division by zero). Returns None for a plan without error.
+    """
+    def get_plan_error(self, plan_id, estimated_cost):
+        if plan_id in self.errors:
+            return self.errors[plan_id]
+        for index in self.plan_ranges[plan_id]:
+            if self.model[index] >= 0 and not math.isfinite(estimated_cost[index]):
+                return ArithmeticError(f"The cost model of node {self.node_ids[index]} ({self.node_types[index]}) has no finite estimate")
+        return None
+
+    """
+    Method to get the diagnostics of the sorts of the batch (see Node.get_sort_diagnostics), with the settings of the database or the given settings. 
+    Returns the diagnostics by position in the batch.
+    """
+    def get_sort_diagnostics(self, settings = None):
+        index = np.flatnonzero(self.model[:self.size] == CostBatch.MODELS.index('sort'))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            _, sort_methods, output_bytes, _ = self.get_sort_terms(index, self.get_settings_values(settings))
+        return {int(position): Node.diagnose_sort(CostBatch.SORT_METHODS[sort_method], float(node_output_bytes), self.sort_spaces[position]) 
+                for position, sort_method, node_output_bytes in zip(index, sort_methods, output_bytes)}
+
+    """
+    Method to get the diagnostics of the hashes of the batch (see Node.get_hash_diagnostics), with the settings of the database or the given settings. 
+    Returns the diagnostics by position in the batch.
+    """
+    def get_hash_diagnostics(self, settings = None):
+        settings = settings or self.db.settings
+        hash_mem = settings.work_mem * settings.hash_mem_multiplier
+        diagnostics = {}
+        for position, hash_usage in self.hash_usages.items():
+            hash_bytes, batch_count = Node.estimate_hash_table(float(self.row_count[position]), float(self.row_width[position]), hash_mem)
+            diagnostics[position] = Node.diagnose_hash(batch_count, hash_bytes, settings.hash_mem_multiplier, hash_usage)
+        return diagnostics
+
+    """
+    Method to get the JSON Lines records of the nodes of a plan, as get_node_records does for a Graph, 
+    from the estimated costs and the validity of the nodes (see evaluate and get_valid) and the diagnostics of the sorts and of the hashes 
+    (see get_sort_diagnostics and get_hash_diagnostics).
+    """
+    def get_node_records(self, plan_id, estimated_cost, valid, sort_diagnostics, hash_diagnostics):
+        records = []
+        for index in self.plan_ranges[plan_id]:
+            record = {
+                'id': int(self.node_ids[index]),
+                'parent': self.parents[index],
+                'node_type': self.node_types[index],
+                'relation': self.relation_names[index],
+                'estimated_cost': float(estimated_cost[index]) if self.model[index] >= 0 else None,
+                'psql_cost': float(self.total_cost[index]),
+                'valid': bool(valid[index]),
+            }
+            if index in sort_diagnostics:
+                record['sort'] = sort_diagnostics[index]
+            if index in hash_diagnostics:
+                record['hash'] = hash_diagnostics[index]
+            records.append(record)
+        return records
+
+    """
+    Method to get the number of blocks of the output of the given nodes.
+    """
+    def get_block_count(self, index, settings):
+        return np.ceil(self.row_count[index] * self.row_width[index] / settings['block_size'])
+
+    """
+    Vectorized Node.get_parallel_divisor: the workers are the workers planned by the Gather under the settings of the database (db_settings), 
+    otherwise the workers of Node.get_planned_workers, computed for all the nodes at once.
+    """
+    def get_parallel_divisor(self, index, settings, db_settings):
+        planned_settings = (settings['max_parallel_workers_per_gather'] == db_settings['max_parallel_workers_per_gather'] 
+                            and settings['min_parallel_table_scan_size'] == db_settings['min_parallel_table_scan_size'])
+
+        page_count = self.page_count[index]
+        threshold = np.maximum(np.floor(settings['min_parallel_table_scan_size'] / settings['block_size']), 1)
+        planned_workers = np.where(page_count >= threshold, 1, 0)
+        threshold = threshold * 3
+        while np.any(page_count >= threshold):
+            planned_workers += page_count >= threshold
+            threshold = threshold * 3
+        planned_workers = np.minimum(planned_workers, settings['max_parallel_workers_per_gather'])
+
+        gather_workers = self.gather_workers[index]
+        workers = np.where(planned_settings & ~np.isnan(gather_workers), gather_workers, planned_workers)
+        workers = np.where(self.parallel_aware[index] == 1, workers, 0)
+        leader_contribution = np.where(settings['parallel_leader_participation'] != 0, np.maximum(1.0 - 0.3 * workers, 0), 0)
+        return np.where(workers > 0, workers + leader_contribution, 1)
+
+    """
+    Vectorized Node.compute_cost_sequential_scan.
+    """
+    def evaluate_sequential_scan(self, index, settings, db_settings):
+        row_count = np.where(self.parallel_aware[index] == 1, self.table_row_count[index] / self.get_parallel_divisor(index, settings, db_settings), self.row_count[index])
+        return settings['cpu_tuple_cost'] * row_count + settings['seq_page_cost'] * self.page_count[index]
+
+    """
+    Vectorized Node.compute_cost_sequential_scan_with_filter.
+    """
+    def evaluate_sequential_scan_with_filter(self, index, settings, db_settings):
+        row_count = self.table_row_count[index] / self.get_parallel_divisor(index, settings, db_settings)
+        return (settings['cpu_tuple_cost'] + settings['cpu_operator_cost']) * row_count + settings['seq_page_cost'] * self.page_count[index]
+
+    """
+    Vectorized Node.compute_cost_sort.
+    """
+    def evaluate_sort(self, index, settings, db_settings):
+        sort_cost, _, _, num_input_tuples = self.get_sort_terms(index, settings)
+        return self.total_cost[self.outer[index]] + sort_cost + settings['cpu_operator_cost'] * num_input_tuples
+
+    """
+    Method to get the terms of the sort cost model of the given nodes: the sort method of each node is selected with np.where. 
+    Returns the cost of the sorts, the ids of their sort methods (see SORT_METHODS), the sizes of their outputs and the numbers of their input tuples.
+    """
+    def get_sort_terms(self, index, settings):
+        outer = self.outer[index]
+        num_input_tuples = np.maximum(self.row_count[outer], 2)
+        comparison_cost = 2 * settings['cpu_operator_cost']
+        work_mem = settings['work_mem']
+        tuple_size = np.ceil(self.row_width[index] / 8) * 8 + Node.TUPLE_HEADER_SIZE
+        input_bytes = num_input_tuples * tuple_size
+        output_tuples = np.where(self.limit_tuples[index] < num_input_tuples, self.limit_tuples[index], num_input_tuples)
+        output_bytes = output_tuples * tuple_size
+
+        page_count = np.ceil(input_bytes / settings['block_size'])
+        run_count = input_bytes / work_mem
+        merge_order = np.clip(np.floor(work_mem / (34 * settings['block_size'])), Node.MIN_MERGE_ORDER, Node.MAX_MERGE_ORDER)
+        merge_passes = np.where(run_count > merge_order, np.ceil(np.log(run_count) / np.log(merge_order)), 1)
+        page_cost = settings['seq_page_cost'] * 0.75 + settings['random_page_cost'] * 0.25
+        external_cost = comparison_cost * num_input_tuples * np.log2(num_input_tuples) + 2 * page_count * merge_passes * page_cost
+        heap_cost = comparison_cost * num_input_tuples * np.log2(2 * output_tuples)
+        quick_cost = comparison_cost * num_input_tuples * np.log2(num_input_tuples)
+        sort_methods = np.where(output_bytes > work_mem, 2, np.where((num_input_tuples > 2 * output_tuples) | (input_bytes > work_mem), 1, 0))
+        sort_cost = np.choose(sort_methods, (quick_cost, heap_cost, external_cost))
+        return sort_cost, sort_methods, output_bytes, num_input_tuples
+
+    """
+    Vectorized Node.compute_cost_merge_join.
+    """
+    def evaluate_merge_join(self, index, settings, db_settings):
+        return 3 * (self.get_block_count(self.outer[index], settings) + self.get_block_count(self.inner[index], settings)) * settings['seq_page_cost']
+
+    """
+    Vectorized Node.compute_cost_hash_join, which uses the same formula as the merge join.
+    """
+    def evaluate_hash_join(self, index, settings, db_settings):
+        return self.evaluate_merge_join(index, settings, db_settings)
+
+    """
+    Vectorized Node.compute_cost_hash.
+    """
+    def evaluate_hash(self, index, settings, db_settings):
+        return self.total_cost[self.outer[index]]
+
+    """
+    Vectorized Node.compute_cost_aggregate.
+    """
+    def evaluate_aggregate(self, index, settings, db_settings):
+        outer = self.outer[index]
+        actual_row_count = np.where(np.isnan(self.actual_row_count[index]), self.row_count[index], self.actual_row_count[index])
+        return self.total_cost[outer] + (self.row_count[outer] * settings['cpu_operator_cost']) + (actual_row_count * settings['cpu_tuple_cost'])
+
+    """
+    Vectorized Node.compute_cost_gather.
+    """
+    def evaluate_gather(self, index, settings, db_settings):
+        outer = self.outer[index]
+        startup_cost = self.startup_cost[outer] + settings['parallel_setup_cost']
+        run_cost = (self.total_cost[outer] - self.startup_cost[outer]) + (settings['parallel_tuple_cost'] * self.row_count[index])
+        return startup_cost + run_cost
+
+    """
+    Vectorized Node.compute_cost_gather_merge.
+    """
+    def evaluate_gather_merge(self, index, settings, db_settings):
+        n = self.workers[index] + 1
+        logN = np.log2(n)
+        comparison_cost = 2.0 * settings['cpu_operator_cost']
+        planned_row = self.row_count[index]
+        startup_cost = (comparison_cost * n * logN) + settings['parallel_setup_cost'] + self.startup_cost[self.outer[index]]
+        run_cost = (planned_row * comparison_cost * logN) + (settings['cpu_operator_cost'] * planned_row) + (settings['parallel_tuple_cost'] * planned_row * 1.05)
+        return startup_cost + run_cost
+
+    """
+    Vectorized Node.compute_cost_index_scan.
+    """
+    def evaluate_index_scan(self, index, settings, db_settings):
+        branching_factor = self.index_row_count[index] / self.index_page_count[index]
+        height_of_index = np.log(self.index_page_count[index]) / np.log(branching_factor)
+        avg_data_blocks = self.table_row_count[index] / branching_factor * 0.5
+        return (height_of_index + avg_data_blocks + self.page_count[index] / 2) * settings['random_page_cost']
+
+    """
+    Vectorized Node.compute_cost_materialize.
+    """
+    def evaluate_materialize(self, index, settings, db_settings):
+        outer = self.outer[index]
+        startup_cost = self.startup_cost[outer]
+        run_cost = self.total_cost[outer] - self.startup_cost[outer] + 2 * settings['cpu_operator_cost'] * self.row_count[outer]
+        tuples_size = self.row_count[outer] * self.row_width[outer]
+        extra_run_cost = np.where(tuples_size > settings['work_mem'], settings['seq_page_cost'] * np.ceil(tuples_size / settings['block_size']), 0)
+        return startup_cost + run_cost + extra_run_cost
+
+    """
+    Vectorized Node.compute_cost_nested_loop: the variant of each node is selected with np.where.
+    """
+    def evaluate_nested_loop(self, index, settings, db_settings):
+        outer, inner = self.outer[index], self.inner[index]
+        num_input_tuples_rel_out, num_input_tuples_rel_in = self.row_count[outer], self.row_count[inner]
+        outer_is_scan = np.isin(self.model[outer], (CostBatch.MODELS.index('sequential_scan'), CostBatch.MODELS.index('sequential_scan_with_filter')))
+        materialized = outer_is_scan & (self.model[inner] == CostBatch.MODELS.index('materialize'))
+        indexed = outer_is_scan & (self.model[inner] == CostBatch.MODELS.index('index_scan'))
+
+        rescan_cost = settings['cpu_operator_cost'] * num_input_tuples_rel_out
+        materialized_cost = ((settings['cpu_operator_cost'] + settings['cpu_tuple_cost']) * num_input_tuples_rel_out * num_input_tuples_rel_in 
+                             + rescan_cost * (num_input_tuples_rel_in - 1) + self.total_cost[outer])
+        indexed_cost = (settings['cpu_tuple_cost'] + self.total_cost[inner]) * num_input_tuples_rel_out + self.total_cost[outer]
+        m = settings['work_mem'] / settings['block_size']
+        block_cost = (self.get_block_count(outer, settings) + self.get_block_count(inner, settings) * num_input_tuples_rel_out / m) * settings['seq_page_cost']
+        return np.where(materialized, materialized_cost, np.where(indexed, indexed_cost, block_cost))
+
+"""
+Class QueryCancelled is the exception raised by ExplainJob.run when the job has been cancelled.
+"""
+class QueryCancelled(Exception):
+    pass
+
+"""
+Class InvalidQuery is the exception raised by ExplainJob.run when the query cannot be planned, with the error of the server as its message.
+"""
+class InvalidQuery(Exception):
+    pass
+
+"""
+Class ExplainJob is the explain pipeline for one query: validation, EXPLAIN, Graph construction and rendering. 
+It is meant to be run on a worker thread: progress is reported through the on_progress callback (called from the worker thread) 
+and the query running on the server can be cancelled from any other thread.
+"""
+class ExplainJob:
+    """
+    The phases of the pipeline, in order.
+    """
+    PHASES = ('Validating query', 'Explaining query', 'Building graph', 'Rendering graph')
+
+    """
+    Constructor to instantiate an ExplainJob object. The statement_timeout is in milliseconds (None or 0 to disable).
+    """
+    def __init__(self, db: DB, query: str, mode: ExplainMode, epsilon, statement_timeout = None, on_progress = None):
+        self.db = db
+        self.query = query
+        self.mode = mode
+        self.epsilon = epsilon
+        self.statement_timeout = statement_timeout
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+        self.backend_pid = None
+        self.backend_lock = threading.Lock()
+
+    """
+    Method to report the start of a phase, and to stop the pipeline between phases if the job has been cancelled.
+    """
+    def report(self, phase):
+        if self.cancelled.is_set():
+            raise QueryCancelled()
+        if self.on_progress:
+            self.on_progress(phase, ExplainJob.PHASES.index(phase) + 1, len(ExplainJob.PHASES))
+
+    """
+    Method to run the pipeline. Returns the Graph and its GraphVisualizer, straight from the DB's PlanCache if the query has been explained before.
+    Raises InvalidQuery for an invalid query and QueryCancelled if the job has been cancelled. 
+    The query is only validated first when the mode executes it (see ExplainMode.is_executing), otherwise the EXPLAIN itself reports an invalid query.
+    """
+    def run(self):
+        cache_key = self.db.plan_cache.get_key(self.query, self.db.settings, self.mode, self.epsilon)
+        cached = self.db.plan_cache.get(cache_key)
+        if cached:
+            return cached
 
-        node = Node(query_plan, self.db, children, self.epsilon)
-        return node 
+        if self.mode.is_executing():
+            self.report('Validating query')
+            is_valid, exception = self.db.is_query_valid(self.query)
+            if not is_valid and self.cancelled.is_set():
+                raise QueryCancelled()
+            if not is_valid:
+                raise InvalidQuery(str(exception).strip())
+
+        try:
+            self.report('Explaining query')
+            try:
+                query_plan = self.db.get_query_plan(self.query, self.mode, self.statement_timeout, on_backend_pid=self.set_backend_pid)
+            except (psycopg2.ProgrammingError, psycopg2.DataError) as exception:
+                if self.mode.is_executing():
+                    raise
+                raise InvalidQuery(str(exception).strip())
+
+            self.report('Building graph')
+            graph = Graph(query_plan, self.db, epsilon=self.epsilon)
+
+            self.report('Rendering graph')
+            visualizer = GraphVisualizer(graph, render_cache=self.db.render_cache)
+        except psycopg2.extensions.QueryCanceledError:
+            if self.cancelled.is_set():
+                raise QueryCancelled()
+            raise
+        self.db.plan_cache.put(cache_key, graph, visualizer)
+        if self.cancelled.is_set():
+            raise QueryCancelled()
+        return graph, visualizer
+
+    """
+    Method to record the backend running the EXPLAIN, and to forget it (pid None) as soon as the EXPLAIN returns. 
+    If the job was cancelled while the connection was being borrowed, the query is cancelled right away.
+    """
+    def set_backend_pid(self, pid):
+        with self.backend_lock:
+            self.backend_pid = pid
+            if pid is not None and self.cancelled.is_set():
+                raise QueryCancelled()
+
+    """
+    Method to cancel the job. The EXPLAIN, if it is running on the server, is cancelled with pg_cancel_backend. 
+    The lock keeps the backend from being released to the pool (and reused by another query) while it is being cancelled.
+    """
+    def cancel(self):
+        self.cancelled.set()
+        with self.backend_lock:
+            if self.backend_pid is not None:
+                self.db.cancel_backend(self.backend_pid)
 
 """
 Class GraphVisualizer is a class to visualize the graph of the physical query plan by parsing the Graph object. 
@@ -968,25 +3128,372 @@ It leverages graphviz library to create the visualization of the graph
 """
 class GraphVisualizer: 
     """
-    Constructor to instantiate a GraphVisualizer object.
+    Size in pixels of the rendered image, the size of the graph in the GUI.
+    """
+    SIZE = (560, 560)
+
+    """
+    Resolution of the rendered image, which converts SIZE to the inches used by Graphviz.
+    """
+    DPI = 96
+
+    """
+    Constructor to instantiate a GraphVisualizer object. 
+    The graph is rendered in memory through the pipe of dot, as PNG bytes of exactly size pixels, or as SVG (format='svg'), which scales without resampling. 
+    With a render_cache, a graph whose DOT source has been rendered before is not rendered again.
     """
-    def __init__(self, graph):
-        self.graphviz = graphviz.Digraph('G', filename='qep', format='png')
-        self.graphviz.attr(rankdir='BT')
+    def __init__(self, graph, format = 'png', size = SIZE, render_cache: RenderCache = None):
+        self.format = format
+        self.size = size
+        self.graphviz = graphviz.Digraph('G', format=format)
+        # A size ending with '!' and ratio 'fill' stretch the layout to exactly the requested size, as the GUI displays it
+        self.graphviz.attr(rankdir='BT', size=f'{size[0] / GraphVisualizer.DPI},{size[1] / GraphVisualizer.DPI}!', ratio='fill', dpi=str(GraphVisualizer.DPI))
         self.parse_graph(graph.root)
-        self.graphviz.render('assets/img/qep')
+
+        if render_cache is None:
+            self.image = self.graphviz.pipe()
+            return
+        key = render_cache.get_key(self.graphviz.source, format, size)
+        self.image = render_cache.get(key)
+        if self.image is None:
+            self.image = self.graphviz.pipe()
+            render_cache.put(key, self.image)
 
     """
-    Method to parse the graph and create the visualization.
+    Method to parse the graph and create the visualization. The nodes are visited in pre-order with an explicit stack, 
+    each child being declared with its edge to its parent before its own subtree.
     """
-    def parse_graph(self, node: Node):
-        if not node.valid: 
-            self.graphviz.node(node.uuid, node.get_label(), fillcolor='cyan', style='filled')
-        else: 
-            self.graphviz.node(node.uuid, node.get_label(), fillcolor='green', style='filled')
-            
-        if node.children: 
-            for child in node.children: 
-                self.graphviz.node(child.uuid, child.node_type)
-                self.graphviz.edge(child.uuid, node.uuid)
-                self.parse_graph(child)
\ No newline at end of file
+    def parse_graph(self, root: Node):
+        stack = [(root, None)]
+        while stack:
+            node, parent = stack.pop()
+            if parent is not None:
+                self.graphviz.node(str(node.id), node.node_type)
+                self.graphviz.edge(str(node.id), str(parent.id))
+
+            if not node.valid: 
+                self.graphviz.node(str(node.id), node.get_label(), fillcolor='cyan', style='filled')
+            else: 
+                self.graphviz.node(str(node.id), node.get_label(), fillcolor='green', style='filled')
+
+            stack.extend((child, node) for child in reversed(node.children))
+
+"""
+Pattern of the tokens that can contain a semicolon without ending a statement: quoted strings and identifiers, dollar-quoted strings and comments.
+"""
+SQL_STATEMENT_TOKEN = re.compile(r"""
+    '(?:[^']|'')*'             # string literal
+    | "(?:[^"]|"")*"           # quoted identifier
+    | (\$\w*\$)[\s\S]*?\1      # dollar-quoted string
+    | --[^\n]*                 # line comment
+    | /\*[\s\S]*?\*/            # block comment
+    | ;
+""", re.VERBOSE)
+
+"""
+Pattern of SQL comments, used to drop the statements that only contain comments.
+"""
+SQL_COMMENT = re.compile(r'--[^\n]*|/\*[\s\S]*?\*/')
+
+"""
+Function to split a SQL script into its statements. Semicolons inside strings, dollar quotes and comments do not end a statement.
+"""
+def split_sql_statements(script: str):
+    statements = []
+    start = 0
+    for match in SQL_STATEMENT_TOKEN.finditer(script):
+        if match.group(0) == ';':
+            statements.append(script[start:match.start()])
+            start = match.end()
+    statements.append(script[start:])
+    return [statement.strip() for statement in statements if SQL_COMMENT.sub('', statement).strip()]
+
+"""
+Function to read the statements to explain from a .sql file, or from all .sql files of a directory (recursively, in sorted order). 
+Returns a list of (source file, statement number, statement).
+"""
+def read_sql_statements(path: str):
+    if os.path.isdir(path):
+        files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names if name.endswith('.sql'))
+    else:
+        files = [path]
+
+    statements = []
+    for file_path in files:
+        with open(file_path) as file:
+            for number, statement in enumerate(split_sql_statements(file.read()), start=1):
+                statements.append((file_path, number, statement))
+    return statements
+
+"""
+Function to get the JSON records of the nodes of a graph, in pre-order with the id of their parent. 
+The cost descriptions are only rendered when requested.
+"""
+def get_node_records(graph: Graph, descriptions = False):
+    parents = {child.id: node.id for node in graph.nodes for child in node.children}
+    records = []
+    for node in graph.nodes:
+        record = {
+            'id': node.id,
+            'parent': parents.get(node.id),
+            'node_type': node.node_type,
+            'relation': node.relation_name or None,
+            'estimated_cost': node.estimated_cost,
+            'psql_cost': node.total_cost,
+            'valid': node.valid,
+        }
+        if node.get_cost_model() == 'sort' and node.cost_terms is not None:
+            record['sort'] = node.get_sort_diagnostics()
+        if node.get_cost_model() == 'hash' and node.cost_terms is not None:
+            record['hash'] = node.get_hash_diagnostics()
+        if descriptions:
+            record['description'] = node.cost_description
+        records.append(record)
+    return records
+
+"""
+The DB connection of a batch worker process, opened once by init_batch_worker.
+"""
+BATCH_DB = None
+
+"""
+Function to initialize a batch worker process with its own DB connection.
+"""
+def init_batch_worker(config):
+    global BATCH_DB
+    BATCH_DB = DB(config)
+
+"""
+Function to explain one statement in a batch worker process: validation, EXPLAIN and Graph construction with the cost breakdown of every node. 
+Returns the JSON Lines record of the statement. As in ExplainJob.run, the statement is only validated first when the mode executes it.
+"""
+def explain_batch_statement(task):
+    source, number, query, mode, epsilon, statement_timeout = task
+    record = {'source': source, 'statement': number, 'query': query, 'valid': False, 'error': None, 'timings': {}}
+    started = time.perf_counter()
+
+    if mode.is_executing():
+        is_valid, exception = BATCH_DB.is_query_valid(query)
+        record['timings']['validate'] = time.perf_counter() - started
+        if not is_valid:
+            record['error'] = str(exception).strip()
+            return record
+
+    try:
+        phase_started = time.perf_counter()
+        query_plan = BATCH_DB.get_query_plan(query, mode, statement_timeout)
+        record['timings']['explain'] = time.perf_counter() - phase_started
+
+        phase_started = time.perf_counter()
+        graph = Graph(query_plan, BATCH_DB, epsilon=epsilon)
+        record['timings']['graph'] = time.perf_counter() - phase_started
+    except Exception as exception:
+        record['error'] = str(exception).strip()
+        return record
+
+    record['valid'] = True
+    record['total_cost'] = graph.root.total_cost
+    record['nodes'] = get_node_records(graph)
+    record['timings']['total'] = time.perf_counter() - started
+    return record
+
+"""
+Function to explain all statements found at path in parallel across a pool of worker processes, each with its own DB connection. 
+The records are written to output as JSON Lines, in the order of the statements. Returns the number of valid and invalid statements.
+"""
+def run_batch(config, path, output = sys.stdout, workers = None, mode = ExplainMode.ESTIMATE, epsilon = 1, statement_timeout = None):
+    statements = read_sql_statements(path)
+    tasks = [(source, number, query, mode, epsilon, statement_timeout) for source, number, query in statements]
+    # Each worker only runs one query at a time, two connections are enough for it
+    config = dict(config, pool_size=2)
+
+    valid_count = invalid_count = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(config,)) as executor:
+        for record in executor.map(explain_batch_statement, tasks, chunksize=8):
+            output.write(json.dumps(record) + '\n')
+            if record['valid']:
+                valid_count += 1
+            else:
+                invalid_count += 1
+    return valid_count, invalid_count
+
+"""
+Function to get the saved plan files found at path: a .json file, or a directory that is searched recursively for .json files.
+"""
+def get_saved_plan_files(path: str):
+    if os.path.isdir(path):
+        return sorted(os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names if name.endswith('.json'))
+    return [path]
+
+"""
+Function to read the saved plans found at path (see get_saved_plan_files). 
+A file holds the output of EXPLAIN (FORMAT JSON), a list of such outputs, or a single plan. Returns a list of (file, number, plan).
+"""
+def read_saved_plans(path: str):
+    plans = []
+    for file_path in get_saved_plan_files(path):
+        with open(file_path) as file:
+            content = loads_query_plan(file.read())
+        for number, entry in enumerate(content if isinstance(content, list) else [content], start=1):
+            if isinstance(entry, list):
+                entry = entry[0]
+            plans.append((file_path, number, entry['Plan'] if 'Plan' in entry else entry))
+    return plans
+
+"""
+Function to explain saved plans offline, with the settings and the catalog of a snapshot instead of a live database. 
+The records are written to output as JSON Lines, like run_batch does. Returns the number of explained and failed plans. 
+Without descriptions, the costs of all the plans are evaluated at once by a CostBatch; the descriptions need a Graph per plan.
+"""
+def run_offline(snapshot: Snapshot, path, output = sys.stdout, epsilon = 1, descriptions = False):
+    saved_plans = read_saved_plans(path)
+    if not descriptions:
+        batch = CostBatch([query_plan for _, _, query_plan in saved_plans], snapshot, epsilon)
+        estimated_cost, error = batch.evaluate()
+        valid = batch.get_valid(error)
+        sort_diagnostics = batch.get_sort_diagnostics()
+        hash_diagnostics = batch.get_hash_diagnostics()
+
+    valid_count = invalid_count = 0
+    for plan_id, (source, number, query_plan) in enumerate(saved_plans):
+        record = {'source': source, 'plan': number, 'valid': False, 'error': None}
+        try:
+            if descriptions:
+                nodes = get_node_records(Graph(query_plan, snapshot, epsilon=epsilon), descriptions)
+            else:
+                exception = batch.get_plan_error(plan_id, estimated_cost)
+                if exception is not None:
+                    raise exception
+                nodes = batch.get_node_records(plan_id, estimated_cost, valid, sort_diagnostics, hash_diagnostics)
+        except Exception as exception:
+            record['error'] = f'{type(exception).__name__}: {exception}'
+            invalid_count += 1
+        else:
+            record['valid'] = True
+            record['total_cost'] = query_plan['Total Cost']
+            record['nodes'] = nodes
+            valid_count += 1
+        output.write(json.dumps(record) + '\n')
+    return valid_count, invalid_count
+
+"""
+Number of most expensive nodes reported by a what-if simulation.
+"""
+WHAT_IF_TOP_NODES = 5
+
+"""
+Function to get the points of a grid of settings: the dict of every combination of the values of each setting, e.g. 
+{'random_page_cost': ['1.1', '4'], 'work_mem': ['4MB', '64MB']} has four points.
+"""
+def get_settings_grid(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+"""
+Function to rank the nodes of a simulated plan by their own cost (see Node.get_own_cost), most expensive first. 
+Returns the node ids in rank order.
+"""
+def get_cost_ranking(nodes):
+    own_costs = {node.id: node.get_own_cost() for node in nodes}
+    return sorted(own_costs, key=lambda node_id: (-own_costs[node_id], node_id))
+
+"""
+The snapshot of a what-if worker process, loaded once by init_what_if_worker.
+"""
+WHAT_IF_SNAPSHOT = None
+
+"""
+Function to initialize a what-if worker process with the snapshot.
+"""
+def init_what_if_worker(snapshot_content):
+    global WHAT_IF_SNAPSHOT
+    WHAT_IF_SNAPSHOT = Snapshot.from_dict(snapshot_content)
+
+"""
+Function to get the JSON Lines record of a plan (or of a whole file when number is None) that failed at a point of a settings grid.
+"""
+def get_what_if_error_record(source, number, point, exception):
+    return {'source': source, 'plan': number, 'settings': point, 'valid': False, 'error': f'{type(exception).__name__}: {exception}'}
+
+"""
+Function to simulate the plans of one saved plan file at every point of a settings grid in a what-if worker process. 
+The file is read and parsed in the worker, so that only its path is sent to the process: a deep plan could not be pickled. 
+Returns the JSON Lines records of the plans of the file, one per plan and point in this order (one per point if the file cannot be read).
+"""
+def simulate_what_if_file(task):
+    source, points, epsilon = task
+    try:
+        plans = read_saved_plans(source)
+    except Exception as exception:
+        return [get_what_if_error_record(source, None, point, exception) for point in points]
+
+    records = []
+    for source, number, query_plan in plans:
+        records.extend(simulate_what_if_plan(source, number, query_plan, points, epsilon))
+    return records
+
+"""
+Function to simulate one plan at every point of a settings grid. 
+Every point is compared with the simulation at the settings of the snapshot: the change of the total cost of the plan and of the ranking of its nodes. 
+Returns the JSON Lines records of the plan, one per point, with an error record for each point whose simulation failed.
+"""
+def simulate_what_if_plan(source, number, query_plan, points, epsilon):
+    try:
+        graph = Graph(query_plan, WHAT_IF_SNAPSHOT, epsilon=epsilon)
+        baseline = graph.simulate(WHAT_IF_SNAPSHOT.settings)
+    except Exception as exception:
+        return [get_what_if_error_record(source, number, point, exception) for point in points]
+
+    baseline_ranking = get_cost_ranking(baseline)
+    baseline_ranks = {node_id: rank for rank, node_id in enumerate(baseline_ranking)}
+    records = []
+    for point in points:
+        try:
+            nodes = graph.simulate(WHAT_IF_SNAPSHOT.settings.override(point))
+        except Exception as exception:
+            records.append(get_what_if_error_record(source, number, point, exception))
+            continue
+        ranking = get_cost_ranking(nodes)
+        rank_shifts = {node_id: baseline_ranks[node_id] - rank for rank, node_id in enumerate(ranking) if baseline_ranks[node_id] != rank}
+        records.append({
+            'source': source,
+            'plan': number,
+            'settings': point,
+            'valid': True,
+            'error': None,
+            'baseline_total_cost': baseline[0].total_cost,
+            'total_cost': nodes[0].total_cost,
+            'total_cost_ratio': nodes[0].total_cost / baseline[0].total_cost if baseline[0].total_cost else None,
+            'top_nodes': [{'id': node_id, 'node_type': nodes[node_id].node_type, 'baseline_rank': baseline_ranks[node_id]} 
+                          for node_id in ranking[:WHAT_IF_TOP_NODES]],
+            'top_node_changed': ranking[0] != baseline_ranking[0],
+            'rank_changes': len(rank_shifts),
+            'max_rank_shift': max(map(abs, rank_shifts.values()), default=0),
+        })
+    return records
+
+"""
+Function to sweep a grid of settings (see get_settings_grid) over the saved plans found at path, in parallel across worker processes, 
+with the settings and the catalog of a snapshot. The records are written to output as JSON Lines, one per plan and point. 
+Returns the summary of each point: (point, number of plans, mean total cost ratio, number of plans whose most expensive node changed).
+"""
+def run_what_if(snapshot: Snapshot, path, grid, output = sys.stdout, workers = None, epsilon = 1):
+    points = get_settings_grid(grid)
+    # Invalid settings are reported before any plan is simulated
+    for point in points:
+        snapshot.settings.override(point)
+    tasks = [(source, points, epsilon) for source in get_saved_plan_files(path)]
+
+    ratios = [[] for _ in points]
+    top_node_changes = [0] * len(points)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_what_if_worker, initargs=(snapshot.to_dict(),)) as executor:
+        for records in executor.map(simulate_what_if_file, tasks):
+            # The records of a file are grouped by plan, each plan having one record per point
+            for point_id, record in zip(itertools.cycle(range(len(points))), records):
+                output.write(json.dumps(record) + '\n')
+                if record['valid'] and record['total_cost_ratio'] is not None:
+                    ratios[point_id].append(record['total_cost_ratio'])
+                    top_node_changes[point_id] += record['top_node_changed']
+
+    return [(point, len(point_ratios), sum(point_ratios) / len(point_ratios) if point_ratios else None, top_node_changed)
+            for point, point_ratios, top_node_changed in zip(points, ratios, top_node_changes)]
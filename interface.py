@@ -1,7 +1,13 @@
 import ttkbootstrap as ttk
 import tkinter as tk
+import io
+import queue
+import re
+import time
+import threading
 from tkinter import messagebox
-from explain import DB, Graph, GraphVisualizer, Node
+from psycopg2.extensions import QueryCanceledError
+from explain import DB, Catalog, ExplainJob, ExplainMode, Graph, GraphVisualizer, InvalidQuery, Node, QueryCancelled
 from PIL import ImageTk, Image
 
 TEXT_PRIMARY_COLOR = "#F9F9F9"
@@ -79,28 +85,91 @@ Class QueryExplanation is a component that contains the query plan treeview and
 """
 class QueryExplanation(ttk.Frame):
     """
-    Method to recursively update the treeview.
+    Static variable that contains the suffix of the item id of the placeholder child of a node whose children are not inserted yet, 
+    which makes the node expandable.
     """
-    def __recursive_update(self, node: Node, parent):
-        def callback(event):
-            self.selected_node = node
-            self.query_explanation.config(state=tk.NORMAL)
-            self.query_explanation.delete("1.0", ttk.END)
-            self.query_explanation.insert(tk.INSERT, node.cost_description)
-            self.query_explanation.config(state=tk.DISABLED)
+    PLACEHOLDER = ":placeholder"
 
-        curnode = self.query_selection_tree.insert(parent, "end", text=node.node_type, values=(node.startup_cost, node.total_cost, node.row_count), tags=(node.node_type, node.uuid))
-        self.query_selection_tree.tag_bind(node.uuid, "<<TreeviewSelect>>", callback=callback)
-        for child in node.children:
-            self.__recursive_update(child, curnode)
+    """
+    Method to show the cost description of the selected node.
+    """
+    def __on_select(self, event):
+        selection = self.query_selection_tree.selection()
+        node = self.tree_nodes.get(selection[0]) if selection else None
+        if node is None:
+            return
+        self.selected_node = node
+        self.query_explanation.config(state=tk.NORMAL)
+        self.query_explanation.delete("1.0", ttk.END)
+        self.query_explanation.insert(tk.INSERT, node.cost_description)
+        self.query_explanation.config(state=tk.DISABLED)
+
+    """
+    Method to insert the children of a node when it is expanded for the first time, and to hide its subtree summary while it is expanded.
+    """
+    def __on_open(self, event):
+        iid = self.query_selection_tree.focus()
+        node = self.tree_nodes.get(iid)
+        if node is None:
+            return
+        self.query_selection_tree.set(iid, "subtree", "")
+        if self.query_selection_tree.exists(iid + QueryExplanation.PLACEHOLDER):
+            self.query_selection_tree.delete(iid + QueryExplanation.PLACEHOLDER)
+            for child in node.children:
+                self.__insert_node(child, iid)
+
+    """
+    Method to show the subtree summary of a node when it is collapsed.
+    """
+    def __on_close(self, event):
+        iid = self.query_selection_tree.focus()
+        node = self.tree_nodes.get(iid)
+        if node is not None:
+            self.query_selection_tree.set(iid, "subtree", self.__get_subtree_summary(node))
+
+    """
+    Method to get the summary of the subtree of a node: the number of nodes, the total cost of the children and the number of rows estimated in the subtree.
+    """
+    def __get_subtree_summary(self, node: Node):
+        if not node.children:
+            return ""
+        node_count, row_count = self.subtree_sizes[node.id]
+        cost = round(sum(child.total_cost for child in node.children), 2)
+        return f"{node_count} nodes, cost {cost}, {row_count} rows"
 
     """
-    Method to update the treeview.
+    Method to insert a node in the treeview, collapsed. Its children are inserted when it is expanded.
+    """
+    def __insert_node(self, node: Node, parent):
+        iid = str(node.id)
+        self.tree_nodes[iid] = node
+        self.query_selection_tree.insert(parent, "end", iid=iid, text=node.node_type, values=(node.startup_cost, node.total_cost, node.row_count, self.__get_subtree_summary(node)), tags=(node.node_type,))
+        if node.children:
+            self.query_selection_tree.insert(iid, "end", iid=iid + QueryExplanation.PLACEHOLDER, text="...")
+
+    """
+    Method to update the treeview. Only the root and its children are inserted, the other nodes are inserted when their parent is expanded, 
+    so that large plans are shown immediately.
     """
     def update_treeview(self, event):
-        root: Node = self.master.master.master.master.inner_state.graph.root
+        graph: Graph = self.master.master.master.master.inner_state.graph
         self.query_selection_tree.delete(*self.query_selection_tree.get_children())
-        self.__recursive_update(root, "")
+        self.tree_nodes = {}
+
+        # The number of nodes and rows of every subtree, children first (graph.nodes is in pre-order)
+        self.subtree_sizes = {}
+        for node in reversed(graph.nodes):
+            node_count, row_count = 0, 0
+            for child in node.children:
+                child_node_count, child_row_count = self.subtree_sizes[child.id]
+                node_count += child_node_count + 1
+                row_count += child_row_count + child.row_count
+            self.subtree_sizes[node.id] = (node_count, row_count)
+
+        self.__insert_node(graph.root, "")
+        self.query_selection_tree.focus(str(graph.root.id))
+        self.__on_open(None)
+        self.query_selection_tree.item(str(graph.root.id), open=True)
 
     """
     Constructor to instantiate the QueryExplanation class.
@@ -109,6 +178,8 @@ class QueryExplanation(ttk.Frame):
         super().__init__(*args, **kwargs)
         self.pack(expand=True, fill="both")
         self.selected_node = None
+        self.tree_nodes = {}
+        self.subtree_sizes = {}
         """
         self
         |-> query_selection_frame   
@@ -120,7 +191,7 @@ class QueryExplanation(ttk.Frame):
         self.query_selection_frame = ttk.Frame(self, width=5)
         self.query_selection_frame.pack(side = ttk.LEFT, fill="y", padx=(0, 16))
 
-        self.query_selection_tree = ttk.Treeview(self.query_selection_frame, columns=("startup", "cost", "rows"), height=50)
+        self.query_selection_tree = ttk.Treeview(self.query_selection_frame, columns=("startup", "cost", "rows", "subtree"), height=50)
         self.query_selection_tree.heading("#0", text="Query Plan")
         self.query_selection_tree.column("#0", width=150)
         self.query_selection_tree.heading("#1", text="Startup Cost")
@@ -129,8 +200,13 @@ class QueryExplanation(ttk.Frame):
         self.query_selection_tree.column("#2", width=120)
         self.query_selection_tree.heading("#3", text="Rows")
         self.query_selection_tree.column("#3", width=80)
+        self.query_selection_tree.heading("#4", text="Collapsed Subtree")
+        self.query_selection_tree.column("#4", width=220)
         
-        # Onclick event (based on tags)
+        # Onclick event
+        self.query_selection_tree.bind("<<TreeviewSelect>>", self.__on_select)
+        self.query_selection_tree.bind("<<TreeviewOpen>>", self.__on_open)
+        self.query_selection_tree.bind("<<TreeviewClose>>", self.__on_close)
         self.query_selection_tree.pack(side = ttk.LEFT, fill="y")
 
         self.query_explanation_frame = ttk.Frame(self)
@@ -147,6 +223,90 @@ class QueryExplanation(ttk.Frame):
 Class QueryTable is a component that contains the statistics of the database and the schema of the database.
 """
 class QueryTable(ttk.Frame):
+    """
+    Static variable that contains the delay (in milliseconds) after the last key typed in the relation filter before the relations are filtered.
+    """
+    FILTER_DELAY = 150
+
+    """
+    Static variable that contains the catalog columns shown in the statistics table.
+    """
+    STATISTICS_COLUMNS = ["relname", "relpages", "reltuples", "relhasindex"]
+
+    """
+    Method to refresh the statistics of the database. Only the tables whose statistics changed are reloaded, 
+    and the catalog notifies its observers (see __on_statistics_changed).
+    """
+    def __refresh_statistics(self):
+        db_con: DB = self.master.master.master.master.inner_state.db_connection
+        try:
+            db_con.refresh_statistics()
+        except Exception:
+            messagebox.showerror("Error", "An error has occured while refreshing the statistics")
+
+    """
+    Method to update the rows of the tables that changed in the catalog: the rows of reloaded tables are updated, 
+    the rows of new tables are added and the rows of dropped tables are removed. The other rows are left untouched.
+    """
+    def __on_statistics_changed(self, oids):
+        for oid in oids:
+            iid = str(oid)
+            relation = self.catalog.relations.get(oid)
+            if relation is None or relation['relkind'] not in Catalog.TABLE_KINDS:
+                if self.table.exists(iid):
+                    self.table.delete(iid)
+            elif self.table.exists(iid):
+                self.table.item(iid, values=[relation[column] for column in QueryTable.STATISTICS_COLUMNS])
+            else:
+                self.table.insert("", "end", iid=iid, values=[relation[column] for column in QueryTable.STATISTICS_COLUMNS])
+
+    """
+    Method to stop observing the catalog when the table is destroyed (e.g. on disconnection).
+    """
+    def __on_destroy(self, event):
+        if event.widget is self:
+            self.catalog.unsubscribe(self.__on_statistics_changed)
+
+    """
+    Method to schedule the filtering of the relations after a key is typed in the relation filter. Keys typed less than FILTER_DELAY apart filter once.
+    """
+    def __on_filter_key(self, event):
+        if self.schema_filter_timer is not None:
+            self.after_cancel(self.schema_filter_timer)
+        self.schema_filter_timer = self.after(QueryTable.FILTER_DELAY, self.__filter_relations)
+
+    """
+    Method to show the relations whose name contains the text of the relation filter (case insensitive), collapsed. 
+    Relations outside of the public schema are shown with their schema.
+    """
+    def __filter_relations(self):
+        self.schema_filter_timer = None
+        text = self.schema_filter.get()
+        if self.schema_filter.is_empty and text == self.schema_filter.placeholder:
+            text = ""
+
+        self.schema_table.delete(*self.schema_table.get_children())
+        self.schema_relations = {}
+        for schema, relation_name in self.schema_columns:
+            name = relation_name if schema == "public" else f"{schema}.{relation_name}"
+            if text.lower() in name.lower():
+                iid = self.schema_table.insert("", "end", values=[name, "", "", ""])
+                self.schema_relations[iid] = (schema, relation_name)
+                # Placeholder child that makes the relation expandable
+                self.schema_table.insert(iid, "end", values=["", "...", "", ""])
+
+    """
+    Method to insert the columns of a relation when it is expanded for the first time.
+    """
+    def __on_relation_open(self, event):
+        iid = self.schema_table.focus()
+        relation = self.schema_relations.pop(iid, None)
+        if relation is None:
+            return
+        self.schema_table.delete(*self.schema_table.get_children(iid))
+        for column_name, column_type, statistics_target in self.schema_columns[relation]:
+            self.schema_table.insert(iid, "end", values=["", column_name, column_type, "default" if statistics_target < 0 else statistics_target])
+
     """
     Constructor to instantiate the QueryTable class.    
     """
@@ -167,15 +327,16 @@ class QueryTable(ttk.Frame):
         self.query_table = ttk.Frame(self.notebook, width=720, height=1000)
         self.query_table.pack(fill="y")
         db_con: DB = self.master.master.master.master.inner_state.db_connection
-        statistic = db_con.get_statistics()
 
-        # Generate table for Relation Statistics
-        header = ["relname", "relpages", "reltuples", "relhasindex"]
-        content = []
-        for val in statistic.values():
-            content.append([val[header_keys] for header_keys in header])
+        # Generate table for Relation Statistics from the catalog shared with the rest of the application, updated when it changes
+        self.catalog = db_con.statistics
+        self.catalog.subscribe(self.__on_statistics_changed)
+        self.bind("<Destroy>", self.__on_destroy)
 
-        self.table = ttk.Treeview(self.query_table, columns=header, show="headings")
+        self.refresh_button = ttk.Button(self.query_table, text="Refresh Statistics", command=self.__refresh_statistics)
+        self.refresh_button.pack(side = ttk.TOP, anchor=ttk.E, pady=4)
+
+        self.table = ttk.Treeview(self.query_table, columns=QueryTable.STATISTICS_COLUMNS, show="headings")
         self.table.pack(fill="both", expand=True)
         self.table.heading("#0", text="")
         self.table.heading("#1", text="Name")
@@ -187,16 +348,22 @@ class QueryTable(ttk.Frame):
         self.table.heading("#4", text="Has Index")
         self.table.column("#4", width=25, anchor=tk.W)
 
-        for row in content:
-            self.table.insert("", "end", values=row)
+        for relation in self.catalog.tables():
+            self.table.insert("", "end", iid=str(relation['oid']), values=[relation[column] for column in QueryTable.STATISTICS_COLUMNS])
 
-        # Generate table for Schemas
-        relations = db_con.get_table_names()
+        # Generate table for Schemas. The columns of all relations are loaded with one query, and inserted when their relation is expanded
+        self.schema_columns = db_con.get_schema_columns()
+        self.schema_relations = {}
+        self.schema_filter_timer = None
         
         self.schema_table_frame = ttk.Frame(self.notebook, width=480, height=1000)
         self.schema_table_frame.pack(fill="y")
 
-        self.schema_table = ttk.Treeview(self.schema_table_frame, columns=["Relation", "Column"], show="tree headings")
+        self.schema_filter = Input(self.schema_table_frame, placeholder="Filter relations")
+        self.schema_filter.pack(side = ttk.TOP, fill="x", pady=4)
+        self.schema_filter.bind("<KeyRelease>", self.__on_filter_key)
+
+        self.schema_table = ttk.Treeview(self.schema_table_frame, columns=["Relation", "Column", "Type", "Statistics Target"], show="tree headings")
         self.schema_table.pack(fill="both", expand=True)
 
         self.schema_table.column("#0", width=40, anchor=tk.W)
@@ -204,97 +371,325 @@ class QueryTable(ttk.Frame):
         self.schema_table.column("#1", width=40, anchor=tk.W)
         self.schema_table.heading("#2", text="Column")
         self.schema_table.column("#2", width=40, anchor=tk.W)
+        self.schema_table.heading("#3", text="Type")
+        self.schema_table.column("#3", width=40, anchor=tk.W)
+        self.schema_table.heading("#4", text="Statistics Target")
+        self.schema_table.column("#4", width=40, anchor=tk.W)
+        self.schema_table.bind("<<TreeviewOpen>>", self.__on_relation_open)
 
-        for relation in relations:
-            columns = db_con.get_column_names(relation)
-            par = self.schema_table.insert("", "end", values=[relation, ""])    
-            for column in columns:
-                self.schema_table.insert(par, "end", values=["", column])
-
+        self.__filter_relations()
 
         self.notebook.add(self.query_table, text="Statistics")
         self.notebook.add(self.schema_table_frame, text="Schemas")
 
         
+"""
+The SQL keywords for highlighting. Keywords of several words match with any spaces or tabs between the words.
+"""
+SQL_KEYWORDS = ["SELECT", "FROM", "WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT", "OFFSET", "JOIN", "INNER JOIN", "LEFT JOIN", "RIGHT JOIN", "FULL JOIN", "CROSS JOIN", "NATURAL JOIN", "USING", "ON", "AS", "AND", "OR", "NOT", "IN", "LIKE", "BETWEEN", "IS", "NULL", "EXISTS", "ALL", "ANY", "SOME", "UNION", "INTERSECT", "EXCEPT", "INSERT", "INTO", "VALUES", "UPDATE", "SET", "DELETE", "CREATE", "TABLE", "DROP", "ALTER", "ADD", "PRIMARY KEY", "FOREIGN KEY", "REFERENCES", "INDEX", "UNIQUE", "CHECK", "DEFAULT", "AUTO_INCREMENT", "CURRENT_TIMESTAMP", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_USER", "DATABASE", "IF", "THEN", "ELSE", "END", "CASE", "WHEN", "WHILE", "DO", "BEGIN", "DECLARE", "CURSOR", "OPEN", "CLOSE", "FETCH", "LOOP", "EXIT", "CONTINUE", "GOTO", "RETURN", "CALL", "PROCEDURE", "FUNCTION", "TRIGGER", "EVENT", "HANDLER", "REPLACE", "GRANT", "REVOKE", "PRIVILEGES", "WITH", "OPTION", "LOCK", "UNLOCK", "START", "TRANSACTION", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "ISOLATION", "LEVEL", "READ", "WRITE", "ONLY", "REPEATABLE", "COMMITTED", "SERIALIZABLE", "AUTOCOMMIT", "SHOW", "STATUS", "VARIABLES", "DATABASES", "TABLES", "INDEXES", "GRANTS", "PROCESSLIST", "KILL", "SHUTDOWN", "LOGS", "ERRORS", "WARNINGS", "SLAVE", "MASTER", "REPLICATION", "BINARY", "LOG", "POSITION", "FILE", "FORMAT", "PASSWORD", "USER", "HOST", "PRIVILEGE", "RELOAD", "FLUSH", "STATISTICS", "QUERY", "CACHE", "MEMORY"]
+
+"""
+The keywords of a single word, upper case.
+"""
+SQL_SINGLE_WORD_KEYWORDS = frozenset(keyword for keyword in SQL_KEYWORDS if " " not in keyword)
+
+"""
+The keywords of several words, by their first word: the patterns that match the rest of the keyword after the first word, longest first.
+"""
+SQL_MULTI_WORD_KEYWORDS = {}
+for keyword in sorted((keyword for keyword in SQL_KEYWORDS if " " in keyword), key=len, reverse=True):
+    first_word, *other_words = keyword.split()
+    SQL_MULTI_WORD_KEYWORDS.setdefault(first_word, []).append(
+        re.compile(r"[ \t]+" + r"[ \t]+".join(other_words) + r"(?![\w$])", re.IGNORECASE))
+
+"""
+Pattern of the tokens that matter for highlighting a line of SQL: words (which are keywords or not), and the openings of strings, 
+quoted identifiers, dollar-quoted strings and comments, whose content is never highlighted.
+"""
+SQL_HIGHLIGHT_TOKEN = re.compile(r"""
+    (?<![\w$])(?P<word>[A-Za-z_][\w$]*)
+    | (?P<line_comment>--)
+    | (?P<opening>'|"|/\*|\$\w*\$)
+""", re.VERBOSE)
+
+"""
+Patterns of the end of the strings, quoted identifiers and block comments that span several lines, by their opening. 
+Dollar-quoted strings end with their opening tag.
+"""
+SQL_CLOSINGS = {
+    "'": re.compile(r"[^']*(?:''[^']*)*'(?!')"),
+    '"': re.compile(r'[^"]*(?:""[^"]*)*"(?!")'),
+    "/*": re.compile(r"[\s\S]*?\*/"),
+}
+
+"""
+Function to find the keywords of a line of SQL. The state is the opening of the string or comment the line starts in (None outside of them). 
+Returns the (start, end) columns of the keywords and the state at the end of the line.
+"""
+def scan_sql_line(line, state = None):
+    spans = []
+    position = 0
+    while True:
+        if state is not None:
+            if state in SQL_CLOSINGS:
+                closing = SQL_CLOSINGS[state].match(line, position)
+                end = closing.end() if closing else -1
+            else:
+                end = line.find(state, position)
+                end = end + len(state) if end >= 0 else -1
+            if end < 0:
+                return spans, state
+            position, state = end, None
+
+        match = SQL_HIGHLIGHT_TOKEN.search(line, position)
+        if not match or match.group("line_comment"):
+            return spans, None
+        position = match.end()
+        if match.group("opening"):
+            state = match.group("opening")
+            continue
+
+        word = match.group("word").upper()
+        for other_words in SQL_MULTI_WORD_KEYWORDS.get(word, ()):
+            other_words_match = other_words.match(line, position)
+            if other_words_match:
+                position = other_words_match.end()
+                spans.append((match.start(), position))
+                break
+        else:
+            if word in SQL_SINGLE_WORD_KEYWORDS:
+                spans.append((match.start(), position))
+
 """
 Class SQLInput is a component that contains the input field for the SQL query.
 """
 class SQLInput(ttk.Frame):
     
     """
-    Static variable that contains the SQL keywords for highlighting.
+    Static variable that contains the interval (in milliseconds) at which the events of the running query are polled.
     """
-    SQL_KEYWORDS = ["SELECT", "FROM", "WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT", "OFFSET", "JOIN", "INNER JOIN", "LEFT JOIN", "RIGHT JOIN", "FULL JOIN", "CROSS JOIN", "NATURAL JOIN", "USING", "ON", "AS", "AND", "OR", "NOT", "IN", "LIKE", "BETWEEN", "IS", "NULL", "EXISTS", "ALL", "ANY", "SOME", "UNION", "INTERSECT", "EXCEPT", "INSERT", "INTO", "VALUES", "UPDATE", "SET", "DELETE", "CREATE", "TABLE", "DROP", "ALTER", "ADD", "PRIMARY KEY", "FOREIGN KEY", "REFERENCES", "INDEX", "UNIQUE", "CHECK", "DEFAULT", "AUTO_INCREMENT", "CURRENT_TIMESTAMP", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_USER", "DATABASE", "IF", "EXISTS", "THEN", "ELSE", "END", "CASE", "WHEN", "WHILE", "DO", "BEGIN", "DECLARE", "CURSOR", "OPEN", "CLOSE", "FETCH", "LOOP", "EXIT", "CONTINUE", "GOTO", "RETURN", "CALL", "PROCEDURE", "FUNCTION", "TRIGGER", "EVENT", "HANDLER", "REPLACE", "GRANT", "REVOKE", "PRIVILEGES", "WITH", "OPTION", "LOCK", "UNLOCK", "START", "TRANSACTION", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "ISOLATION", "LEVEL", "READ", "WRITE", "ONLY", "REPEATABLE", "COMMITTED", "SERIALIZABLE", "AUTOCOMMIT", "SHOW", "STATUS", "VARIABLES", "DATABASES", "TABLES", "INDEXES", "GRANTS", "PROCESSLIST", "KILL", "SHUTDOWN", "LOGS", "ERRORS", "WARNINGS", "SLAVE", "MASTER", "REPLICATION", "BINARY", "LOG", "POSITION", "FILE", "FORMAT", "PASSWORD", "USER", "HOST", "PRIVILEGE", "RELOAD", "FLUSH", "LOGS", "TABLES", "STATISTICS", "QUERY", "CACHE", "MEMORY"] 
-    
+    POLL_INTERVAL = 50
+
     """
-    Method to execute the query.
+    Static variable that contains the delay (in milliseconds) after the last modification of the query input before it is highlighted.
     """
-    def __execute_query(self, event):
+    HIGHLIGHT_DELAY = 100
+
+    """
+    Static variable that contains the time budget (in seconds) of a highlighting step, below the duration of a frame.
+    """
+    HIGHLIGHT_BUDGET = 0.008
+
+    """
+    Method to reset the connection after an error. If it cannot be reset, the connection is closed and the user is logged out.
+    """
+    def __reset_connection(self):
         db: DB = self.master.master.master.master.inner_state.db_connection
-        def reset_connection():
+        try:
+            db.reset_connection()
+        except Exception:
+            messagebox.showerror("Error", "An error when resetting the connection")
+            # The pool is closed before it is dropped, so that its connections and its health check thread do not leak
             try:
-                db.reset_connection()
-            except:
-                messagebox.showerror("Error", "An error when resetting the connection")
-                self.master.master.master.master.inner_state.db_connection = None
-
-                # Refresh
-                self.master.master.master.master.refresh_content_layout()
-                return
-            
+                db.close_connection()
+            except Exception:
+                pass
+            self.master.master.master.master.inner_state.db_connection = None
+
+            # Refresh
+            self.master.master.master.master.refresh_content_layout()
+
+    """
+    Method to execute the query. 
+    The explain pipeline (ExplainJob) runs on a worker thread so that the window stays responsive, its events are polled by __poll_job.
+    """
+    def __execute_query(self, event):
+        if self.job is not None:
+            return
+
+        db: DB = self.master.master.master.master.inner_state.db_connection
         query = self.query_input.get("1.0", "end-1c")
-        
-        if db.is_query_valid(query)[0] is False:
-            messagebox.showerror("Error", "Invalid query")
-            reset_connection()
-            return 
-        
+        mode = ExplainMode(self.mode_input.get())
         try:
-            query_plan = self.master.master.master.master.inner_state.db_connection.get_query_plan(query) # forgive me
-        except:
-            messagebox.showerror("Error", "An error has occured during the execution of the query")
-            reset_connection()
+            epsilon = float(self.epsilon_input.get())
+            statement_timeout = float(self.timeout_input.get() or 0) * 1000
+        except ValueError:
+            messagebox.showerror("Error", "Epsilon and timeout must be numbers")
             return
-        
-        epsilon = float(self.epsilon_input.get())
 
-        try:
-            graph = Graph(query_plan, self.master.master.master.master.inner_state.db_connection, epsilon=epsilon)
-            self.master.master.master.master.inner_state.graph = graph
+        def on_progress(phase, step, total):
+            self.job_events.put(("progress", f"{phase}... ({step}/{total})"))
 
-            graphviz = GraphVisualizer(graph)
+        job = ExplainJob(db, query, mode, epsilon, statement_timeout, on_progress=on_progress)
 
-            self.master.master.master.refresh_query_content()
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
-            reset_connection()
-            
+        def run():
+            try:
+                self.job_events.put(("done", job.run()))
+            except Exception as exception:
+                self.job_events.put(("error", exception))
+
+        self.job = job
+        self.execute_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        threading.Thread(target=run, daemon=True).start()
+        self.after(SQLInput.POLL_INTERVAL, self.__poll_job)
+
+    """
+    Method to cancel the running query. pg_cancel_backend needs its own connection, so it is sent from a worker thread as well.
+    """
+    def __cancel_query(self, event):
+        if self.job is None or self.job.cancelled.is_set():
+            return
+        self.progress_label.config(text="Cancelling...")
+        threading.Thread(target=self.job.cancel, daemon=True).start()
+
+    """
+    Method to process the events of the running job on the Tk main loop.
+    """
+    def __poll_job(self):
+        while not self.job_events.empty():
+            event, payload = self.job_events.get()
+            if event == "progress":
+                self.progress_label.config(text=payload)
+                continue
+
+            self.job = None
+            self.execute_button.config(state="normal")
+            self.cancel_button.config(state="disabled")
+            if event == "done":
+                self.progress_label.config(text="")
+                self.__show_result(*payload)
+            else:
+                self.__show_error(payload)
+            return
+
+        self.after(SQLInput.POLL_INTERVAL, self.__poll_job)
+
+    """
+    Method to show the graph of an executed query.
+    """
+    def __show_result(self, graph: Graph, visualizer: GraphVisualizer):
+        self.master.master.master.master.inner_state.graph = graph
+        self.master.master.master.master.inner_state.graph_visualizer = visualizer
+        self.master.master.master.refresh_query_content()
         self.master.master.master.query_explanation.update_treeview(None)
-    
+
     """
-    Method to highlight the keywords in the query input.
-    """
-    def highlight_keywords(self, event):
-        # Remove all tags
-        self.query_input.tag_remove("keyword", "1.0", "end")
-
-        for keyword in SQLInput.SQL_KEYWORDS:
-            start_idx = "1.0"
-            while True:
-                start_idx = self.query_input.search(keyword, start_idx, stopindex="end", nocase=1)
-                
-                if not start_idx:
-                    break
-                end_idx = f"{start_idx}+{len(keyword)}c"
-                # Get the previous and next characters
-                prev_char = self.query_input.get(f"{start_idx}-1c") if start_idx != "1.0" else ""
-                next_char = self.query_input.get(end_idx)
-
-                # Check if they are whitespace characters
-                if (not prev_char or prev_char.isspace()) and (not next_char or next_char.isspace()):
-                    self.query_input.tag_add("keyword", start_idx, end_idx)
-                start_idx = end_idx
-    
+    Method to show the error of a failed query. Unexpected errors reset the connection.
+    """
+    def __show_error(self, exception):
+        if isinstance(exception, QueryCancelled):
+            self.progress_label.config(text="Cancelled")
+        elif isinstance(exception, QueryCanceledError):
+            self.progress_label.config(text="")
+            messagebox.showerror("Error", "The query was cancelled because it exceeded the statement timeout")
+        elif isinstance(exception, InvalidQuery):
+            self.progress_label.config(text="")
+            messagebox.showerror("Error", f"Invalid query: {exception}")
+        else:
+            self.progress_label.config(text="")
+            messagebox.showerror("Error", f"An error has occured during the execution of the query: {type(exception).__name__}: {exception}")
+            self.__reset_connection()
+
+    """
+    Method that replaces the Tcl command of the query input, to see every insert and delete before Tk applies it, 
+    including the ones of the default bindings (typing, pasting, cutting, undo). The changed lines are then highlighted.
+    """
+    def __on_edit(self, operation, *arguments):
+        command = self.query_input_command
+        try:
+            if operation not in ("insert", "delete", "replace"):
+                return self.tk.call((command, operation) + arguments)
+
+            line_count = self.__get_line(command, "end-1c")
+            if operation == "insert":
+                indices = arguments[:1]
+            elif operation == "replace":
+                indices = arguments[:2]
+            else:
+                # Without an end index, delete removes the character at the index, which can be a line break
+                indices = arguments if len(arguments) > 1 else (arguments[0], f"{arguments[0]} +1c")
+            lines = [min(self.__get_line(command, index), line_count) for index in indices]
+            result = self.tk.call((command, operation) + arguments)
+            self.__mark_changed(min(lines) - 1, max(lines) - 1, self.__get_line(command, "end-1c") - line_count)
+            return result
+        except tk.TclError:
+            # As in the default bindings, an invalid index (e.g. sel.first without a selection) does nothing
+            return ""
+
+    """
+    Method to get the line number of an index of the query input.
+    """
+    def __get_line(self, command, index):
+        return int(str(self.tk.call(command, "index", index)).split(".")[0])
+
+    """
+    Method to record that the lines first to last (0-based) were replaced, adding line_delta lines, and to schedule the highlighting.
+    Edits less than HIGHLIGHT_DELAY apart are highlighted once.
+    """
+    def __mark_changed(self, first, last, line_delta):
+        added = last - first + line_delta
+        # line_states[i] is the state at the start of line i. The states after the changed lines are kept (moved with their lines): 
+        # the highlighting stops at the first of them that is unchanged by the scan
+        self.line_states = self.line_states[:first + 1] + [None] * added + self.line_states[last + 1:]
+
+        until = first + added + 1
+        if self.highlight_line is None:
+            self.highlight_line = first
+        else:
+            # An unfinished scan must still scan past the line it stopped at
+            pending_until = max(self.highlight_until, self.highlight_line + 1)
+            self.highlight_line = min(self.highlight_line, first)
+            if pending_until > last:
+                until = max(until, pending_until + line_delta)
+        self.highlight_until = until
+
+        if self.highlight_job is not None:
+            self.after_cancel(self.highlight_job)
+            self.highlight_job = None
+        if self.highlight_timer is not None:
+            self.after_cancel(self.highlight_timer)
+        self.highlight_timer = self.after(SQLInput.HIGHLIGHT_DELAY, self.highlight_keywords)
+
+    """
+    Method to highlight the keywords in the changed lines of the query input. Lines are scanned from the first changed line 
+    until a line after the changed lines starts in the same state as before (e.g. outside of a string), after which the highlighting is unchanged. 
+    """
+    def highlight_keywords(self):
+        self.highlight_timer = None
+        if self.highlight_line is not None:
+            self.__highlight_step()
+
+    """
+    Method to scan lines of the query input for HIGHLIGHT_BUDGET at most, then to schedule the next step if the scan is not finished, 
+    so that very large inputs do not freeze the GUI.
+    """
+    def __highlight_step(self):
+        self.highlight_job = None
+        deadline = time.perf_counter() + SQLInput.HIGHLIGHT_BUDGET
+        line_count = len(self.line_states) - 1
+        line_number = self.highlight_line
+        while line_number < line_count:
+            line = self.query_input.get(f"{line_number + 1}.0", f"{line_number + 1}.end")
+            spans, state = scan_sql_line(line, self.line_states[line_number])
+            self.query_input.tag_remove("keyword", f"{line_number + 1}.0", f"{line_number + 2}.0")
+            if spans:
+                self.query_input.tag_add("keyword", *[f"{line_number + 1}.{column}" for span in spans for column in span])
+
+            line_number += 1
+            if line_number >= self.highlight_until and self.line_states[line_number] == state:
+                line_number = line_count
+                break
+            self.line_states[line_number] = state
+            if time.perf_counter() > deadline:
+                break
+
+        if line_number < line_count:
+            self.highlight_line = line_number
+            self.highlight_job = self.after(1, self.__highlight_step)
+        else:
+            self.highlight_line = None
+
     """
     Constructor to instantiate the SQLInput class.
     """
@@ -309,15 +704,43 @@ class SQLInput(ttk.Frame):
         self.execute_button.pack(side = ttk.BOTTOM, pady=4, padx = 8, anchor=ttk.S)
         self.execute_button.bind("<Button-1>", self.__execute_query)
 
+        self.cancel_button = ttk.Button(self, text="Cancel", style="danger.TButton", state="disabled")
+        self.cancel_button.pack(side = ttk.BOTTOM, pady=4, padx = 8, anchor=ttk.S)
+        self.cancel_button.bind("<Button-1>", self.__cancel_query)
+
+        self.progress_label = ttk.Label(self, text="", foreground=TEXT_SECONDARY_COLOR)
+        self.progress_label.pack(side = ttk.BOTTOM, pady=4, padx = 8, anchor=ttk.S)
+
+        self.job = None
+        self.job_events = queue.Queue()
+
         
         self.epsilon_input = Input(self, placeholder="Epsilon", default_value="1")
         self.epsilon_input.pack(side = ttk.RIGHT, pady=4, padx = 8)
         self.epsilon_label = ttk.Label(self, text="Epsilon", anchor=ttk.W)
         self.epsilon_label.pack(side = ttk.RIGHT, pady=4, padx = 8)
 
+        self.mode_input = ttk.Combobox(self, values=[mode.value for mode in ExplainMode], state="readonly", width=28)
+        self.mode_input.set(ExplainMode.ANALYZE_BUFFERS.value)
+        self.mode_input.pack(side = ttk.RIGHT, pady=4, padx = 8)
+        self.mode_label = ttk.Label(self, text="Mode", anchor=ttk.W)
+        self.mode_label.pack(side = ttk.RIGHT, pady=4, padx = 8)
+
+        self.timeout_input = Input(self, placeholder="Timeout", default_value="0", width=6)
+        self.timeout_input.pack(side = ttk.RIGHT, pady=4, padx = 8)
+        self.timeout_label = ttk.Label(self, text="Timeout (s)", anchor=ttk.W)
+        self.timeout_label.pack(side = ttk.RIGHT, pady=4, padx = 8)
+
         # Change self.m
 
-        self.query_input.bind("<KeyRelease>", self.highlight_keywords)
+        self.highlight_timer = None
+        self.highlight_job = None
+        self.line_states = [None, None]
+        self.highlight_line = None
+        self.highlight_until = 0
+        self.query_input_command = str(self.query_input) + "_original"
+        self.tk.call("rename", str(self.query_input), self.query_input_command)
+        self.tk.createcommand(str(self.query_input), self.__on_edit)
 
 """
 Class LayoutHeader is a component that contains the input fields for the database connection.
@@ -449,8 +872,9 @@ class LayoutContent(ttk.Frame):
     """
     def refresh_query_content(self):
         # To be used after a new query
-        image = Image.open('./assets/img/qep.png')
-        image = image.resize((560, 560))
+        graph_visualizer: GraphVisualizer = self.master.inner_state.graph_visualizer
+        # The graph is already rendered at the display size
+        image = Image.open(io.BytesIO(graph_visualizer.image))
         self.graph_image = ImageTk.PhotoImage(image)
         self.graph_image_label.configure(image=self.graph_image)
         self.graph_image_label.image = self.graph_image
@@ -537,6 +961,7 @@ class InnerState:
     def __init__(self):
         self.db_connection = None
         self.graph = None
+        self.graph_visualizer = None
 
 """
 Class App is the main component that organizes the QUPEX's components. 
@@ -564,17 +989,17 @@ class App(ttk.Window):
     Method to refresh the content layout.
     """
     def refresh_content_layout(self):
-        # Used to re-render the entirety of the content layout to its default state
-        self.content.pack_forget()
-        self.footer.pack_forget()
+        # Used to re-render the content layout to its default state when the connection changes. 
+        # The content of the current connection is kept, e.g. after a failed login attempt or a connection reset
+        if self.inner_state.db_connection is self.content_connection:
+            return
+        self.content.destroy()
         if self.inner_state.db_connection:
             self.content = LayoutContent(self, borderwidth=2)
         else:
             self.content = LayoutContentNotLoggedIn(self, borderwidth=2)
-        self.content.pack(side = ttk.TOP, padx=8, pady = 4, fill="both", expand=True)
-        
-        self.footer = LayoutFooter(self, borderwidth=2)
-        self.footer.pack(side = ttk.TOP, padx=8, pady = 4, fill="x")
+        self.content.pack(side = ttk.TOP, padx=8, pady = 4, fill="both", expand=True, before=self.footer)
+        self.content_connection = self.inner_state.db_connection
 
     """
     Method to login to the database.
@@ -616,6 +1041,7 @@ class App(ttk.Window):
         # Content that contains the query input and the query result
         self.content = LayoutContentNotLoggedIn(self, borderwidth=2)
         self.content.pack(side = ttk.TOP, padx=8, pady = 4, fill="both", expand=True)
+        self.content_connection = None
 
         # Footer that contains the credits
         self.footer = LayoutFooter(self, borderwidth=2)
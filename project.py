@@ -1,10 +1,196 @@
-from interface import App
-from interface import InnerState
+import argparse
+import json
+import os
+import sys
 
 """
-The entry point of the project that triggers the mainloop.
+Function to add the connection arguments of a command, which default to the libpq environment variables.
+"""
+def add_connection_arguments(parser):
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("PGPORT", "5432"))
+    parser.add_argument("--database", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""), help="defaults to $PGPASSWORD")
+
+"""
+Function to get the DB config from the connection arguments.
+"""
+def get_connection_config(arguments):
+    return {
+        "host": arguments.host,
+        "port": arguments.port,
+        "database": arguments.database,
+        "user": arguments.user,
+        "password": arguments.password,
+    }
+
+"""
+Function to parse the command line arguments. Without a command, the GUI is started.
+"""
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog="project.py", description="QUPEX - Query Plan Explorer")
+    commands = parser.add_subparsers(dest="command")
+
+    batch = commands.add_parser("explain", help="explain the SQL statements of a file or directory without the GUI, as a JSON Lines report")
+    batch.add_argument("path", help="a .sql file, or a directory that is searched recursively for .sql files")
+    add_connection_arguments(batch)
+    batch.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes, each with its own connection")
+    batch.add_argument("--mode", choices=["estimate", "analyze", "analyze-buffers"], default="estimate", help="estimate does not execute the statements")
+    batch.add_argument("--epsilon", type=float, default=1)
+    batch.add_argument("--timeout", type=float, default=0, help="statement timeout in seconds (0 to disable)")
+    batch.add_argument("--output", help="JSON Lines report file (defaults to stdout)")
+
+    snapshot = commands.add_parser("snapshot", help="capture the planner settings and the catalog of a database, to explain its plans offline")
+    add_connection_arguments(snapshot)
+    snapshot.add_argument("--output", required=True, help="snapshot JSON file to write")
+
+    offline = commands.add_parser("explain-plan", help="explain saved EXPLAIN (FORMAT JSON) plans offline against a snapshot, as a JSON Lines report")
+    offline.add_argument("path", help="a .json plan file, or a directory that is searched recursively for .json files")
+    offline.add_argument("--snapshot", required=True, help="snapshot JSON file captured with the snapshot command")
+    offline.add_argument("--epsilon", type=float, default=1)
+    offline.add_argument("--descriptions", action="store_true", help="include the cost description of every node")
+    offline.add_argument("--output", help="JSON Lines report file (defaults to stdout)")
+
+    what_if = commands.add_parser("what-if", help="simulate saved plans offline under other planner settings, as a JSON Lines report")
+    what_if.add_argument("path", help="a .json plan file, or a directory that is searched recursively for .json files")
+    what_if.add_argument("--snapshot", required=True, help="snapshot JSON file captured with the snapshot command")
+    what_if.add_argument("--set", dest="settings", action="append", required=True, metavar="NAME=VALUE[,VALUE...]", 
+                         help="values of a setting to sweep, e.g. random_page_cost=1.1,4 or work_mem=4MB,64MB (repeat for a grid)")
+    what_if.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    what_if.add_argument("--epsilon", type=float, default=1)
+    what_if.add_argument("--output", help="JSON Lines report file (defaults to stdout)")
+
+    benchmark = commands.add_parser("benchmark", help="benchmark graph construction, cost descriptions, rendering and batch cost evaluation on recorded plans, without a database")
+    benchmark.add_argument("--fixtures", help="directory with snapshot.json and plans/*.json (defaults to benchmarks/)")
+    benchmark.add_argument("--repeat", type=int, default=5, help="number of timed runs of each stage")
+    benchmark.add_argument("--output", help="write the results to this JSON baseline file")
+    benchmark.add_argument("--compare", help="baseline file to compare against, fails if a stage got slower than the threshold")
+    benchmark.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio over the baseline that counts as a regression")
+    return parser.parse_args()
+
+"""
+Function to run the headless batch explain.
+"""
+def run_batch_explain(arguments):
+    from explain import ExplainMode, run_batch
+
+    config = get_connection_config(arguments)
+    mode = ExplainMode[arguments.mode.upper().replace("-", "_")]
+    output = open(arguments.output, "w") if arguments.output else sys.stdout
+    try:
+        valid_count, invalid_count = run_batch(config, arguments.path, output, arguments.workers, mode, arguments.epsilon, arguments.timeout * 1000)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Explained {valid_count} statements, {invalid_count} failed.", file=sys.stderr)
+    return 1 if invalid_count else 0
+
+"""
+Function to capture a snapshot of a database.
+"""
+def capture_snapshot(arguments):
+    from explain import DB
+
+    db = DB(get_connection_config(arguments))
+    try:
+        snapshot = db.capture_snapshot()
+    finally:
+        db.close_connection()
+    snapshot.save(arguments.output)
+    print(f"Captured {len(snapshot.statistics.relations)} relations of PostgreSQL {snapshot.server_version} to {arguments.output}.", file=sys.stderr)
+    return 0
+
+"""
+Function to explain saved plans offline against a snapshot.
+"""
+def run_offline_explain(arguments):
+    from explain import Snapshot, run_offline
+
+    snapshot = Snapshot.load(arguments.snapshot)
+    output = open(arguments.output, "w") if arguments.output else sys.stdout
+    try:
+        valid_count, invalid_count = run_offline(snapshot, arguments.path, output, arguments.epsilon, arguments.descriptions)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Explained {valid_count} plans, {invalid_count} failed.", file=sys.stderr)
+    return 1 if invalid_count else 0
+
+"""
+Function to simulate saved plans under a grid of settings, and print the summary of each point of the grid.
+"""
+def run_what_if_simulation(arguments):
+    from explain import Snapshot, run_what_if
+
+    grid = {}
+    for setting in arguments.settings:
+        name, separator, values = setting.partition("=")
+        if not separator or not values:
+            print(f"Invalid setting {setting!r}, expected NAME=VALUE[,VALUE...]", file=sys.stderr)
+            return 2
+        grid[name.strip()] = [value.strip() for value in values.split(",")]
+
+    snapshot = Snapshot.load(arguments.snapshot)
+    output = open(arguments.output, "w") if arguments.output else sys.stdout
+    try:
+        summary = run_what_if(snapshot, arguments.path, grid, output, arguments.workers, arguments.epsilon)
+    except ValueError as exception:
+        print(exception, file=sys.stderr)
+        return 2
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    for point, plan_count, mean_ratio, top_node_changes in summary:
+        settings = ", ".join(f"{name}={value}" for name, value in point.items())
+        ratio = f"{mean_ratio:.3f}x" if mean_ratio is not None else "n/a"
+        print(f"{settings}: mean total cost {ratio} over {plan_count} plans, most expensive node changed in {top_node_changes}", file=sys.stderr)
+    return 0
+
+"""
+Function to run the benchmark, optionally saving the results as a baseline and comparing them against a previous baseline.
+"""
+def run_plan_benchmark(arguments):
+    from benchmark import compare_results, format_results, run_benchmark
+
+    results = run_benchmark(arguments.fixtures, arguments.repeat)
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+    print(format_results(results, baseline))
+
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if baseline:
+        regressions = compare_results(baseline, results, arguments.threshold)
+        for name, stage, baseline_time, stage_time in regressions:
+            print(f"Regression: {stage} of {name} took {stage_time * 1000:.2f} ms, {baseline_time * 1000:.2f} ms in the baseline.", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+"""
+The entry point of the project that triggers the mainloop, or runs one of the headless commands.
 """
 if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == "explain":
+        sys.exit(run_batch_explain(arguments))
+    if arguments.command == "snapshot":
+        sys.exit(capture_snapshot(arguments))
+    if arguments.command == "explain-plan":
+        sys.exit(run_offline_explain(arguments))
+    if arguments.command == "what-if":
+        sys.exit(run_what_if_simulation(arguments))
+    if arguments.command == "benchmark":
+        sys.exit(run_plan_benchmark(arguments))
+
+    from interface import App
+    from interface import InnerState
+
     inner_state = InnerState()
     app = App(inner_state)
     app.mainloop()